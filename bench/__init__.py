@@ -0,0 +1 @@
+"""Offline benchmarks for bot.py. Run them from the repository root, e.g. ``python -m bench.on_message``."""
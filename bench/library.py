@@ -0,0 +1,107 @@
+"""Benchmark of the local library index.
+
+Builds a LibraryIndex of ``--tracks`` synthetic tracks in a temporary
+database, then times searches that should be answered locally (the artist
+and name of a known song), searches that shouldn't (words that no title
+contains) and music.search listings. Prints one JSON line.
+
+    python -m bench.library --tracks 100000 --queries 2000
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault('MUSIC_DB_PATH', ':memory:')
+
+import bot  # noqa: E402
+
+WORDS = ('love night heart baby dance fire time summer dream light rain moon girl boy world life city road '
+         'blue gold wild home forever young star river ocean broken tonight happy sad crazy sweet lonely '
+         'electric golden silver midnight morning sunday paradise highway thunder angel devil money shadow '
+         'memory ghost kiss touch feel remember alive free falling rising burning running waiting calling').split()
+SUFFIXES = ('', ' (Official Video)', ' (Lyrics)', ' (Live)', ' (Remix)', ' [Official Audio]', ' (Acoustic)')
+
+
+def make_infos(count: int, rng: random.Random):
+    artists = ['{} {}'.format(rng.choice(WORDS).title(), rng.choice(WORDS).title()) + (' {}'.format(i) if i else '')
+               for i in range(count // 20 + 1)]
+
+    infos = []
+    for i in range(count):
+        artist = rng.choice(artists)
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title()
+        infos.append({
+            'webpage_url': 'https://www.youtube.com/watch?v={:011d}'.format(i),
+            'title': '{} - {}{}'.format(artist, title, rng.choice(SUFFIXES)),
+            'uploader': artist,
+            'tags': rng.sample(WORDS, 3),
+            'duration': rng.randint(90, 600),
+        })
+
+    return infos
+
+
+def timed(operation, items):
+    samples = []
+    for item in items:
+        start = time.perf_counter()
+        operation(item)
+        samples.append(time.perf_counter() - start)
+
+    samples.sort()
+    return {
+        'count': len(samples),
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'p99_ms': round(samples[int(len(samples) * 0.99)] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=1000, help='tracks added per transaction')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    infos = make_infos(args.tracks, rng)
+
+    with tempfile.TemporaryDirectory() as directory:
+        library = bot.LibraryIndex(os.path.join(directory, 'library.sqlite3'), confidence=bot.MUSIC_LIBRARY_CONFIDENCE)
+        if not library.enabled:
+            raise SystemExit('sqlite was built without FTS5')
+
+        start = time.perf_counter()
+        for i in range(0, len(infos), args.batch):
+            library.add(*infos[i:i + args.batch])
+        build = time.perf_counter() - start
+
+        # How people usually ask for a song: its name and the artist, without the decorations.
+        known = []
+        for info in rng.sample(infos, args.queries):
+            name = info['title'].split(' - ', 1)[1].split(' (')[0].split(' [')[0]
+            known.append(('{} {}'.format(info['uploader'], name), info['webpage_url']))
+        unknown = ['{} {}'.format(rng.choice(WORDS), 'zzz{}'.format(i)) for i in range(args.queries)]
+
+        answered = []
+        results = {
+            'benchmark': 'library',
+            'tracks': len(library),
+            'build_seconds': round(build, 2),
+            'tracks_per_sec': round(args.tracks / build),
+            'match_known': timed(lambda query: answered.append(library.match(query[0]) == query[1]), known),
+            'match_unknown': timed(library.match, unknown),
+            'search_top10': timed(lambda query: library.search(query[0], limit=10), known),
+        }
+        results['answered_locally'] = round(sum(answered) / len(answered), 3)
+        results['db_bytes'] = os.path.getsize(os.path.join(directory, 'library.sqlite3'))
+
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,756 @@
+"""End to end benchmark of the Music cog without Discord or YouTube.
+
+Drives ``bot.on_message`` through a fake gateway. Every simulated guild has
+a text channel, a voice channel and a listener in it who queues ``--songs``
+songs with ``music.play``. Voice connections are fake VoiceClients that
+consume frames like discord.py's AudioPlayer thread does, at ``--speed``
+times real time. ``youtube_dl.YoutubeDL.extract_info`` is replaced by a stub
+that answers after ``--extract-latency`` seconds, and stream URLs point to a
+local HTTP server. The audio comes from stub FFmpeg sources producing
+silence (``--audio fake``) or from real FFmpeg decoding a generated tone
+(``--audio ffmpeg``). Other users chat at ``--chatter-rate`` messages per
+second meanwhile. With ``--shared-tracks`` every guild queues the same songs,
+which is what MUSIC_BROADCAST=1 is for. With ``--playlist`` every guild queues
+its songs with a single playlist link instead. With ``--returns N`` every
+listener comes back ``--return-after`` seconds after its songs finished and
+plays one more song, N times, which shows whether the voice connection was
+kept warm (MUSIC_KEEP_WARM*) or had to be made again, taking
+``--voice-connect`` seconds. With ``--unavailable N`` about one video in N
+fails to extract the way removed videos do, and is skipped. Voice channels carry ``--channel-bitrate``,
+which decides the stream format played (MUSIC_FORMAT). With ``--processes N`` the
+guilds and the chatter are split between N bot processes running at the
+same time, the way the Supervisor splits shards (MUSIC_PROCESSES), and their
+results are merged.
+
+Prints one JSON line per guild count with the enqueue latency, time to first
+audio, gaps between songs, CPU per stream and on_message throughput. Every
+guild count runs in its own process so caches and threads don't carry over.
+The bot's own settings (MUSIC_PLAYBACK, YTDL_WORKERS, ...) are read from the
+environment as usual.
+
+    python -m bench.music --guilds 1,10,100,500 --songs 3 --track-seconds 30 --speed 5
+"""
+
+import argparse
+import asyncio
+import collections
+import functools
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+os.environ.setdefault('MUSIC_DB_PATH', ':memory:')
+os.environ.setdefault('YTDL_POOL', 'thread')
+# Downloads to the audio cache would compete with the streams being measured.
+os.environ.setdefault('MUSIC_AUDIO_CACHE_SIZE', '0')
+
+import discord  # noqa: E402
+import youtube_dl  # noqa: E402
+
+import bot  # noqa: E402
+
+FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000
+PCM_SILENCE = b'\0' * discord.opus.Encoder.FRAME_SIZE
+# Not Broadcast.SILENCE, which the fake client tells apart as filler.
+OPUS_SILENCE = b'\xfc\xff\xfe'
+
+# Samples are kept for the whole run, not just the most recent ones.
+timings = bot.LatencyRecorder(size=10 ** 6)
+
+
+FORMATS = (('139', 'mp4a.40.5', 48), ('249', 'opus', 50), ('250', 'opus', 70), ('140', 'mp4a.40.2', 128),
+           ('251', 'opus', 160))
+
+
+class StubExtractor:
+    """Replaces ``youtube_dl.YoutubeDL.extract_info``.
+
+    Searches return one entry, playlist links (``list=<name>-<count>``) return
+    ``count`` flat entries and other URLs return a processed info dict, after
+    ``latency`` seconds give or take half. About one video in ``unavailable``
+    raises DownloadError instead.
+    """
+
+    def __init__(self, latency: float, seconds: float, stream_url: str, unavailable: int = 0):
+        self.latency = latency
+        self.seconds = seconds
+        self.stream_url = stream_url
+        self.unavailable = unavailable
+        self.calls = 0
+        self._rng = random.Random(0)
+        self._lock = threading.Lock()
+
+    # Set on the class, so it's called without the YoutubeDL instance.
+    def __call__(self, url, download=True, ie_key=None, extra_info=None, process=True,
+                 force_generic_extractor=False):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * self._rng.uniform(0.5, 1.5)
+        time.sleep(delay)
+
+        if not url.startswith(('http://', 'https://')):
+            video_id = hashlib.md5(url.encode()).hexdigest()[:11]
+            return {'_type': 'playlist', 'entries': [
+                {'id': video_id, 'title': url, 'webpage_url': 'https://www.youtube.com/watch?v=' + video_id}]}
+
+        if 'list=' in url:
+            name, count = url.rsplit('list=', 1)[1].rsplit('-', 1)
+            video_ids = [hashlib.md5('{} {}'.format(name, i).encode()).hexdigest()[:11] for i in range(int(count))]
+            return {'_type': 'playlist', 'entries': [
+                {'_type': 'url', 'ie_key': 'Youtube', 'id': video_id, 'url': video_id, 'title': 'Track ' + video_id}
+                for video_id in video_ids]}
+
+        video_id = url.rsplit('=', 1)[-1]
+        if self.unavailable and int(video_id, 16) % self.unavailable == 0:
+            raise youtube_dl.utils.DownloadError('ERROR: Video unavailable')
+
+        return {
+            'id': video_id,
+            'extractor': 'youtube',
+            'title': 'Track ' + video_id,
+            'uploader': 'Bench',
+            'uploader_url': 'https://www.youtube.com/channel/bench',
+            'upload_date': '20200101',
+            'thumbnail': 'https://i.ytimg.com/vi/{}/hqdefault.jpg'.format(video_id),
+            'description': '',
+            'duration': int(self.seconds),
+            'tags': [],
+            'webpage_url': url,
+            'view_count': 0,
+            'like_count': 0,
+            'dislike_count': 0,
+            'url': self.stream_url,
+            'acodec': 'opus',
+            'abr': 160,
+            # YouTube's audio only formats, all served by StreamServer.
+            'formats': [{'format_id': format_id, 'acodec': acodec, 'abr': abr, 'vcodec': 'none', 'protocol': 'https',
+                         'url': '{}?itag={}'.format(self.stream_url, format_id)}
+                        for format_id, acodec, abr in FORMATS],
+        }
+
+
+class StreamServer:
+    """Serves the one file every stream URL points to, so probes and real FFmpeg work offline."""
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    def __init__(self, seconds: float, generate: bool):
+        self.directory = tempfile.mkdtemp(prefix='bench-music-')
+        path = os.path.join(self.directory, 'tone.webm')
+        if generate:
+            subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi',
+                            '-i', 'sine=frequency=440:duration={}'.format(seconds),
+                            '-c:a', 'libopus', '-b:a', '128k', path], check=True)
+        else:
+            with open(path, 'wb') as f:
+                f.write(b'\0' * 1024)
+
+        handler = functools.partial(self.Handler, directory=self.directory)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/tone.webm'.format(self.server.server_address[1])
+
+    def close(self):
+        self.server.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class FakeFFmpegAudio(discord.AudioSource):
+    """Stands in for FFmpegPCMAudio and FFmpegOpusAudio: silence for the length of the track."""
+
+    seconds = 0.0
+    # Stream formats asked for, by itag.
+    formats = collections.Counter()
+
+    def __init__(self, source, *, opus: bool, before_options: str = None, **kwargs):
+        self.formats[source.rsplit('itag=', 1)[1] if 'itag=' in source else 'default'] += 1
+        position = 0.0
+        if before_options and '-ss ' in before_options:
+            position = float(before_options.split('-ss ', 1)[1].split()[0])
+
+        self.opus = opus
+        self.remaining = int(max(0.0, self.seconds - position) / FRAME_LENGTH)
+
+    def read(self):
+        if self.remaining <= 0:
+            return b''
+
+        self.remaining -= 1
+        return OPUS_SILENCE if self.opus else PCM_SILENCE
+
+    def is_opus(self):
+        return self.opus
+
+
+class FakeAudioPlayer(threading.Thread):
+    """The loop of discord.py's AudioPlayer, sending frames to the fake client instead of a socket."""
+
+    def __init__(self, source: discord.AudioSource, client: 'FakeVoiceClient', *, after=None):
+        super().__init__(daemon=True)
+        self.source = source
+        self.client = client
+        self.after = after
+        self.delay = FRAME_LENGTH / client.speed
+
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._lock = threading.Lock()
+        self._error = None
+
+    def run(self):
+        try:
+            self._do_run()
+        except Exception as e:
+            self._error = e
+            self.stop()
+        finally:
+            self.source.cleanup()
+            if self.after is not None:
+                self.after(self._error)
+
+    def _do_run(self):
+        loops = 0
+        start = time.perf_counter()
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+                loops = 0
+                start = time.perf_counter()
+                continue
+
+            loops += 1
+            with self._lock:
+                data = self.source.read()
+                opus = self.source.is_opus()
+
+            if not data:
+                self.stop()
+                break
+
+            self.client.send_audio_packet(data, encode=not opus)
+            time.sleep(max(0.0, start + self.delay * loops - time.perf_counter()))
+
+    def set_source(self, source: discord.AudioSource):
+        with self._lock:
+            self.source = source
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def is_playing(self):
+        return self._resumed.is_set() and not self._end.is_set()
+
+    def is_paused(self):
+        return not self._end.is_set() and not self._resumed.is_set()
+
+
+class FakeVoiceClient:
+    """The parts of discord.VoiceClient the cog uses. Measures when audio actually flows."""
+
+    def __init__(self, guild: 'FakeGuild', channel: 'FakeVoiceChannel', *, speed: float, encode: bool):
+        self.guild = guild
+        self.channel = channel
+        self.speed = speed
+        self.encoder = discord.opus.Encoder() if encode else None
+        self.frames = 0
+        # Broadcast.SILENCE sent while a broadcast's pump was behind, not audio.
+        self.filler_frames = 0
+        self.tracks_finished = 0
+        self._player = None
+        self._ended_at = None
+        self._waiting = False
+
+    @property
+    def source(self):
+        return self._player.source if self._player else None
+
+    @source.setter
+    def source(self, value: discord.AudioSource):
+        if self._player is None:
+            raise ValueError('Not playing anything.')
+
+        self._player.set_source(value)
+
+    def play(self, source: discord.AudioSource, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+
+        def finished(error):
+            self._ended_at = time.perf_counter()
+            self.tracks_finished += 1
+            if after is not None:
+                after(error)
+
+        self._waiting = True
+        self._player = FakeAudioPlayer(source, self, after=finished)
+        self._player.start()
+
+    def send_audio_packet(self, data: bytes, *, encode: bool = True):
+        if data == bot.Broadcast.SILENCE:
+            self.filler_frames += 1
+            return
+
+        if self._waiting:
+            self._waiting = False
+            now = time.perf_counter()
+            if self.guild.first_play_at is not None:
+                timings('first_audio', now - self.guild.first_play_at)
+                self.guild.first_play_at = None
+            elif self._ended_at is not None:
+                timings('gap', now - self._ended_at)
+
+        if encode and self.encoder is not None:
+            self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+        self.frames += 1
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    async def move_to(self, channel: 'FakeVoiceChannel'):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self.guild.voice_client = None
+
+
+class FakeHTTP:
+    async def send_typing(self, channel_id: int):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, channel: 'FakeTextChannel'):
+        self.channel = channel
+
+    async def edit(self, **kwargs):
+        self.channel.edits += 1
+
+
+class FakeTextChannel:
+    def __init__(self, channel_id: int, guild: 'FakeGuild', state):
+        self.id = channel_id
+        self.guild = guild
+        self._state = state
+        self.sent = 0
+        self.edits = 0
+        self.enqueued = 0
+        self.skipped = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        # Replies may have been merged into one message by the dispatcher.
+        for line in (content or '').splitlines():
+            if line.startswith('Enqueued **') and line.endswith(' songs from the playlist'):
+                self.enqueued += int(line.split('**')[1])
+            elif line.startswith('Enqueued'):
+                self.enqueued += 1
+            elif line.startswith('Couldn\'t play'):
+                self.skipped += 1
+
+        return FakeMessage(self)
+
+
+class FakeVoiceChannel:
+    # Seconds the voice handshake takes.
+    connect_latency = 0.0
+    bitrate = 64000
+
+    def __init__(self, channel_id: int, guild: 'FakeGuild', *, speed: float, encode: bool):
+        self.id = channel_id
+        self.guild = guild
+        self.speed = speed
+        self.encode = encode
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(self.connect_latency)
+        self.guild.voice_client = FakeVoiceClient(self.guild, self, speed=self.speed, encode=self.encode)
+        self.guild.voice_clients.append(self.guild.voice_client)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self, ids, state, *, speed: float, encode: bool):
+        self.id = next(ids)
+        self.voice_client = None
+        # Every connection made, they're gone from voice_client once disconnected.
+        self.voice_clients = []
+        self.first_play_at = None
+        self.text_channel = FakeTextChannel(next(ids), self, state)
+        self.voice_channel = FakeVoiceChannel(next(ids), self, speed=speed, encode=encode)
+        self.listener = make_member(next(ids), voice_channel=self.voice_channel)
+
+    def done(self):
+        if self.text_channel.enqueued == 0:
+            return True
+
+        return self.tracks_finished + self.text_channel.skipped >= self.text_channel.enqueued
+
+    @property
+    def tracks_finished(self):
+        return sum(client.tracks_finished for client in self.voice_clients)
+
+    @property
+    def frames(self):
+        return sum(client.frames for client in self.voice_clients)
+
+    @property
+    def filler_frames(self):
+        return sum(client.filler_frames for client in self.voice_clients)
+
+
+def make_member(member_id: int, *, voice_channel: FakeVoiceChannel = None):
+    return types.SimpleNamespace(id=member_id, name='user{}'.format(member_id), discriminator='0001', nick=None,
+                                 bot=False, mention='<@{}>'.format(member_id),
+                                 voice=types.SimpleNamespace(channel=voice_channel) if voice_channel else None)
+
+
+class FakeGateway:
+    """Turns (guild, author, content) into message events for ``bot.on_message``."""
+
+    def __init__(self, guilds: int, *, speed: float, encode: bool):
+        ids = itertools.count(10 ** 17)
+        self.state = types.SimpleNamespace(loop=bot.bot.loop, http=FakeHTTP())
+        self.guilds = [FakeGuild(ids, self.state, speed=speed, encode=encode) for _ in range(guilds)]
+        self.chatters = [make_member(next(ids)) for _ in range(100)]
+
+        bot.bot._connection.user = make_member(next(ids))
+        bot.bot.process_commands = self.process_commands
+
+    async def process_commands(self, message):
+        if message.author.bot:
+            return
+
+        ctx = await bot.bot.get_context(message)
+        await bot.bot.invoke(ctx)
+
+    async def dispatch(self, guild: FakeGuild, author, content: str):
+        message = types.SimpleNamespace(author=author, content=content, guild=guild, channel=guild.text_channel,
+                                        mentions=[], _state=self.state)
+        await bot.on_message(message)
+
+
+async def listener(gateway: FakeGateway, guild: FakeGuild, songs: int, query: str, shared: bool, playlist: bool,
+                   returns: int = 0, return_after: float = 0):
+    if playlist:
+        name = 'shared' if shared else 'guild{}'.format(guild.id)
+        guild.first_play_at = start = time.perf_counter()
+        await gateway.dispatch(guild, guild.listener,
+                               'music.play https://www.youtube.com/playlist?list={}-{}'.format(name, songs))
+        timings('enqueue', time.perf_counter() - start)
+        return
+
+    for i in range(songs):
+        search = 'bench song {}'.format(i) if shared else 'bench guild {} song {}'.format(guild.id, i)
+        if query == 'url':
+            search = 'https://www.youtube.com/watch?v=' + hashlib.md5(search.encode()).hexdigest()[:11]
+
+        start = time.perf_counter()
+        if i == 0:
+            guild.first_play_at = start
+        await gateway.dispatch(guild, guild.listener, 'music.play ' + search)
+        timings('enqueue', time.perf_counter() - start)
+
+    for i in range(returns):
+        while not guild.done():
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(return_after)
+
+        search = 'bench guild {} return {}'.format(guild.id, i)
+        guild.first_play_at = time.perf_counter()
+        await gateway.dispatch(guild, guild.listener, 'music.play ' + search)
+
+
+async def chatter(gateway: FakeGateway, rate: float, counter: list):
+    rng = random.Random(1)
+    start = time.perf_counter()
+    while True:
+        guild = rng.choice(gateway.guilds)
+        sent = time.perf_counter()
+        await gateway.dispatch(guild, rng.choice(gateway.chatters), 'anyone listening to anything good?')
+        timings('on_message', time.perf_counter() - sent)
+        counter[0] += 1
+
+        await asyncio.sleep(max(0.0, start + counter[0] / rate - time.perf_counter()))
+
+
+async def ffmpeg_sampler(peak: list):
+    while True:
+        peak[0] = max(peak[0], bot.StreamStats.ffmpeg_sources)
+        await asyncio.sleep(0.05)
+
+
+async def run(args):
+    gateway = FakeGateway(args.guilds, speed=args.speed, encode=args.encode)
+    messages = [0]
+    chatter_task = asyncio.ensure_future(chatter(gateway, args.chatter_rate, messages)) if args.chatter_rate else None
+    args.ffmpeg_peak = [0]
+    sampler = asyncio.ensure_future(ffmpeg_sampler(args.ffmpeg_peak))
+
+    cpu_start, wall_start = os.times(), time.perf_counter()
+    await asyncio.gather(*(listener(gateway, guild, args.songs, args.query, args.shared_tracks, args.playlist,
+                                    args.returns, args.return_after)
+                           for guild in gateway.guilds))
+
+    deadline = time.perf_counter() + args.timeout
+    while not all(guild.done() for guild in gateway.guilds) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+
+    cpu_end, wall = os.times(), time.perf_counter() - wall_start
+    sampler.cancel()
+    if chatter_task is not None:
+        chatter_task.cancel()
+
+    voice_states = bot.bot.get_cog('Music').voice_states
+    for guild in gateway.guilds:
+        await voice_states.remove(guild.id)
+
+    return gateway, messages[0], wall, cpu_start, cpu_end
+
+
+def milliseconds(label: str):
+    samples = timings.samples.get(label)
+    if not samples:
+        return None
+
+    return {'count': len(samples), **{'p{}'.format(p): round(timings.percentile(p, label) * 1000, 1)
+                                      for p in (50, 90, 99)}, 'max': round(max(samples) * 1000, 1)}
+
+
+def percentiles(samples: list):
+    if not samples:
+        return None
+
+    samples = sorted(samples)
+    return {'count': len(samples), **{'p{}'.format(p): round(samples[min(len(samples) - 1, len(samples) * p // 100)]
+                                                            * 1000, 1) for p in (50, 90, 99)},
+            'max': round(samples[-1] * 1000, 1)}
+
+
+def report(args, gateway: FakeGateway, messages: int, wall: float, cpu_start, cpu_end):
+    stream_seconds = sum(guild.frames for guild in gateway.guilds) * FRAME_LENGTH
+    process_cpu = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    children_cpu = (cpu_end.children_user - cpu_start.children_user) + \
+                   (cpu_end.children_system - cpu_start.children_system)
+    per_stream = (lambda cpu: round(cpu / stream_seconds, 4) if stream_seconds else None)
+    median = (lambda label: bot.StreamStats.cpu_usage.median(label))
+    engine = bot.YTDLSource.engine.stats()
+
+    results = {
+        'benchmark': 'music',
+        'guilds': args.guilds,
+        'processes': args.processes,
+        'songs_per_guild': args.songs,
+        'track_seconds': args.track_seconds,
+        'speed': args.speed,
+        'audio': args.audio,
+        'playback': bot.MUSIC_PLAYBACK,
+        'query': args.query,
+        'shared_tracks': args.shared_tracks,
+        'playlist': args.playlist,
+        'broadcast': bot.MUSIC_BROADCAST,
+        'extract_latency': args.extract_latency,
+        'seconds': round(wall, 2),
+        'timed_out': not all(guild.done() for guild in gateway.guilds),
+        'enqueued': sum(guild.text_channel.enqueued for guild in gateway.guilds),
+        'tracks_played': sum(guild.tracks_finished for guild in gateway.guilds),
+        'tracks_skipped': sum(guild.text_channel.skipped for guild in gateway.guilds),
+        'filler_frames': sum(guild.filler_frames for guild in gateway.guilds),
+        'enqueue_ms': milliseconds('enqueue'),
+        'first_audio_ms': milliseconds('first_audio'),
+        'gap_ms': milliseconds('gap'),
+        'cpu_per_stream': {
+            # Cores busy per stream playing in real time.
+            'process': per_stream(process_cpu),
+            'ffmpeg': per_stream(children_cpu),
+            'median_total': median(bot.MUSIC_PLAYBACK),
+            'median_python': median(bot.MUSIC_PLAYBACK + '-python'),
+        },
+        'ffmpeg_processes_peak': args.ffmpeg_peak[0],
+        'opus_encode': args.encode,
+        'messages': messages,
+        'messages_per_sec': round(messages / wall, 1),
+        'on_message_ms': milliseconds('on_message'),
+        'extractions': args.stub.calls,
+        'messages_sent': sum(guild.text_channel.sent for guild in gateway.guilds),
+        'message_edits': sum(guild.text_channel.edits for guild in gateway.guilds),
+        'messages_coalesced': bot.dispatcher.coalesced,
+        'extractions_rejected': engine['rejected'],
+        'returns': args.returns,
+        'voice_joins': dict(bot.VoiceState.joins),
+        'voice_connects': sum(len(guild.voice_clients) for guild in gateway.guilds),
+        'channel_bitrate': FakeVoiceChannel.bitrate,
+        'stream_format': bot.MUSIC_FORMAT,
+        'formats_played': dict(FakeFFmpegAudio.formats),
+        'stream_bytes': dict(bot.StreamStats.stream_bytes),
+        'stream_kb_per_track': {acodec: round(bot.StreamStats.track_bytes.median(acodec) / 1000, 1)
+                                for acodec in bot.StreamStats.track_bytes.samples if acodec != 'all'},
+        'ffmpeg_cpu_seconds': {acodec: round(cpu, 3) for acodec, cpu in bot.StreamStats.decode_cpu.items()},
+        'first_audio_by_join_ms': {join: {key: round(value * 1000, 1) if key != 'count' else value
+                                          for key, value in summary.items()}
+                                   for join, summary in bot.VoiceState.first_audio.summary().items()
+                                   if join != 'all'},
+    }
+    if args.samples:
+        results['samples'] = {label: list(timings.samples.get(label, ()))
+                              for label in ('enqueue', 'first_audio', 'gap', 'on_message')}
+        results['samples'].update(stream_seconds=stream_seconds, process_cpu=process_cpu, children_cpu=children_cpu)
+
+    return results
+
+
+# Counts that add up across processes.
+SUMMED = ('enqueued', 'tracks_played', 'tracks_skipped', 'filler_frames', 'ffmpeg_processes_peak', 'messages', 'extractions', 'messages_sent',
+          'message_edits', 'messages_coalesced', 'extractions_rejected')
+SUMMED_BY_LABEL = ('voice_joins', 'formats_played', 'stream_bytes', 'ffmpeg_cpu_seconds')
+
+
+def run_processes(args, argv: list):
+    """Runs ``args.processes`` benchmarks at once, each with its share of the
+    guilds and the chatter, and merges what they measured."""
+
+    children = []
+    for index in range(args.processes):
+        guilds = args.guilds // args.processes + (index < args.guilds % args.processes)
+        command = [sys.executable, '-m', 'bench.music', '--guilds', str(guilds), '--samples',
+                   '--chatter-rate', str(args.chatter_rate / args.processes)] + argv
+        children.append(subprocess.Popen(command, stdout=subprocess.PIPE))
+
+    runs = []
+    for child in children:
+        output, _ = child.communicate()
+        if child.returncode:
+            raise SystemExit(child.returncode)
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    results = dict(runs[0], guilds=args.guilds, processes=args.processes)
+    results.update({key: sum(run[key] for run in runs) for key in SUMMED})
+    for key in SUMMED_BY_LABEL:
+        results[key] = dict(sum((collections.Counter(run[key]) for run in runs), collections.Counter()))
+    results['seconds'] = max(run['seconds'] for run in runs)
+    results['timed_out'] = any(run['timed_out'] for run in runs)
+    results['messages_per_sec'] = round(results['messages'] / results['seconds'], 1)
+
+    samples = [run.pop('samples') for run in runs]
+    del results['samples']
+    for label in ('enqueue', 'first_audio', 'gap', 'on_message'):
+        results[label + '_ms'] = percentiles([sample for run in samples for sample in run[label]])
+
+    stream_seconds = sum(run['stream_seconds'] for run in samples)
+    per_stream = (lambda cpu: round(cpu / stream_seconds, 4) if stream_seconds else None)
+    results['cpu_per_stream'] = dict(results['cpu_per_stream'],
+                                     process=per_stream(sum(run['process_cpu'] for run in samples)),
+                                     ffmpeg=per_stream(sum(run['children_cpu'] for run in samples)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', default='1,10,100,500', help='comma separated guild counts')
+    parser.add_argument('--songs', type=int, default=3, help='songs queued per guild')
+    parser.add_argument('--track-seconds', type=float, default=30)
+    parser.add_argument('--speed', type=float, default=5, help='playback speed, 1 is real time')
+    parser.add_argument('--extract-latency', type=float, default=0.3, help='mean seconds per extract_info call')
+    parser.add_argument('--query', choices=('search', 'url'), default='search')
+    parser.add_argument('--shared-tracks', action='store_true', help='every guild queues the same songs')
+    parser.add_argument('--playlist', action='store_true', help='queue the songs with one playlist link')
+    parser.add_argument('--audio', choices=('fake', 'ffmpeg'), default='fake')
+    parser.add_argument('--chatter-rate', type=float, default=200, help='other messages per second, 0 for none')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for playback to finish')
+    parser.add_argument('--no-encode', dest='encode', action='store_false',
+                        help="don't Opus-encode PCM frames like VoiceClient does")
+    parser.add_argument('--returns', type=int, default=0, help='times every listener comes back for one more song')
+    parser.add_argument('--return-after', type=float, default=2, help='seconds between the queue ending and a return')
+    parser.add_argument('--voice-connect', type=float, default=0.5, help='seconds a voice handshake takes')
+    parser.add_argument('--channel-bitrate', type=int, default=64000, help='bits per second of the voice channels')
+    parser.add_argument('--unavailable', type=int, default=0, help='about one video in N fails to extract')
+    parser.add_argument('--processes', type=int, default=1, help='bot processes sharing the guilds')
+    parser.add_argument('--samples', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    counts = [int(count) for count in args.guilds.split(',')]
+    if len(counts) > 1:
+        argv, skip = [], False
+        for arg in sys.argv[1:]:
+            if not skip and not arg.startswith('--guilds'):
+                argv.append(arg)
+            skip = arg == '--guilds'
+
+        for count in counts:
+            subprocess.run([sys.executable, '-m', 'bench.music', '--guilds', str(count)] + argv, check=True)
+        return
+
+    args.guilds = counts[0]
+    if args.processes > 1:
+        argv, skip = [], False
+        for arg in sys.argv[1:]:
+            if not skip and not arg.startswith(('--guilds', '--processes', '--chatter-rate')):
+                argv.append(arg)
+            skip = arg in ('--guilds', '--processes', '--chatter-rate')
+
+        print(json.dumps(run_processes(args, argv)))
+        return
+
+    if args.encode and not discord.opus.is_loaded():
+        args.encode = discord.opus._load_default()
+
+    server = StreamServer(args.track_seconds, generate=args.audio == 'ffmpeg')
+    args.stub = StubExtractor(args.extract_latency, args.track_seconds, server.url, args.unavailable)
+    youtube_dl.YoutubeDL.extract_info = args.stub
+    FakeVoiceChannel.connect_latency = args.voice_connect
+    FakeVoiceChannel.bitrate = args.channel_bitrate
+    bot.Broadcast.FRAME_DELAY /= args.speed
+    if args.audio == 'fake':
+        FakeFFmpegAudio.seconds = args.track_seconds
+        discord.FFmpegPCMAudio = functools.partial(FakeFFmpegAudio, opus=False)
+        discord.FFmpegOpusAudio = functools.partial(FakeFFmpegAudio, opus=True)
+
+    try:
+        results = bot.bot.loop.run_until_complete(run(args))
+    finally:
+        server.close()
+
+    print(json.dumps(report(args, *results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Micro-benchmark of on_message throughput.
+
+Feeds synthetic messages through ``bot.on_message`` with command processing
+stubbed out, so only the trigger rules and the dispatch are measured. Most
+messages come from ordinary users, a configurable share from authors that
+have rules. Prints one JSON line with the results.
+
+    python -m bench.on_message --messages 200000 --rule-share 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import types
+
+os.environ.setdefault('MUSIC_DB_PATH', ':memory:')
+
+import bot  # noqa: E402
+
+
+class FakeChannel:
+    def __init__(self):
+        self.id = 1
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+
+def make_author(author_id: int, name: str, discriminator: str, nick: str = None):
+    return types.SimpleNamespace(id=author_id, name=name, discriminator=discriminator, nick=nick,
+                                 mention='<@{}>'.format(author_id))
+
+
+def make_messages(count: int, rule_share: float, users: int, channel: FakeChannel):
+    ordinary = [make_author(10 ** 17 + i, 'user{}'.format(i), '{:04d}'.format(i % 10000)) for i in range(users)]
+    triggers = [
+        (make_author(159985870458322944, 'MEE6', '4876', nick='Modaru Nivelaru'), 'GG, you just advanced to level 5!'),
+        (make_author(42, 'MEE6', '0000'), 'Hey <@!317000109680230400>, welcome!'),
+        (make_author(43, 'OmuRoshuCuUnBatz', '8792'), 'muie.popa'),
+    ]
+
+    rng = random.Random(0)
+    messages = []
+    for _ in range(count):
+        if rng.random() < rule_share:
+            author, content = rng.choice(triggers)
+        else:
+            author, content = rng.choice(ordinary), 'just chatting about music.play and stuff'
+        messages.append(types.SimpleNamespace(author=author, content=content, channel=channel))
+
+    return messages
+
+
+async def run(messages):
+    processed = 0
+
+    async def process_commands(message):
+        nonlocal processed
+        processed += 1
+
+    bot.bot.process_commands = process_commands
+
+    start = time.perf_counter()
+    for message in messages:
+        await bot.on_message(message)
+    elapsed = time.perf_counter() - start
+
+    return elapsed, processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--rule-share', type=float, default=0.01)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    channel = FakeChannel()
+    messages = make_messages(args.messages, args.rule_share, args.users, channel)
+    elapsed, processed = asyncio.get_event_loop().run_until_complete(run(messages))
+
+    print(json.dumps({
+        'benchmark': 'on_message',
+        'messages': args.messages,
+        'rule_share': args.rule_share,
+        'rules': len(bot.message_rules),
+        'seconds': round(elapsed, 4),
+        'messages_per_sec': round(args.messages / elapsed),
+        # Responses go out through the rate limited dispatcher, most are still queued or merged.
+        'responses': bot.dispatcher.stats(),
+        'commands_processed': processed,
+    }))
+
+
+if __name__ == '__main__':
+    main()
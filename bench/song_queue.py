@@ -0,0 +1,69 @@
+"""Benchmark of SongQueue operations on large queues.
+
+Times put, indexed access, slicing a page, moving, removing and getting
+songs on a queue of ``--size`` entries, in first come first served and in
+fair mode. Prints one JSON line per mode with microseconds per operation.
+
+    python -m bench.song_queue --size 10000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import types
+
+os.environ.setdefault('MUSIC_DB_PATH', ':memory:')
+
+import bot  # noqa: E402
+
+
+def make_song(i: int, requesters: int):
+    return types.SimpleNamespace(requester=types.SimpleNamespace(id=i % requesters),
+                                 track=types.SimpleNamespace(webpage_url='https://example.com/{}'.format(i)))
+
+
+def timed(operation, count: int):
+    start = time.perf_counter()
+    for _ in range(count):
+        operation()
+    return round((time.perf_counter() - start) / count * 1e6, 2)
+
+
+async def run(size: int, requesters: int, fair: bool):
+    rng = random.Random(0)
+    queue = bot.SongQueue(fair=fair)
+    songs = iter([make_song(i, requesters) for i in range(size)])
+
+    results = {'benchmark': 'song_queue', 'size': size, 'fair': fair}
+    results['put_us'] = timed(lambda: queue.put_nowait(next(songs)), size)
+    results['index_us'] = timed(lambda: queue[rng.randrange(size)], size)
+    results['page_us'] = timed(lambda: queue[rng.randrange(size - 10):][:10], 1000)
+    results['has_us'] = timed(lambda: queue.has('https://example.com/{}'.format(rng.randrange(size))), size)
+    results['move_us'] = timed(lambda: queue.move(rng.randrange(size), rng.randrange(size)), size)
+    results['remove_us'] = timed(lambda: queue.remove(rng.randrange(len(queue))), size // 2)
+
+    start = time.perf_counter()
+    remaining = len(queue)
+    while len(queue):
+        await queue.get()
+    results['get_us'] = round((time.perf_counter() - start) / remaining * 1e6, 2)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--requesters', type=int, default=50)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    for fair in (False, True):
+        print(json.dumps(loop.run_until_complete(run(args.size, args.requesters, fair))))
+
+
+if __name__ == '__main__':
+    main()
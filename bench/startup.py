@@ -0,0 +1,62 @@
+"""Benchmark of cold start: how long ``import bot`` takes in each YTDL_LOAD mode.
+
+Every run is a fresh interpreter that imports the bot (which registers the
+Music cog, but doesn't log in) and then loads youtube_dl, the way the first
+``music.play`` would. Prints one JSON line per mode with the median of
+``--runs`` runs: time until the bot could start logging in, the startup
+phases and the time youtube_dl took to load.
+
+    python -m bench.startup --runs 5 --modes eager,lazy --extractors youtube,generic
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+import bot
+ready = time.perf_counter() - start
+bot.YTDLSource.load()
+print(json.dumps({'ready': ready, 'phases': bot.startup.phases, 'youtube_dl': bot.LazyExtractor.load_seconds}))
+"""
+
+
+def run_once(mode: str, extractors: str, directory: str):
+    env = dict(os.environ, YTDL_LOAD=mode, YTDL_EXTRACTORS=extractors, MUSIC_METRICS_PORT='0',
+               MUSIC_DB_PATH=os.path.join(directory, 'music.sqlite3'))
+    output = subprocess.run([sys.executable, '-c', CHILD], env=env, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modes', default='eager,lazy', help='comma separated YTDL_LOAD values')
+    parser.add_argument('--extractors', default='', help='YTDL_EXTRACTORS for every run, empty for all')
+    args = parser.parse_args()
+
+    for mode in args.modes.split(','):
+        with tempfile.TemporaryDirectory() as directory:
+            runs = [run_once(mode, args.extractors, directory) for _ in range(args.runs)]
+
+        phases = {phase: round(statistics.median(run['phases'].get(phase, 0.0) for run in runs), 3)
+                  for phase in runs[0]['phases']}
+        print(json.dumps({
+            'benchmark': 'startup',
+            'mode': mode,
+            'extractors': args.extractors or 'all',
+            'runs': args.runs,
+            'ready_seconds': round(statistics.median(run['ready'] for run in runs), 3),
+            'phases': phases,
+            'youtube_dl_seconds': round(statistics.median(run['youtube_dl'] for run in runs), 3),
+        }))
+
+
+if __name__ == '__main__':
+    main()
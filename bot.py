@@ -12,21 +12,374 @@ You also need FFmpeg in your PATH environment variable or the FFmpeg.exe binary
 """
 
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import functools
+import importlib.util
 import itertools
+import json
 import math
 import random
 import os
+import re
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.error
+import urllib.parse
+import urllib.request
+from fractions import Fraction
 
 import discord
-import youtube_dl
+import sortedcontainers
 from async_timeout import timeout
 from discord.ext import commands
 
 import configparser
 
-# Silence useless bug reports messages
-youtube_dl.utils.bug_reports_message = lambda: ''
+# Local sqlite database shared by the persistent caches. Point it at a
+# mounted volume so it survives worker restarts.
+MUSIC_DB_PATH = os.getenv('MUSIC_DB_PATH', 'music.sqlite3')
+
+# 'single' resolves direct URLs with one extraction and repeated searches
+# through the query index, 'legacy' always does search + process.
+YTDL_RESOLUTION = os.getenv('YTDL_RESOLUTION', 'single')
+
+# Dedicated extraction pool: 'thread' or 'process' workers, and how many
+# extractions may wait before new requests are turned away.
+YTDL_POOL = os.getenv('YTDL_POOL', 'thread')
+YTDL_WORKERS = int(os.getenv('YTDL_WORKERS', '4'))
+YTDL_BACKLOG = int(os.getenv('YTDL_BACKLOG', '64'))
+
+# When youtube_dl and its extractors get loaded: 'eager' while starting up,
+# 'warm' in the background once the bot is logged in, 'lazy' on the first
+# extraction. YTDL_EXTRACTORS lists the youtube_dl.extractor modules to load
+# instead of all ~800 of them. Plain searches need 'generic', e.g. 'youtube,generic'.
+YTDL_LOAD = os.getenv('YTDL_LOAD', 'warm')
+YTDL_EXTRACTORS = [name.strip() for name in os.getenv('YTDL_EXTRACTORS', '').split(',') if name.strip()]
+
+# Give up on an extraction after YTDL_TIMEOUT seconds (YTDL_SOCKET_TIMEOUT for
+# a stalled connection, which also frees the worker), retry throttling and
+# network errors YTDL_RETRIES times, and stop trying for YTDL_BREAKER_RESET
+# seconds after YTDL_BREAKER_THRESHOLD failures in a row. A play request gets
+# MUSIC_PLAY_TIMEOUT seconds in total.
+YTDL_TIMEOUT = float(os.getenv('YTDL_TIMEOUT', '20'))
+YTDL_SOCKET_TIMEOUT = float(os.getenv('YTDL_SOCKET_TIMEOUT', '10'))
+YTDL_RETRIES = int(os.getenv('YTDL_RETRIES', '2'))
+YTDL_BREAKER_THRESHOLD = int(os.getenv('YTDL_BREAKER_THRESHOLD', '5'))
+YTDL_BREAKER_RESET = float(os.getenv('YTDL_BREAKER_RESET', '30'))
+MUSIC_PLAY_TIMEOUT = float(os.getenv('MUSIC_PLAY_TIMEOUT', '45'))
+
+# 'pcm' decodes in FFmpeg and scales the volume in Python, 'opus' hands Opus
+# packets straight to discord and lets FFmpeg do any volume/encoding work.
+MUSIC_PLAYBACK = os.getenv('MUSIC_PLAYBACK', 'pcm')
+
+# 'bitrate' streams the cheapest audio format that carries the voice
+# channel's bitrate (Opus ones first with MUSIC_PLAYBACK=opus, FFmpeg passes
+# those through), 'best' the one youtube_dl picks.
+MUSIC_FORMAT = os.getenv('MUSIC_FORMAT', 'bitrate')
+
+# How many queued songs to resolve and validate ahead of playback.
+MUSIC_PREFETCH = int(os.getenv('MUSIC_PREFETCH', '2'))
+
+# Start the next song's FFmpeg this many seconds before the current one ends,
+# and keep up to this many seconds of a looped song for local replays. Every
+# guild looping a song keeps one recording on disk: Opus frames take about
+# 1 MB per minute (20 MB for 1200 s), the raw PCM of the 'pcm' playback mode
+# 11.5 MB per minute, which is why it gets less (MUSIC_LOOP_BUFFER_PCM, 58 MB
+# for 300 s). Longer songs are streamed again on every loop.
+MUSIC_PREWARM = float(os.getenv('MUSIC_PREWARM', '5'))
+MUSIC_LOOP_BUFFER = float(os.getenv('MUSIC_LOOP_BUFFER', '1200'))
+MUSIC_LOOP_BUFFER_PCM = float(os.getenv('MUSIC_LOOP_BUFFER_PCM', '300'))
+
+# Whether guilds share one FFmpeg process per song with the other guilds
+# playing it (joining at the live position), unless changed with music.broadcast.
+MUSIC_BROADCAST = os.getenv('MUSIC_BROADCAST', '0') == '1'
+
+# Searches that clearly match a song played before are answered from the
+# local library (see LibraryIndex). Prefix a search with MUSIC_LIVE_PREFIX to
+# always search online.
+MUSIC_LIBRARY_CONFIDENCE = float(os.getenv('MUSIC_LIBRARY_CONFIDENCE', '0.5'))
+MUSIC_LIVE_PREFIX = os.getenv('MUSIC_LIVE_PREFIX', '!')
+
+# Local Opus copies of often played songs: where, how many bytes at most, and
+# after how many plays a song gets downloaded ('lru' or 'lfu' eviction).
+MUSIC_AUDIO_CACHE = os.getenv('MUSIC_AUDIO_CACHE', 'audio-cache')
+MUSIC_AUDIO_CACHE_SIZE = int(os.getenv('MUSIC_AUDIO_CACHE_SIZE', str(2 * 1024 ** 3)))
+MUSIC_AUDIO_CACHE_PLAYS = int(os.getenv('MUSIC_AUDIO_CACHE_PLAYS', '3'))
+MUSIC_AUDIO_CACHE_POLICY = os.getenv('MUSIC_AUDIO_CACHE_POLICY', 'lru')
+
+# Queue behaviour, both off by default: refuse songs that are already queued,
+# and interleave songs round-robin by requester instead of first come, first served.
+MUSIC_QUEUE_DEDUPE = os.getenv('MUSIC_QUEUE_DEDUPE', '0') == '1'
+MUSIC_QUEUE_FAIR = os.getenv('MUSIC_QUEUE_FAIR', '0') == '1'
+
+# Playlist links queue up to this many songs from one flat listing. They are
+# resolved when they get prefetched or played, not when they're queued.
+MUSIC_PLAYLIST_MAX = int(os.getenv('MUSIC_PLAYLIST_MAX', '500'))
+
+# Chat output per channel: on average MUSIC_SEND_RATE messages (and edits) a
+# second, in bursts of up to MUSIC_SEND_BURST, which is Discord's limit of 5
+# per 5 seconds. Replies that pile up beyond that are merged into one message.
+MUSIC_SEND_RATE = float(os.getenv('MUSIC_SEND_RATE', '1'))
+MUSIC_SEND_BURST = int(os.getenv('MUSIC_SEND_BURST', '5'))
+
+# Idle players stay connected to voice so the next music.play doesn't have
+# to connect again. How long is learned per guild from how soon it came back
+# before: long enough for most of its returns, between MUSIC_KEEP_WARM_MIN
+# and MUSIC_KEEP_WARM_MAX seconds. Guilds that rarely come back within
+# MUSIC_KEEP_WARM_MAX are disconnected after MUSIC_KEEP_WARM_MIN, guilds
+# without history after MUSIC_KEEP_WARM.
+MUSIC_KEEP_WARM = float(os.getenv('MUSIC_KEEP_WARM', '180'))
+MUSIC_KEEP_WARM_MIN = float(os.getenv('MUSIC_KEEP_WARM_MIN', '30'))
+MUSIC_KEEP_WARM_MAX = float(os.getenv('MUSIC_KEEP_WARM_MAX', '1800'))
+
+# Forget guilds whose player has been idle this many seconds, and track at
+# most this many guilds (idle ones are dropped first).
+MUSIC_IDLE_REAP = float(os.getenv('MUSIC_IDLE_REAP', '600'))
+MUSIC_MAX_STATES = int(os.getenv('MUSIC_MAX_STATES', '10000'))
+
+# Snapshot every guild's player this often (seconds) so a restart can resume
+# it, and resume at most this many guilds at the same time after a restart.
+MUSIC_SNAPSHOT_INTERVAL = float(os.getenv('MUSIC_SNAPSHOT_INTERVAL', '15'))
+MUSIC_RESUME_CONCURRENCY = int(os.getenv('MUSIC_RESUME_CONCURRENCY', '4'))
+
+# Serve the metrics as Prometheus text on http://MUSIC_METRICS_HOST:MUSIC_METRICS_PORT/metrics.
+# Port 0 turns the endpoint off.
+MUSIC_METRICS_HOST = os.getenv('MUSIC_METRICS_HOST', '127.0.0.1')
+MUSIC_METRICS_PORT = int(os.getenv('MUSIC_METRICS_PORT', '9108'))
+
+# Sharding: with MUSIC_PROCESSES > 1, bot.py runs a Supervisor that splits
+# MUSIC_SHARDS shards ('auto' asks Discord how many) across that many worker
+# processes and restarts each one on its own when it exits. Workers are told
+# their shards in MUSIC_SHARD_IDS and MUSIC_SHARD_COUNT, and serve metrics on
+# MUSIC_METRICS_PORT + their index.
+MUSIC_PROCESSES = int(os.getenv('MUSIC_PROCESSES', '1'))
+MUSIC_SHARDS = os.getenv('MUSIC_SHARDS', 'auto')
+MUSIC_SHARD_IDS = [int(shard_id) for shard_id in os.getenv('MUSIC_SHARD_IDS', '').split(',') if shard_id]
+MUSIC_SHARD_COUNT = int(os.getenv('MUSIC_SHARD_COUNT', '0'))
+
+# Trigger rules for on_message, see the comments in the file.
+RULES_PATH = os.getenv('RULES_PATH', 'rules.ini')
+
+
+class Supervisor:
+    """Runs the bot as ``processes`` worker processes that split ``shard_count``
+    shards between them, each with its own players and caches in memory.
+
+    Workers are started one after another, as Discord only lets a bot identify
+    a shard every few seconds. A worker that exits is restarted on its own, the
+    others keep playing. Workers that keep exiting are restarted with
+    exponential backoff.
+    """
+
+    IDENTIFY_INTERVAL = 5.5
+    # A worker that ran this long was healthy, its backoff starts over.
+    HEALTHY_AFTER = 60
+    MAX_BACKOFF = 60
+
+    def __init__(self, *, processes: int, shard_count: int, metrics_port: int = 0):
+        self.processes = max(1, min(processes, shard_count))
+        self.shard_count = shard_count
+        self.metrics_port = metrics_port
+
+        size, extra = divmod(shard_count, self.processes)
+        self.shards = []
+        for index in range(self.processes):
+            start = index * size + min(index, extra)
+            self.shards.append(list(range(start, start + size + (index < extra))))
+
+        self.workers = [None] * self.processes
+        self.restarts = [0] * self.processes
+        self._started_at = [0.0] * self.processes
+        self._backoff = [0.0] * self.processes
+        self._restart_at = [None] * self.processes
+
+    @staticmethod
+    def recommended_shards(token: str):
+        """Asks Discord how many shards the bot should run."""
+
+        request = urllib.request.Request('https://discord.com/api/v8/gateway/bot',
+                                         headers={'Authorization': 'Bot ' + token, 'User-Agent': 'DiscordBot'})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read().decode())['shards']
+
+    def spawn(self, index: int):
+        env = dict(os.environ, MUSIC_PROCESSES='1', MUSIC_SHARD_COUNT=str(self.shard_count),
+                   MUSIC_SHARD_IDS=','.join(str(shard_id) for shard_id in self.shards[index]),
+                   MUSIC_METRICS_PORT=str(self.metrics_port + index) if self.metrics_port else '0')
+        self.workers[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self._started_at[index] = time.monotonic()
+        self._restart_at[index] = None
+        print('Worker {} started with shards {}-{} of {} (pid {})'.format(
+            index, self.shards[index][0], self.shards[index][-1], self.shard_count, self.workers[index].pid))
+
+    def check(self, index: int):
+        """Schedules a restart of the worker if it exited, and restarts it once it's due."""
+
+        now = time.monotonic()
+        if self._restart_at[index] is not None:
+            if now >= self._restart_at[index]:
+                self.restarts[index] += 1
+                self.spawn(index)
+            return
+
+        code = self.workers[index].poll()
+        if code is None:
+            return
+
+        if now - self._started_at[index] >= self.HEALTHY_AFTER:
+            self._backoff[index] = 0.0
+        else:
+            self._backoff[index] = min(self.MAX_BACKOFF, max(1.0, self._backoff[index] * 2))
+        self._restart_at[index] = now + self._backoff[index]
+        print('Worker {} exited with code {}, restarting it in {:.0f}s'.format(index, code, self._backoff[index]))
+
+    def run(self):
+        def terminate(signum, frame):
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            for index in range(self.processes):
+                self.spawn(index)
+                if index < self.processes - 1:
+                    # Let its shards identify before the next worker's try to.
+                    time.sleep(len(self.shards[index]) * self.IDENTIFY_INTERVAL)
+
+            while True:
+                for index in range(self.processes):
+                    self.check(index)
+                time.sleep(1)
+        finally:
+            self.stop()
+
+    def stop(self, timeout: float = 10):
+        workers = [worker for worker in self.workers if worker is not None and worker.poll() is None]
+        for worker in workers:
+            worker.terminate()
+
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            try:
+                worker.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                worker.kill()
+
+
+if __name__ == '__main__' and MUSIC_PROCESSES > 1 and not MUSIC_SHARD_IDS:
+    # Decided before anything below runs: the supervisor only starts and watches
+    # the workers, it has no bot, players or caches of its own.
+    bot_token = os.getenv("token")
+    shard_count = Supervisor.recommended_shards(bot_token) if MUSIC_SHARDS == 'auto' else int(MUSIC_SHARDS)
+    Supervisor(processes=MUSIC_PROCESSES, shard_count=shard_count, metrics_port=MUSIC_METRICS_PORT).run()
+
+
+class MessageRule:
+    __slots__ = ('name', 'nick', 'mentions', 'contains', 'responses', 'target', 'consume')
+
+    def __init__(self, name: str, section: configparser.SectionProxy, responses: list):
+        self.name = name
+        self.nick = section.get('nick')
+        self.mentions = tuple(form.format(user_id) for user_id in self.split(section.get('mentions'))
+                              for form in ('<@{}>', '<@!{}>'))
+        self.contains = tuple(self.split(section.get('contains')))
+        self.responses = responses
+        self.target = section.get('target')
+        self.consume = section.getboolean('consume', False)
+
+    @staticmethod
+    def split(value: str):
+        return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+    def matches(self, message: discord.Message):
+        if self.nick is not None and getattr(message.author, 'nick', None) != self.nick:
+            return False
+
+        content = message.content
+        if self.mentions and not any(mention in content for mention in self.mentions):
+            return False
+
+        if self.contains and not any(text in content for text in self.contains):
+            return False
+
+        return True
+
+    def respond(self, message: discord.Message):
+        return random.choice(self.responses).format(self.target or message.author.mention)
+
+
+class MessageRules:
+    """The on_message trigger rules, loaded once from an ini file.
+
+    Rules are indexed by author id, so a message from anyone without rules
+    costs a single dict lookup. Rules configured by Name#discriminator tag are
+    resolved to the author's id the first time the author is seen.
+    """
+
+    # Stop remembering authors without rules past this many.
+    MAX_AUTHORS = 100000
+
+    def __init__(self, path: str):
+        self.path = path
+        self._by_id = {}
+        self._by_tag = {}
+
+        if os.path.exists(path):
+            self.reload()
+
+    def __len__(self):
+        return len({rule.name for rules in itertools.chain(self._by_id.values(), self._by_tag.values())
+                    for rule in rules})
+
+    def reload(self):
+        parser = configparser.ConfigParser(interpolation=None)
+        with open(self.path, encoding='utf-8') as f:
+            parser.read_file(f)
+
+        pools = {}
+        for name in parser.sections():
+            if name.startswith('responses:'):
+                lines = parser[name]['lines'].splitlines()
+                pools[name[len('responses:'):]] = [line.strip() for line in lines if line.strip()]
+
+        by_id = {}
+        by_tag = {}
+        for name in parser.sections():
+            if not name.startswith('rule:'):
+                continue
+
+            section = parser[name]
+            rule = MessageRule(name[len('rule:'):], section, pools[section['responses']])
+            for author_id in MessageRule.split(section.get('author_ids')):
+                by_id.setdefault(int(author_id), []).append(rule)
+            for tag in MessageRule.split(section.get('authors')):
+                by_tag.setdefault(tag, []).append(rule)
+
+        self._by_id, self._by_tag = by_id, by_tag
+
+    def match(self, message: discord.Message):
+        author = message.author
+        rules = self._by_id.get(author.id)
+        if rules is None:
+            if not self._by_tag:
+                return ()
+
+            rules = self._by_tag.get('{0.name}#{0.discriminator}'.format(author), ())
+            if rules or len(self._by_id) < self.MAX_AUTHORS:
+                self._by_id[author.id] = rules
+
+        return [rule for rule in rules if rule.matches(message)] if rules else ()
 
 
 class VoiceError(Exception):
@@ -37,176 +390,2602 @@ class YTDLError(Exception):
     pass
 
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    YTDL_OPTIONS = {
-        'format': 'bestaudio/best',
-        'extractaudio': True,
-        'audioformat': 'mp3',
-        'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
-        'restrictfilenames': True,
-        'noplaylist': True,
-        'nocheckcertificate': True,
-        'ignoreerrors': False,
-        'logtostderr': False,
-        'quiet': True,
-        'no_warnings': True,
-        'default_search': 'auto',
-        'source_address': '0.0.0.0',
-    }
+class ExtractorBusy(YTDLError):
+    """The extractor can't take the request right now. The message is meant for the user as is."""
 
-    FFMPEG_OPTIONS = {
-        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-        'options': '-vn'
+
+class ExtractorTimeout(ExtractorBusy):
+    pass
+
+
+class ExtractorUnavailable(ExtractorBusy):
+    pass
+
+
+class LatencyRecorder:
+    """Keeps the most recent latency samples per label."""
+
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.size))
+
+    def __call__(self, label: str, elapsed: float):
+        self.samples[label].append(elapsed)
+        if label != 'all':
+            self.samples['all'].append(elapsed)
+
+    def percentile(self, percent: float, label: str = 'all'):
+        samples = sorted(self.samples.get(label, ()))
+        if not samples:
+            return None
+
+        index = min(len(samples) - 1, int(round(percent / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def median(self, label: str = 'all'):
+        return self.percentile(50, label)
+
+    def summary(self):
+        return {label: {'count': len(samples), 'p50': self.percentile(50, label), 'p90': self.percentile(90, label),
+                        'p99': self.percentile(99, label)}
+                for label, samples in self.samples.items()}
+
+
+class Histogram:
+    """Bucket counts and a sum, the way Prometheus histograms are exposed."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # The last one is for values above every bucket.
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """Histograms, counters and gauges for the hot paths, rendered as Prometheus text.
+
+    Histograms and counters are updated as things happen. Gauges, and counters
+    that are kept elsewhere (like the cache hit counts), are read from the
+    functions passed to :meth:`register` when the metrics are rendered.
+    """
+
+    HELP = {
+        'music_stage_seconds': 'Time spent in each stage of resolving and starting songs.',
+        'music_enqueue_seconds': 'Time to resolve a play request, by how it was resolved.',
+        'music_gap_seconds': 'Silence between songs, by where the next source came from.',
+        'music_extraction_failures_total': 'Extractions that failed, by reason.',
+        'music_extraction_retries_total': 'Extractions retried after a transient error.',
+        'music_voice_errors_total': 'Songs ended by an error in the voice player, and failed summons.',
+        'music_message_wait_seconds': 'Time chat messages waited for their channel\'s rate limit.',
+        'music_first_audio_seconds': 'Time from music.play to audio on an idle player, by join (warm or cold).',
     }
 
-    ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
+    def __init__(self):
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.collectors = collections.OrderedDict()
+        # Recent samples per stage, for music.stats.
+        self.stages = LatencyRecorder()
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, **labels):
+        with self._lock:
+            self.histograms[name, tuple(sorted(labels.items()))].observe(seconds)
+
+    def stage(self, stage: str, seconds: float):
+        self.observe('music_stage_seconds', seconds, stage=stage)
+        self.stages(stage, seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage(stage, time.perf_counter() - start)
+
+    def timed_future(self, stage: str, future: asyncio.Future):
+        """Records how long ``future`` takes from now until it's done, for things that
+        finish in the background (like a message on the dispatcher's queue).
+        """
+
+        start = time.perf_counter()
+        future.add_done_callback(lambda _: self.stage(stage, time.perf_counter() - start))
+        return future
+
+    def inc(self, name: str, amount: int = 1, **labels):
+        with self._lock:
+            self.counters[name, tuple(sorted(labels.items()))] += amount
+
+    def register(self, name: str, kind: str, help: str, func, *, label: str = None):
+        """Adds a gauge or counter read from ``func()``. With ``label``, ``func``
+        returns a dict of label value -> value instead of a single value.
+        """
+
+        self.collectors[name] = (kind, help, func, label)
+
+    def collect(self):
+        """Returns {name: (kind, help, [(labels, value)])} for everything registered."""
+
+        collected = {}
+        for name, (kind, help, func, label) in self.collectors.items():
+            value = func()
+            if label is None:
+                samples = [((), value)]
+            else:
+                samples = [(((label, key),), item) for key, item in value.items()]
+            collected[name] = (kind, help, [(labels, value) for labels, value in samples if value is not None])
+
+        return collected
+
+    def render(self):
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            histograms = [(key, list(histogram.counts), histogram.sum) for key, histogram in histograms]
+
+        lines = []
+        for name, series in itertools.groupby(histograms, key=lambda item: item[0][0]):
+            lines.extend(self._header(name, 'histogram', self.HELP.get(name, name)))
+            for (_, labels), counts, total in series:
+                bounds = ['{:g}'.format(bound) for bound in Histogram.BUCKETS] + ['+Inf']
+                for bound, count in zip(bounds, itertools.accumulate(counts)):
+                    lines.append(self._sample(name + '_bucket', labels + (('le', bound),), count))
+                lines.append(self._sample(name + '_sum', labels, total))
+                lines.append(self._sample(name + '_count', labels, sum(counts)))
+
+        for name, series in itertools.groupby(counters, key=lambda item: item[0][0]):
+            lines.extend(self._header(name, 'counter', self.HELP.get(name, name)))
+            lines.extend(self._sample(name, labels, value) for (_, labels), value in series)
+
+        for name, (kind, help, samples) in self.collect().items():
+            lines.extend(self._header(name, kind, help))
+            lines.extend(self._sample(name, labels, value) for labels, value in samples)
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _header(name: str, kind: str, help: str):
+        return ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, kind)]
+
+    @staticmethod
+    def _sample(name: str, labels: tuple, value):
+        if labels:
+            name += '{' + ','.join('{}="{}"'.format(key, Metrics._escape(label)) for key, label in labels) + '}'
+        return '{} {}'.format(name, value)
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    async def serve(self, host: str, port: int):
+        """Serves :meth:`render` on /metrics until cancelled."""
+
+        try:
+            server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            print('Couldn\'t serve metrics on {}:{}: {}'.format(host, port, e))
+            return
+
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            if request.split(b' ', 2)[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+
+            writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(status, len(body)).encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, IndexError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics = Metrics()
+
+
+class ExtractionEngine:
+    """Runs blocking extractions on a dedicated worker pool.
+
+    Every guild gets its own queue and the queues are served round-robin, so a
+    guild enqueueing many links can't starve the others. Once ``backlog`` jobs
+    are waiting, new ones are rejected with ExtractorBusy.
+    """
+
+    def __init__(self, *, pool: str = 'thread', workers: int = 4, backlog: int = 64):
+        self.pool = pool
+        self.workers = workers
+        self.backlog = backlog
+
+        self.completed = 0
+        self.rejected = 0
+        self.wait_times = LatencyRecorder()
+
+        self._executor = None
+        self._queues = collections.OrderedDict()
+        self._pending = 0
+        self._active = 0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.pool == 'process':
+                self._executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='ytdl')
+
+        return self._executor
+
+    async def run(self, guild, func, *args, loop: asyncio.BaseEventLoop = None):
+        if self._pending >= self.backlog:
+            self.rejected += 1
+            metrics.inc('music_extraction_failures_total', reason='busy')
+            raise ExtractorBusy('I\'m busy processing other requests right now, please try again in a moment.')
+
+        loop = loop or asyncio.get_event_loop()
+        future = loop.create_future()
+        self._queues.setdefault(guild, collections.deque()).append((future, func, args, time.perf_counter()))
+        self._pending += 1
+        self._dispatch(loop)
+
+        return await future
+
+    def stats(self):
+        return {
+            'pool': self.pool,
+            'workers': self.workers,
+            'active': self._active,
+            'pending': self._pending,
+            'backlog': self.backlog,
+            'guilds': {guild: len(jobs) for guild, jobs in self._queues.items()},
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'wait_p50': self.wait_times.percentile(50),
+            'wait_p90': self.wait_times.percentile(90),
+        }
+
+    def _dispatch(self, loop: asyncio.BaseEventLoop):
+        while self._active < self.workers and self._queues:
+            guild, jobs = next(iter(self._queues.items()))
+            future, func, args, enqueued_at = jobs.popleft()
+            if jobs:
+                self._queues.move_to_end(guild)
+            else:
+                del self._queues[guild]
+            self._pending -= 1
+
+            # The requester went away while the job was waiting.
+            if future.cancelled():
+                continue
+
+            waited = time.perf_counter() - enqueued_at
+            self.wait_times('all', waited)
+            metrics.stage('extractor_wait', waited)
+            self._active += 1
+            task = loop.run_in_executor(self.executor, func, *args)
+            task.add_done_callback(functools.partial(self._finished, loop, future))
+
+    def _finished(self, loop: asyncio.BaseEventLoop, future: asyncio.Future, task: asyncio.Future):
+        self._active -= 1
+        self.completed += 1
+
+        if not future.done():
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                metrics.inc('music_extraction_failures_total', reason='error')
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        self._dispatch(loop)
+
+
+class CircuitBreaker:
+    """Fails fast while a dependency keeps failing.
+
+    After ``threshold`` failures in a row the circuit opens and :meth:`check`
+    raises ExtractorUnavailable for ``reset_after`` seconds. Then a single
+    trial call is let through: the circuit closes if it succeeds and opens
+    again if it fails.
+    """
+
+    def __init__(self, *, threshold: int = 5, reset_after: float = 30):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+
+        return 'half-open' if self.retry_after <= 0 else 'open'
+
+    @property
+    def retry_after(self):
+        return self._opened_at + self.reset_after - time.monotonic() if self._opened_at is not None else 0
+
+    def check(self):
+        state = self.state
+        if state == 'open' or (state == 'half-open' and self._trial):
+            raise ExtractorUnavailable('I can\'t reach the music source right now, please try again in {:.0f} '
+                                       'seconds.'.format(max(1, self.retry_after)))
+
+        self._trial = state == 'half-open'
+
+    def succeeded(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def failed(self):
+        self.failures += 1
+        self._trial = False
+        if self._opened_at is not None or self.failures >= self.threshold:
+            if self.state != 'open':
+                self.trips += 1
+            self._opened_at = time.monotonic()
+
+    def released(self):
+        """The call ended without telling anything about the dependency's health."""
+
+        self._trial = False
+
+
+class SingleFlight:
+    """Shares one run of a coroutine among the concurrent callers asking for the same key.
+
+    Keys are tuples whose first item is the kind of work, for the counts. A
+    caller that gets cancelled stops waiting but doesn't cancel the shared run.
+    """
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.shared = collections.Counter()
+        self._flights = {}
+
+    async def run(self, key: tuple, func):
+        """Returns the result of ``func()`` and whether it was shared with an earlier caller."""
+
+        self.calls[key[0]] += 1
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if shared:
+            self.shared[key[0]] += 1
+        else:
+            flight = self._flights[key] = asyncio.ensure_future(func())
+            flight.add_done_callback(functools.partial(self._landed, key))
+
+        return await asyncio.shield(flight), shared
+
+    def _landed(self, key: tuple, flight: asyncio.Future):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+        # Nobody may be waiting any more, don't let the error go unretrieved.
+        if not flight.cancelled():
+            flight.exception()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def stats(self):
+        calls, shared = sum(self.calls.values()), sum(self.shared.values())
+        return {
+            'in_flight': len(self._flights),
+            'requests': calls,
+            'coalesced': shared,
+            'dedup_rate': shared / calls if calls else 0.0,
+        }
+
+
+class CacheEntry:
+    __slots__ = ('info', 'expires_at', 'stream_expires_at')
+
+    def __init__(self, info: dict, expires_at: float, stream_expires_at: float):
+        self.info = info
+        self.expires_at = expires_at
+        self.stream_expires_at = stream_expires_at
+
+    @property
+    def webpage_url(self):
+        return self.info['webpage_url']
+
+    @property
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    @property
+    def stream_expired(self):
+        return time.time() >= self.stream_expires_at
+
+
+class ExtractionCache:
+    """Caches youtube_dl extraction results in memory (LRU) and on disk (sqlite).
+
+    Entries are stored by ``webpage_url`` and can be looked up by any key they
+    were stored under (normalized search strings, the URL itself). Metadata and
+    the short-lived stream ``url`` expire separately.
+    """
+
+    # The parts of an info dict we actually use. Everything else (formats,
+    # thumbnails, subtitles...) is dropped before caching.
+    FIELDS = ('id', 'extractor', 'title', 'uploader', 'uploader_url', 'upload_date', 'thumbnail',
+              'description', 'duration', 'tags', 'webpage_url', 'view_count', 'like_count',
+              'dislike_count', 'url', 'acodec', 'abr', 'audio_formats')
+
+    # Refresh stream URLs a bit before the origin says they expire.
+    STREAM_EXPIRY_MARGIN = 5 * 60
+
+    def __init__(self, path: str = None, *, capacity: int = 512,
+                 metadata_ttl: float = 7 * 24 * 3600, stream_ttl: float = 3 * 3600):
+        self.capacity = capacity
+        self.metadata_ttl = metadata_ttl
+        self.stream_ttl = stream_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.stream_refreshes = 0
+
+        self._entries = collections.OrderedDict()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            # Sharded workers share the file, let them read while one of them writes.
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS extraction_cache (
+                    webpage_url TEXT PRIMARY KEY,
+                    info TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    stream_expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS extraction_keys (
+                    key TEXT PRIMARY KEY,
+                    webpage_url TEXT NOT NULL
+                );
+            """)
+            self._db.execute('DELETE FROM extraction_cache WHERE expires_at < ?', (time.time(),))
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(search: str):
+        search = search.strip()
+        if search.startswith(('http://', 'https://')):
+            return search
+
+        return ' '.join(search.casefold().split())
+
+    def get(self, key: str, *, count: bool = True):
+        """Returns the entry stored under ``key`` or None if it's missing or its metadata expired.
+        The stream URL of the returned entry may still be expired. Lookups made on behalf of
+        one that was counted already pass ``count=False``.
+        """
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        elif self._db is not None:
+            entry = self._load(key)
+            if entry is not None:
+                self._remember(key, entry)
+
+        if entry is None or entry.expired:
+            self.misses += count
+            return None
+
+        self.hits += count
+        return entry
+
+    @staticmethod
+    def audio_formats(info: dict):
+        """The audio only formats of ``info`` as [format_id, acodec, abr, url] lists, cheapest first.
+        Infos that were stripped down already keep theirs.
+        """
+
+        if 'formats' not in info:
+            return info.get('audio_formats') or []
+
+        formats = [[f.get('format_id'), f.get('acodec'), f.get('abr') or f.get('tbr'), f['url']]
+                   for f in info['formats']
+                   if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none') and f.get('url')
+                   # FFmpeg can't play a DASH fragment list from a URL.
+                   and f.get('protocol') != 'http_dash_segments']
+        return sorted(formats, key=lambda f: f[2] or 0)
+
+    def put(self, info: dict, *keys: str):
+        info = dict(info, audio_formats=self.audio_formats(info))
+        info = {field: info.get(field) for field in self.FIELDS}
+        now = time.time()
+        entry = CacheEntry(info, now + self.metadata_ttl, self._stream_expiry(info['url'], now))
+
+        keys = set(keys)
+        keys.add(entry.webpage_url)
+        for key in keys:
+            self._remember(key, entry)
+
+        if self._db is not None:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO extraction_cache VALUES (?, ?, ?, ?)',
+                                 (entry.webpage_url, json.dumps(info), entry.expires_at, entry.stream_expires_at))
+                self._db.executemany('INSERT OR REPLACE INTO extraction_keys VALUES (?, ?)',
+                                     [(key, entry.webpage_url) for key in keys])
+
+        return entry
+
+    def alias(self, key: str, entry: CacheEntry):
+        """Makes ``entry`` reachable under ``key`` too."""
+
+        self._remember(key, entry)
+        if self._db is not None:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO extraction_keys VALUES (?, ?)', (key, entry.webpage_url))
+
+    def infos(self):
+        """Yields the info of every entry on disk."""
+
+        if self._db is not None:
+            for row in self._db.execute('SELECT info FROM extraction_cache').fetchall():
+                yield json.loads(row[0])
+
+    def lookup_url(self, key: str):
+        """Returns the webpage_url indexed under ``key``, even if its metadata expired."""
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry.webpage_url
+
+        if self._db is not None:
+            row = self._db.execute('SELECT webpage_url FROM extraction_keys WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                return row[0]
+
+        return None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'stream_refreshes': self.stream_refreshes,
+        }
+
+    def _remember(self, key: str, entry: CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def _load(self, key: str):
+        row = self._db.execute('SELECT e.info, e.expires_at, e.stream_expires_at '
+                               'FROM extraction_keys k JOIN extraction_cache e ON e.webpage_url = k.webpage_url '
+                               'WHERE k.key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        return CacheEntry(json.loads(row[0]), row[1], row[2])
+
+    def _stream_expiry(self, url: str, now: float):
+        expires_at = now + self.stream_ttl
+
+        # Signed stream URLs (e.g. googlevideo) carry their own expiry timestamp.
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url or '').query)
+        try:
+            expire = float(query['expire'][0]) - self.STREAM_EXPIRY_MARGIN
+        except (KeyError, IndexError, ValueError):
+            return expires_at
+
+        return min(expires_at, expire)
+
+
+class LibraryIndex:
+    """Full-text index (sqlite FTS5) of the title, uploader and tags of every track resolved so far.
+
+    :meth:`match` answers a search locally when one track matches it clearly:
+    every word of the search is in its title or uploader, enough of its title
+    is covered by the search (``confidence``), and no other hit is covered as
+    well. Anything else goes to the extractor's search.
+    """
+
+    TOKEN = re.compile(r'[^\W_]+')
+
+    def __init__(self, path: str, *, confidence: float = 0.5):
+        self.confidence = confidence
+        self.hits = 0
+        self.misses = 0
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS library_tracks (
+                    id INTEGER PRIMARY KEY,
+                    webpage_url TEXT NOT NULL UNIQUE,
+                    title TEXT NOT NULL,
+                    uploader TEXT NOT NULL,
+                    tags TEXT NOT NULL,
+                    duration INTEGER,
+                    plays INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS library_fts USING fts5(
+                    title, uploader, tags, content='library_tracks', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 1'
+                );
+                CREATE TRIGGER IF NOT EXISTS library_tracks_insert AFTER INSERT ON library_tracks BEGIN
+                    INSERT INTO library_fts (rowid, title, uploader, tags)
+                    VALUES (new.id, new.title, new.uploader, new.tags);
+                END;
+                CREATE TRIGGER IF NOT EXISTS library_tracks_delete AFTER DELETE ON library_tracks BEGIN
+                    INSERT INTO library_fts (library_fts, rowid, title, uploader, tags)
+                    VALUES ('delete', old.id, old.title, old.uploader, old.tags);
+                END;
+            """)
+            self.enabled = True
+        except sqlite3.OperationalError:
+            # sqlite was built without FTS5.
+            self.enabled = False
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM library_tracks').fetchone()[0] if self.enabled else 0
+
+    @classmethod
+    def tokens(cls, text: str):
+        return cls.TOKEN.findall(text.casefold())
+
+    def add(self, *infos: dict):
+        if not self.enabled:
+            return
+
+        with self._db:
+            self._db.executemany('INSERT OR IGNORE INTO library_tracks (webpage_url, title, uploader, tags, duration) '
+                                 'VALUES (?, ?, ?, ?, ?)',
+                                 [(info['webpage_url'], info.get('title') or '', info.get('uploader') or '',
+                                   ' '.join(info.get('tags') or ()), info.get('duration'))
+                                  for info in infos if info.get('webpage_url')])
+
+    def played(self, webpage_url: str):
+        if self.enabled:
+            with self._db:
+                self._db.execute('UPDATE library_tracks SET plays = plays + 1 WHERE webpage_url = ?', (webpage_url,))
+
+    def search(self, query: str, *, limit: int = 10):
+        """Returns the best (webpage_url, title, uploader, duration, plays) matches for ``query``."""
+
+        tokens = self.tokens(query)
+        if not self.enabled or not tokens:
+            return []
+
+        # Every word has to match, titles count the most.
+        return self._db.execute(
+            'SELECT t.webpage_url, t.title, t.uploader, t.duration, t.plays '
+            'FROM library_fts JOIN library_tracks t ON t.id = library_fts.rowid '
+            'WHERE library_fts MATCH ? ORDER BY bm25(library_fts, 10.0, 3.0, 1.0), t.plays DESC LIMIT ?',
+            (' '.join('"{}"'.format(token) for token in tokens), limit)).fetchall()
+
+    def match(self, query: str):
+        """Returns the webpage_url of the track ``query`` clearly refers to, or None."""
+
+        words = set(self.tokens(query))
+        scored = sorted(((self._coverage(words, row), row[4], row[0]) for row in self.search(query, limit=5)),
+                        reverse=True)
+
+        if scored and scored[0][0] >= self.confidence and (len(scored) == 1 or scored[0][0] > scored[1][0]):
+            self.hits += 1
+            return scored[0][2]
+
+        self.misses += 1
+        return None
+
+    def _coverage(self, words: set, row: tuple):
+        title = set(self.tokens(row[1]))
+        if not title or not words <= title | set(self.tokens(row[2])):
+            return 0.0
+
+        return len(title & words) / len(title)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'tracks': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class AudioCache:
+    """Size-bounded directory of Opus files for songs that get played a lot.
+
+    Songs are keyed by extractor and id. Every play is counted, and once a song
+    reaches ``threshold`` plays it's downloaded in the background. When the
+    files grow past ``max_size`` bytes, the least recently (lru) or least
+    frequently (lfu) played ones are evicted.
+    """
+
+    # Songs longer than this (and live streams) are never cached.
+    MAX_DURATION = 20 * 60
+
+    def __init__(self, directory: str, db_path: str, *, max_size: int, threshold: int = 3, policy: str = 'lru'):
+        self.directory = directory
+        self.max_size = max_size
+        self.threshold = threshold
+        self.policy = policy
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        self._downloading = set()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS audio_cache (
+                key TEXT PRIMARY KEY,
+                plays INTEGER NOT NULL DEFAULT 0,
+                last_played REAL NOT NULL,
+                path TEXT,
+                size INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+
+        # Forget files that disappeared and songs that were played once a long time ago.
+        with self._db:
+            for key, path in self._db.execute('SELECT key, path FROM audio_cache WHERE path IS NOT NULL').fetchall():
+                if not os.path.exists(path):
+                    self._db.execute('UPDATE audio_cache SET path = NULL, size = 0 WHERE key = ?', (key,))
+            self._db.execute('DELETE FROM audio_cache WHERE path IS NULL AND last_played < ?',
+                             (time.time() - 30 * 24 * 3600,))
+
+    @property
+    def size(self):
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM audio_cache').fetchone()[0]
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and shutil.which('ffmpeg') is not None
+
+    def path(self, track: 'Track'):
+        """Returns the local file for ``track`` or None if it isn't cached."""
+
+        row = self._db.execute('SELECT path FROM audio_cache WHERE key = ?', (track.cache_key,)).fetchone()
+        if row is None or row[0] is None or not os.path.exists(row[0]):
+            return None
+
+        return row[0]
+
+    def played(self, track: 'Track'):
+        """Counts a play of ``track``. Returns True if it should be downloaded now."""
+
+        key = track.cache_key
+        with self._db:
+            self._db.execute('INSERT OR IGNORE INTO audio_cache (key, last_played) VALUES (?, ?)', (key, time.time()))
+            self._db.execute('UPDATE audio_cache SET plays = plays + 1, last_played = ? WHERE key = ?',
+                             (time.time(), key))
+        plays, path, size = self._db.execute('SELECT plays, path, size FROM audio_cache WHERE key = ?',
+                                             (key,)).fetchone()
+
+        if path is not None:
+            self.hits += 1
+            self.bytes_saved += size
+            return False
+
+        self.misses += 1
+        return (self.enabled and plays >= self.threshold and key not in self._downloading
+                and track.duration and track.duration <= self.MAX_DURATION)
+
+    async def download(self, track: 'Track'):
+        """Stores ``track`` as an Opus file. Its stream URL must be valid."""
+
+        key = track.cache_key
+        self._downloading.add(key)
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key + '.opus')
+        # Workers of a sharded bot may download the same song at the same time.
+        partial = '{}.{}.part'.format(path, os.getpid())
+
+        codec = ['-c:a', 'copy'] if track.acodec == 'opus' else ['-c:a', 'libopus', '-b:a', '128k']
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+                *YTDLSource.FFMPEG_OPTIONS['before_options'].split(), '-i', track.stream_url,
+                '-vn', '-map_metadata', '-1', *codec, '-f', 'opus', partial,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            if await process.wait() != 0:
+                return
+
+            os.replace(partial, path)
+            with self._db:
+                self._db.execute('UPDATE audio_cache SET path = ?, size = ? WHERE key = ?',
+                                 (path, os.path.getsize(path), key))
+            self.evict()
+        finally:
+            self._downloading.discard(key)
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def evict(self):
+        order = 'plays ASC, last_played ASC' if self.policy == 'lfu' else 'last_played ASC'
+        total = self.size
+        rows = self._db.execute('SELECT key, path, size FROM audio_cache WHERE path IS NOT NULL '
+                                'ORDER BY ' + order).fetchall()
+        for key, path, size in rows:
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            with self._db:
+                self._db.execute('UPDATE audio_cache SET path = NULL, size = 0 WHERE key = ?', (key,))
+            total -= size
+
+    def stats(self):
+        plays = self.hits + self.misses
+        files, size = self._db.execute('SELECT COUNT(path), COALESCE(SUM(size), 0) FROM audio_cache').fetchone()
+        return {
+            'files': files,
+            'size': size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / plays if plays else 0.0,
+            'bytes_saved': self.bytes_saved,
+            'downloading': len(self._downloading),
+        }
+
+
+class Track:
+    """Compact metadata for a resolved song. Queued songs only hold one of these."""
+
+    __slots__ = ('id', 'extractor', 'title', 'uploader', 'uploader_url', 'thumbnail', 'duration',
+                 'webpage_url', 'stream_url', 'stream_expires_at', 'acodec', 'abr', 'formats')
+
+    OPUS_DISCOUNT = 0.8
+
+    def __init__(self, entry: CacheEntry):
+        info = entry.info
+        self.id = info.get('id')
+        self.extractor = info.get('extractor')
+        self.title = info.get('title')
+        self.uploader = info.get('uploader')
+        self.uploader_url = info.get('uploader_url')
+        self.thumbnail = info.get('thumbnail')
+        self.duration = info.get('duration')
+        self.webpage_url = info.get('webpage_url')
+        self.stream_url = info.get('url')
+        self.stream_expires_at = entry.stream_expires_at
+        self.acodec = info.get('acodec')
+        self.abr = info.get('abr')
+        self.formats = info.get('audio_formats') or []
+
+    def __str__(self):
+        if self.uploader is None:
+            return '**{0.title}**'.format(self)
+
+        return '**{0.title}** by **{0.uploader}**'.format(self)
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def placeholder(cls, webpage_url: str, title: str, duration: int = None):
+        """A playlist entry nothing has been extracted for yet. Its stream counts as
+        expired, so it gets resolved the way expired streams are renewed.
+        """
+
+        return cls.from_dict({'webpage_url': webpage_url, 'title': title or webpage_url, 'duration': duration})
+
+    @property
+    def resolved(self):
+        return self.id is not None
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        track = cls.__new__(cls)
+        for slot in cls.__slots__:
+            setattr(track, slot, data.get(slot))
+        track.stream_expires_at = track.stream_expires_at or 0
+
+        return track
+
+    @property
+    def cache_key(self):
+        # Same fields as the outtmpl in YTDLSource.YTDL_OPTIONS.
+        return '{0.extractor}-{0.id}'.format(self)
+
+    @property
+    def stream_expired(self):
+        return self.expires_within(0)
+
+    def expires_within(self, seconds: float):
+        return time.time() + seconds >= self.stream_expires_at
+
+    def refresh(self, entry: CacheEntry):
+        if not self.resolved:
+            resolved = Track(entry)
+            for slot in self.__slots__:
+                setattr(self, slot, getattr(resolved, slot))
+            return
+
+        self.stream_url = entry.info.get('url')
+        self.stream_expires_at = entry.stream_expires_at
+        self.acodec = entry.info.get('acodec')
+        self.abr = entry.info.get('abr')
+        self.formats = entry.info.get('audio_formats') or []
+
+    def stream_for(self, bitrate: int = None, *, prefer_opus: bool = False):
+        """Returns the URL, codec and average bitrate (kbps) of the cheapest audio format
+        carrying ``bitrate`` (bits per second, like VoiceChannel.bitrate), or of the best
+        one if none does. Opus formats are cheaper to decode, they count as OPUS_DISCOUNT
+        of their bitrate. With ``prefer_opus``, they go before any other format. Without
+        a bitrate or known bitrates, youtube_dl's pick.
+        """
+
+        formats = [f for f in self.formats or () if f[2]]
+        if not bitrate or not formats:
+            return self.stream_url, self.acodec, self.abr
+
+        candidates = [f for f in formats if f[2] >= bitrate / 1000] or [max(formats, key=lambda f: f[2])]
+        if prefer_opus:
+            candidates = [f for f in candidates if f[1] == 'opus'] or candidates
+
+        _, acodec, abr, url = min(candidates, key=lambda f: (f[2] * self.OPUS_DISCOUNT if f[1] == 'opus' else f[2],
+                                                             f[1] != 'opus'))
+        return url, acodec, abr
+
+
+def process_age():
+    """Returns how many seconds ago this process started (Linux), or None if unknown."""
+
+    try:
+        with open('/proc/self/stat') as f:
+            started = int(f.read().rsplit(')', 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return uptime - started
+
+
+def process_cpu_time(process):
+    """Returns the CPU seconds used so far by a child process, or None if unavailable (non Linux)."""
+
+    try:
+        with open('/proc/{}/stat'.format(process.pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (AttributeError, OSError, IndexError, ValueError):
+        return None
+
+
+class StartupProfile:
+    """How long each phase of starting up took.
+
+    Every :meth:`mark` ends a phase that began at the previous mark. The first
+    phase, 'import', runs from the start of the process to the creation of the
+    profile (only known on Linux, see process_age).
+    """
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        age = process_age()
+        if age is not None:
+            self.phases['import'] = age
+        self.ready = False
+        self._last = time.perf_counter()
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def report(self):
+        lines = ['Started in **{:.2f}s**: {}'.format(self.total, ', '.join(
+            '{} {:.2f}s'.format(phase, seconds) for phase, seconds in self.phases.items()))]
+
+        if LazyExtractor.load_seconds is not None:
+            lines.append('youtube_dl loaded in **{:.2f}s** ({}, extractors: {})'.format(
+                LazyExtractor.load_seconds, YTDL_LOAD, ', '.join(YTDL_EXTRACTORS) or 'all'))
+        else:
+            lines.append('youtube_dl not loaded yet ({})'.format(YTDL_LOAD))
+
+        return '\n'.join(lines)
+
+
+startup = StartupProfile()
+
+
+_youtube_dl = None
+_youtube_dl_lock = threading.Lock()
+
+
+def load_youtube_dl():
+    """Imports youtube_dl the first time it's needed and returns it. With
+    YTDL_EXTRACTORS, only the extractors in those modules are loaded.
+    """
+
+    with _youtube_dl_lock:
+        if _youtube_dl is None:
+            _import_youtube_dl()
+
+    return _youtube_dl
+
+
+def _import_youtube_dl():
+    global _youtube_dl
+
+    for name in YTDL_EXTRACTORS:
+        if not re.fullmatch(r'[a-z0-9_]+', name):
+            raise ValueError('YTDL_EXTRACTORS takes youtube_dl.extractor module names, like '
+                             '"youtube,generic", not {!r}'.format(name))
+
+    lazy = None
+    if YTDL_EXTRACTORS and 'youtube_dl' not in sys.modules:
+        # youtube_dl imports every extractor module unless it was built with a
+        # lazy_extractors module. Stand in one that lists only ours.
+        lazy = types.ModuleType('youtube_dl.extractor.lazy_extractors')
+        lazy._ALL_CLASSES = []
+        sys.modules[lazy.__name__] = lazy
+
+    before = set(sys.modules)
+    try:
+        import youtube_dl
+
+        if lazy is not None:
+            missing = [name for name in YTDL_EXTRACTORS
+                       if importlib.util.find_spec('youtube_dl.extractor.' + name) is None]
+            if missing:
+                raise ValueError('YTDL_EXTRACTORS: youtube_dl has no extractor module named {}'.format(
+                    ', '.join(missing)))
+
+            classes = []
+            for name in YTDL_EXTRACTORS:
+                module = importlib.import_module('youtube_dl.extractor.' + name)
+                for attribute, value in vars(module).items():
+                    if attribute.endswith('IE') and isinstance(value, type) and value.__module__ == module.__name__:
+                        classes.append(value)
+                        # get_info_extractor looks them up in the package.
+                        setattr(youtube_dl.extractor, attribute, value)
+
+            # Generic matches any URL, it has to come last.
+            classes.sort(key=lambda klass: klass.ie_key() == 'Generic')
+            lazy._ALL_CLASSES.extend(classes)
+    except BaseException:
+        # A youtube_dl built around the stand-in would have no extractors at all,
+        # the next attempt has to import it from scratch.
+        for module in set(sys.modules) - before:
+            if module == 'youtube_dl' or module.startswith('youtube_dl.'):
+                del sys.modules[module]
+        if lazy is not None:
+            del sys.modules[lazy.__name__]
+        raise
+
+    # Silence useless bug reports messages
+    youtube_dl.utils.bug_reports_message = lambda: ''
+    _youtube_dl = youtube_dl
+
+
+class LazyExtractor:
+    """A youtube_dl.YoutubeDL that is only created, importing youtube_dl and its
+    extractors, when it's first used.
+    """
+
+    # Seconds the first load took, including the import.
+    load_seconds = None
+    _lock = threading.Lock()
+
+    def __init__(self, options: dict):
+        self.options = options
+        self._ytdl = None
+
+    @property
+    def loaded(self):
+        return self._ytdl is not None
+
+    def get(self):
+        if self._ytdl is None:
+            with self._lock:
+                if self._ytdl is None:
+                    start = time.perf_counter()
+                    self._ytdl = load_youtube_dl().YoutubeDL(self.options)
+
+                    elapsed = time.perf_counter() - start
+                    metrics.stage('youtube_dl_load', elapsed)
+                    if LazyExtractor.load_seconds is None:
+                        LazyExtractor.load_seconds = elapsed
+
+        return self._ytdl
+
+    def extract_info(self, url: str, **kwargs):
+        return self.get().extract_info(url, **kwargs)
+
+
+class SourceWrapper(discord.AudioSource):
+    def __init__(self, original: discord.AudioSource):
+        self.original = original
+
+    def read(self):
+        return self.original.read()
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
+class Recording:
+    """The frames of one playthrough of a song, spooled to a temporary file once they get big."""
+
+    MEMORY_LIMIT = 8 * 1024 * 1024
+    HEADER = struct.Struct('<H')
+
+    def __init__(self, *, opus: bool, volume: float, limit: float = None):
+        self.opus = opus
+        # Opus frames come out of FFmpeg with the volume already applied.
+        self.volume = volume
+        if limit is None:
+            limit = MUSIC_LOOP_BUFFER if opus else MUSIC_LOOP_BUFFER_PCM
+        self.limit = limit
+        self.max_frames = int(limit * 1000 / discord.opus.Encoder.FRAME_LENGTH)
+        self.frames = 0
+        self.truncated = False
+        self.complete = False
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.MEMORY_LIMIT)
+        # The BufferedSource appending to it, see BufferedSource.start_recording.
+        self.source = None
+
+    def append(self, data: bytes):
+        if self.frames >= self.max_frames:
+            self.truncated = True
+            return
+
+        self.file.write(self.HEADER.pack(len(data)))
+        self.file.write(data)
+        self.frames += 1
+
+    def finish(self):
+        self.complete = not self.truncated
+
+    def close(self):
+        if self.source is not None:
+            # The player thread may be appending right now.
+            self.source.stop_recording(self)
+            self.source = None
+
+        self.file.close()
+
+
+class ReplaySource(discord.AudioSource):
+    def __init__(self, recording: Recording):
+        self.recording = recording
+        self._offset = 0
+
+    def read(self):
+        file = self.recording.file
+        try:
+            file.seek(self._offset)
+            header = file.read(Recording.HEADER.size)
+            if len(header) < Recording.HEADER.size:
+                return b''
+
+            data = file.read(Recording.HEADER.unpack(header)[0])
+        except ValueError:
+            # Discarded while playing, which ends the replay.
+            return b''
+
+        self._offset = file.tell()
+        return data
+
+    def is_opus(self):
+        return self.recording.opus
+
+
+class BufferedSource(SourceWrapper):
+    """Wraps an FFmpeg source so its first frames can be read before playback starts
+    (pre-warming) and everything it plays can be recorded for a local replay.
+    """
+
+    def __init__(self, original: discord.AudioSource):
+        super().__init__(original)
+
+        self.recording = None
+        self._buffer = collections.deque()
+        # The pre-warm may still be running when playback starts, and the
+        # recording may be swapped from the event loop: all of it under the lock.
+        self._lock = threading.Lock()
+
+    def prebuffer(self, frames: int):
+        """Reads up to ``frames`` frames ahead. Blocking, run it in an executor."""
+
+        while True:
+            with self._lock:
+                if len(self._buffer) >= frames:
+                    break
+
+                data = self.original.read()
+                if not data:
+                    break
+
+                self._buffer.append(data)
+
+    def start_recording(self, recording: Recording):
+        with self._lock:
+            self.recording = recording
+        recording.source = self
+
+    def stop_recording(self, recording: Recording):
+        """Stops appending to ``recording``, before it gets closed."""
+
+        with self._lock:
+            if self.recording is recording:
+                self.recording = None
+
+    def read(self):
+        with self._lock:
+            data = self._buffer.popleft() if self._buffer else self.original.read()
+
+            if data and self.recording is not None:
+                self.recording.append(data)
+
+        return data
+
+
+class StreamStats:
+    """Mixin for our FFmpeg backed sources.
+
+    Counts live sources and the FFmpeg processes behind them (none for local
+    replays) and measures how much CPU a stream costs: the audio player thread (read, volume, Opus encode, send) and
+    the FFmpeg process, per second of audio played.
+    """
+
+    live_sources = 0
+    ffmpeg_sources = 0
+    # CPU seconds per second of audio, labelled by playback mode, and FFmpeg's
+    # alone labelled by the codec it decoded.
+    cpu_usage = LatencyRecorder()
+    # Bytes streamed from the origin per track, labelled by codec. Estimated
+    # from the format's average bitrate, FFmpeg does the downloading.
+    track_bytes = LatencyRecorder()
+    # Totals by codec, for the metrics.
+    stream_bytes = collections.Counter()
+    decode_cpu = collections.Counter()
+
+    mode = None
+
+    def _init_stats(self, position: float = 0.0, *, acodec: str = None, abr: float = None):
+        # Where in the track playback started, in seconds.
+        self.position = position
+        # What FFmpeg reads: the stream's codec and bitrate, no bitrate if it's a local file.
+        self.acodec = acodec
+        self.abr = abr
+        self.frames = 0
+        self.player_cpu = 0.0
+        self._last_cpu = None
+        self._cleaned_up = False
+        self.replay = isinstance(self.decoder, ReplaySource)
+        StreamStats.live_sources += 1
+        StreamStats.ffmpeg_sources += not self.replay
+
+    @property
+    def decoder(self):
+        """The source under the wrappers: FFmpeg, or the ReplaySource of a recording."""
+
+        source = self.original
+        while isinstance(source, SourceWrapper):
+            source = source.original
+
+        return source
+
+    @property
+    def ffmpeg_process(self):
+        return getattr(self.decoder, '_process', None)
+
+    @property
+    def seconds_played(self):
+        # Not "played", YTDLSource.played counts plays of a track.
+        return self.frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+
+    @property
+    def elapsed(self):
+        return self.position + self.seconds_played
+
+    async def prebuffer(self, frames: int, *, loop: asyncio.BaseEventLoop = None):
+        if isinstance(self.original, BufferedSource):
+            loop = loop or asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.original.prebuffer, frames)
+
+    def record(self, *, volume: float):
+        """Starts recording what this source plays. Returns the Recording, or None if it can't be recorded."""
+
+        if not isinstance(self.original, BufferedSource) or self.position:
+            return None
+
+        recording = Recording(opus=self.is_opus(), volume=volume)
+        if self.track.duration and self.track.duration > recording.limit:
+            # It would only be thrown away at the end.
+            recording.close()
+            return None
+
+        self.original.start_recording(recording)
+        return recording
+
+    def read(self):
+        # Everything the player thread did since the previous frame is on us.
+        now = time.thread_time()
+        if self._last_cpu is not None:
+            self.player_cpu += now - self._last_cpu
+        self._last_cpu = now
+
+        data = super().read()
+        if data:
+            self.frames += 1
+
+        return data
+
+    def cleanup(self):
+        # Also reached from __del__ of sources that failed to start.
+        if not getattr(self, '_cleaned_up', True):
+            self._cleaned_up = True
+            StreamStats.live_sources -= 1
+            StreamStats.ffmpeg_sources -= not self.replay
+
+            ffmpeg_cpu = process_cpu_time(self.ffmpeg_process)
+            played = self.seconds_played
+            acodec = self.acodec or 'unknown'
+            if played >= 1:
+                self.cpu_usage(self.mode + '-python', self.player_cpu / played)
+                if ffmpeg_cpu is not None:
+                    self.cpu_usage(self.mode, (self.player_cpu + ffmpeg_cpu) / played)
+                    self.cpu_usage('ffmpeg-' + acodec, ffmpeg_cpu / played)
+            if ffmpeg_cpu is not None:
+                StreamStats.decode_cpu[acodec] += ffmpeg_cpu
+            if self.abr and played:
+                transferred = int(self.abr * 125 * played)
+                self.track_bytes(acodec, transferred)
+                StreamStats.stream_bytes[acodec] += transferred
+
+        super().cleanup()
+
+
+class YTDLSource(StreamStats, discord.PCMVolumeTransformer):
+    YTDL_OPTIONS = {
+        'format': 'bestaudio[acodec=opus]/bestaudio/best' if MUSIC_PLAYBACK == 'opus' else 'bestaudio/best',
+        'extractaudio': True,
+        'audioformat': 'mp3',
+        'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
+        'restrictfilenames': True,
+        'noplaylist': True,
+        'playlistend': 1,
+        'nocheckcertificate': True,
+        'ignoreerrors': False,
+        'logtostderr': False,
+        'quiet': True,
+        'no_warnings': True,
+        'default_search': 'auto',
+        'source_address': '0.0.0.0',
+        'socket_timeout': YTDL_SOCKET_TIMEOUT,
+    }
+
+    FFMPEG_OPTIONS = {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+        'options': '-vn'
+    }
+
+    ytdl = LazyExtractor(YTDL_OPTIONS)
+    # Lists a playlist's entries without extracting any of them.
+    ytdl_flat = LazyExtractor(dict(YTDL_OPTIONS, extract_flat='in_playlist', playlistend=MUSIC_PLAYLIST_MAX))
+    cache = ExtractionCache(MUSIC_DB_PATH)
+    engine = ExtractionEngine(pool=YTDL_POOL, workers=YTDL_WORKERS, backlog=YTDL_BACKLOG)
+    # Concurrent requests for the same query or page share one extraction.
+    inflight = SingleFlight()
+    breaker = CircuitBreaker(threshold=YTDL_BREAKER_THRESHOLD, reset_after=YTDL_BREAKER_RESET)
+    library = LibraryIndex(MUSIC_DB_PATH, confidence=MUSIC_LIBRARY_CONFIDENCE)
+    if library.enabled and not len(library):
+        library.add(*cache.infos())
+    audio_cache = AudioCache(MUSIC_AUDIO_CACHE, MUSIC_DB_PATH, max_size=MUSIC_AUDIO_CACHE_SIZE,
+                             threshold=MUSIC_AUDIO_CACHE_PLAYS, policy=MUSIC_AUDIO_CACHE_POLICY)
+    # Running audio cache downloads. The loop only keeps weak references to tasks.
+    downloads = set()
+
+    # Called with (resolution, elapsed seconds) after every create_source.
+    latency = LatencyRecorder()
+    timing_hooks = [latency, lambda resolution, elapsed: metrics.observe('music_enqueue_seconds', elapsed,
+                                                                          resolution=resolution)]
+
+    mode = 'pcm'
+
+    def __init__(self, track: Track, source: discord.AudioSource, *, volume: float = 0.5, position: float = 0.0,
+                 acodec: str = None, abr: float = None):
+        super().__init__(source, volume)
+
+        self.track = track
+        self._init_stats(position, acodec=acodec, abr=abr)
+
+    def __str__(self):
+        return str(self.track)
+
+    @classmethod
+    async def create_track(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+        guild = ctx.guild.id if ctx.guild else None
+        start = time.perf_counter()
+
+        live = bool(MUSIC_LIVE_PREFIX) and search.startswith(MUSIC_LIVE_PREFIX)
+        if live:
+            search = search[len(MUSIC_LIVE_PREFIX):]
+
+        key = cls.cache.normalize(search)
+        entry = cls.cache.get(key) if not live else None
+        resolution = 'failed'
+        try:
+            if entry is None or entry.stream_expired:
+                async with timeout(MUSIC_PLAY_TIMEOUT):
+                    (entry, resolution), shared = await cls.inflight.run(
+                        ('live' if live else 'query', key),
+                        functools.partial(cls.resolve_entry, key, entry, live=live, loop=loop, guild=guild))
+                if shared:
+                    resolution = 'coalesced'
+            else:
+                resolution = 'cache'
+        except asyncio.TimeoutError:
+            resolution = 'timeout'
+            metrics.inc('music_extraction_failures_total', reason='timeout')
+            raise ExtractorTimeout('That took too long, please try again in a moment.') from None
+        finally:
+            # Failures count too, they are what the tail latency is made of.
+            elapsed = time.perf_counter() - start
+            for hook in cls.timing_hooks:
+                hook(resolution, elapsed)
+
+        return Track(entry)
+
+    @classmethod
+    async def create_playlist(cls, ctx: commands.Context, url: str, *, loop: asyncio.BaseEventLoop = None):
+        """Lists the entries of a playlist with a single extraction.
+        Returns an iterator of placeholder tracks, see Track.placeholder.
+        """
+
+        loop = loop or asyncio.get_event_loop()
+        guild = ctx.guild.id if ctx.guild else None
+        start = time.perf_counter()
+
+        resolution = 'failed'
+        try:
+            async with timeout(MUSIC_PLAY_TIMEOUT):
+                with metrics.timed('playlist'):
+                    entries, shared = await cls.inflight.run(
+                        ('playlist', url), functools.partial(cls.run_extractor, ytdl_extract_playlist, url,
+                                                             loop=loop, guild=guild))
+            resolution = 'coalesced' if shared else 'playlist'
+        except asyncio.TimeoutError:
+            resolution = 'timeout'
+            metrics.inc('music_extraction_failures_total', reason='timeout')
+            raise ExtractorTimeout('That took too long, please try again in a moment.') from None
+        finally:
+            elapsed = time.perf_counter() - start
+            for hook in cls.timing_hooks:
+                hook(resolution, elapsed)
+
+        if not entries:
+            metrics.inc('music_extraction_failures_total', reason='not_found')
+            raise YTDLError('Couldn\'t find anything in `{}`'.format(url))
+
+        return (Track.placeholder(*entry) for entry in entries)
+
+    @classmethod
+    def load(cls):
+        """Loads youtube_dl and creates the extractors now instead of on first use."""
+
+        cls.ytdl.get()
+        cls.ytdl_flat.get()
+
+    @staticmethod
+    def is_playlist(search: str):
+        """Whether ``search`` links to a playlist rather than to a song in one (which noplaylist plays alone)."""
+
+        url = urllib.parse.urlsplit(search)
+        query = urllib.parse.parse_qs(url.query)
+        return url.scheme in ('http', 'https') and 'list' in query and 'v' not in query
+
+    @classmethod
+    async def create_source(cls, track: Track, *, volume: float = 0.5, position: float = 0.0, bitrate: int = None,
+                            loop: asyncio.BaseEventLoop = None, guild: int = None):
+        """Builds the playable source for ``track``. Plays the local copy if there is one,
+        otherwise the stream (the format for ``bitrate``, see Track.stream_for), renewing
+        its URL first if it expired.
+        """
+
+        loop = loop or asyncio.get_event_loop()
+        await cls.ensure_stream(track, loop=loop, guild=guild)
+
+        if MUSIC_PLAYBACK == 'opus':
+            return YTDLOpusSource.from_track(track, volume=volume, position=position, bitrate=bitrate)
+
+        source, before_options, acodec, abr = cls.ffmpeg_input(track, bitrate)
+        if position:
+            before_options += ' -ss {:.2f}'.format(position)
+
+        with metrics.timed('ffmpeg_spawn'):
+            source = discord.FFmpegPCMAudio(source, before_options=before_options,
+                                            options=cls.FFMPEG_OPTIONS['options'])
+        return cls(track, BufferedSource(source), volume=volume, position=position, acodec=acodec, abr=abr)
+
+    @classmethod
+    async def ensure_stream(cls, track: Track, *, loop: asyncio.BaseEventLoop = None, guild: int = None):
+        """Renews the stream URL of ``track`` if it expired and there is no local copy to play instead."""
+
+        if track.stream_expired and (not track.resolved or cls.audio_cache.path(track) is None):
+            await cls.refresh_track(track, loop=loop, guild=guild)
+
+    @classmethod
+    def ffmpeg_input(cls, track: Track, bitrate: int = None):
+        """Returns the FFmpeg input for ``track`` played at ``bitrate``, its before_options,
+        its codec and its bitrate (None for the local copy).
+        """
+
+        path = cls.audio_cache.path(track)
+        if path is not None:
+            return path, '', 'opus', None
+
+        url, acodec, abr = track.stream_for(bitrate if MUSIC_FORMAT == 'bitrate' else None,
+                                            prefer_opus=MUSIC_PLAYBACK == 'opus')
+        return url, cls.FFMPEG_OPTIONS['before_options'], acodec, abr
+
+    @classmethod
+    def played(cls, track: Track, *, loop: asyncio.BaseEventLoop = None):
+        """Counts a play of ``track`` and starts caching it locally once it's popular enough."""
+
+        cls.library.played(track.webpage_url)
+        if cls.audio_cache.played(track):
+            loop = loop or asyncio.get_event_loop()
+            task = loop.create_task(cls.audio_cache.download(track))
+            cls.downloads.add(task)
+            task.add_done_callback(functools.partial(cls._downloaded, track))
+
+    @classmethod
+    def _downloaded(cls, track: Track, task: asyncio.Task):
+        cls.downloads.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print('Couldn\'t cache {} locally: {!r}'.format(track.webpage_url, task.exception()))
+
+    @classmethod
+    def replay(cls, track: Track, recording: Recording, *, volume: float = 0.5):
+        """Plays ``track`` again from a local recording instead of the remote stream."""
+
+        if recording.opus:
+            return YTDLOpusSource(track, ReplaySource(recording), volume=recording.volume)
+
+        return cls(track, ReplaySource(recording), volume=volume)
+
+    @classmethod
+    async def resolve_entry(cls, key: str, entry: CacheEntry = None, *, live: bool = False,
+                            loop: asyncio.BaseEventLoop, guild: int = None):
+        """Resolves a query that missed the cache, or renews the stream of ``entry``.
+        Returns the new cache entry and how it was resolved.
+        """
+
+        if entry is None:
+            webpage_url = None
+            if not live and not key.startswith(('http://', 'https://')):
+                with metrics.timed('library'):
+                    webpage_url = cls.library.match(key)
+
+            if webpage_url is not None:
+                # The query's miss was counted already.
+                entry = cls.cache.get(webpage_url, count=False)
+                if entry is not None and not entry.stream_expired:
+                    cls.cache.alias(key, entry)
+                    return entry, 'library'
+
+                # Known track, only its details have to be fetched again.
+                info = await cls.process(webpage_url, loop=loop, guild=guild)
+                return cls.cache.put(info, key), 'library-refresh'
+
+            info, resolution = await cls.resolve(key, live=live, loop=loop, guild=guild)
+            entry = cls.cache.put(info, key)
+            cls.library.add(entry.info)
+            return entry, resolution
+
+        # Metadata is still good, only the stream link has to be renewed.
+        info = await cls.process(entry.webpage_url, loop=loop, guild=guild)
+        cls.cache.stream_refreshes += 1
+        return cls.cache.put(info, key), 'refresh'
+
+    @classmethod
+    async def refresh_track(cls, track: Track, *, loop: asyncio.BaseEventLoop = None, guild: int = None):
+        loop = loop or asyncio.get_event_loop()
+
+        placeholder = not track.resolved
+        info = await cls.process(track.webpage_url, loop=loop, guild=guild)
+        entry = cls.cache.put(info)
+        if placeholder:
+            cls.library.add(entry.info)
+        else:
+            cls.cache.stream_refreshes += 1
+        track.refresh(entry)
+
+    @classmethod
+    async def probe(cls, track: Track, *, loop: asyncio.BaseEventLoop = None):
+        """Checks that the origin still serves the track's stream URL by fetching its first byte."""
+
+        loop = loop or asyncio.get_event_loop()
+        return await loop.run_in_executor(None, probe_stream, track.stream_url)
+
+    @classmethod
+    async def resolve(cls, search: str, *, live: bool = False, loop: asyncio.BaseEventLoop, guild: int = None):
+        """Extracts the processed info for ``search``. ``live`` skips the query index.
+        Returns the info and how it was resolved ('url', 'index' or 'search').
+        """
+
+        if YTDL_RESOLUTION == 'single':
+            if search.startswith(('http://', 'https://')):
+                return await cls.process(search, loop=loop, guild=guild), 'url'
+
+            webpage_url = cls.cache.lookup_url(search) if not live else None
+            if webpage_url is not None:
+                return await cls.process(webpage_url, loop=loop, guild=guild), 'index'
+
+        return await cls.extract(search, loop=loop, guild=guild), 'search'
+
+    @classmethod
+    async def extract_info(cls, url: str, process: bool, *, loop: asyncio.BaseEventLoop, guild: int = None):
+        return await cls.run_extractor(ytdl_extract_info, url, process, loop=loop, guild=guild)
+
+    @classmethod
+    async def run_extractor(cls, func, *args, loop: asyncio.BaseEventLoop, guild: int = None):
+        """Runs ``func(*args)`` on the engine under YTDL_TIMEOUT, retrying transient errors
+        with jittered exponential backoff, unless the circuit breaker is open.
+        """
+
+        for attempt in range(YTDL_RETRIES + 1):
+            cls.breaker.check()
+            try:
+                result = await asyncio.wait_for(cls.engine.run(guild, func, *args, loop=loop), YTDL_TIMEOUT)
+            except (asyncio.CancelledError, ExtractorBusy):
+                cls.breaker.released()
+                raise
+            except asyncio.TimeoutError:
+                # The worker is freed by the socket timeout, we just stop waiting for it.
+                cls.breaker.failed()
+                metrics.inc('music_extraction_failures_total', reason='timeout')
+                raise ExtractorTimeout('That took too long, please try again in a moment.') from None
+            except Exception as e:
+                # youtube_dl's DownloadError and friends become YTDLError, which the
+                # commands and the player report instead of dying on.
+                if not is_transient(e):
+                    # The site answered, it just didn't like the request.
+                    cls.breaker.succeeded()
+                    raise YTDLError(extractor_message(e)) from e
+
+                cls.breaker.failed()
+                if attempt == YTDL_RETRIES:
+                    raise YTDLError(extractor_message(e)) from e
+
+                metrics.inc('music_extraction_retries_total')
+                await asyncio.sleep(random.uniform(0, 2 ** attempt))
+            else:
+                cls.breaker.succeeded()
+                return result
+
+    @classmethod
+    async def extract(cls, search: str, *, loop: asyncio.BaseEventLoop, guild: int = None):
+        with metrics.timed('search'):
+            data = await cls.extract_info(search, False, loop=loop, guild=guild)
+
+        if data is None:
+            metrics.inc('music_extraction_failures_total', reason='not_found')
+            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+
+        if 'entries' not in data:
+            process_info = data
+        else:
+            process_info = None
+            for entry in data['entries']:
+                if entry:
+                    process_info = entry
+                    break
+
+            if process_info is None:
+                metrics.inc('music_extraction_failures_total', reason='not_found')
+                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+
+        return await cls.process(process_info['webpage_url'], loop=loop, guild=guild)
+
+    @classmethod
+    async def process(cls, webpage_url: str, *, loop: asyncio.BaseEventLoop, guild: int = None):
+        info, _ = await cls.inflight.run(('page', webpage_url),
+                                         functools.partial(cls._process, webpage_url, loop=loop, guild=guild))
+        return info
+
+    @classmethod
+    async def _process(cls, webpage_url: str, *, loop: asyncio.BaseEventLoop, guild: int = None):
+        with metrics.timed('process'):
+            processed_info = await cls.extract_info(webpage_url, True, loop=loop, guild=guild)
+
+        if processed_info is None:
+            metrics.inc('music_extraction_failures_total', reason='not_found')
+            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
+
+        if 'entries' not in processed_info:
+            info = processed_info
+        else:
+            info = None
+            while info is None:
+                try:
+                    info = processed_info['entries'].pop(0)
+                except IndexError:
+                    metrics.inc('music_extraction_failures_total', reason='not_found')
+                    raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
+
+        return info
+
+    @staticmethod
+    def parse_duration(duration: int):
+        minutes, seconds = divmod(duration, 60)
+        hours, minutes = divmod(minutes, 60)
+        days, hours = divmod(hours, 24)
+
+        duration = []
+        if days > 0:
+            duration.append('{} days'.format(days))
+        if hours > 0:
+            duration.append('{} hours'.format(hours))
+        if minutes > 0:
+            duration.append('{} minutes'.format(minutes))
+        if seconds > 0:
+            duration.append('{} seconds'.format(seconds))
+
+        return ', '.join(duration)
+
+
+class YTDLOpusSource(StreamStats, SourceWrapper):
+    """Plays a track without any per-frame work in Python.
+
+    Opus streams at full volume are passed through as-is, anything else is
+    volume-adjusted and encoded to Opus by FFmpeg. Changing the volume means
+    restarting FFmpeg at the current position, see :meth:`restart`.
+    """
+
+    mode = 'opus'
+    BITRATE = 128
+
+    def __init__(self, track: Track, source: discord.AudioSource, *, volume: float = 0.5, position: float = 0.0,
+                 bitrate: int = None, acodec: str = None, abr: float = None):
+        super().__init__(source)
+
+        self.track = track
+        self.volume = volume
+        self.bitrate = bitrate
+        self._init_stats(position, acodec=acodec, abr=abr)
+
+    def __str__(self):
+        return str(self.track)
+
+    @classmethod
+    def from_track(cls, track: Track, *, volume: float = 0.5, position: float = 0.0, bitrate: int = None):
+        source, before_options, acodec, abr = YTDLSource.ffmpeg_input(track, bitrate)
+        if position:
+            before_options += ' -ss {:.2f}'.format(position)
+
+        if acodec == 'opus' and volume == 1.0:
+            codec, options = 'opus', '-vn'
+        else:
+            codec, options = None, '-vn -filter:a volume={:.2f}'.format(volume)
+
+        # Encoding more than the channel carries is wasted.
+        encode_bitrate = min(cls.BITRATE, bitrate // 1000) if bitrate else cls.BITRATE
+        with metrics.timed('ffmpeg_spawn'):
+            source = discord.FFmpegOpusAudio(source, bitrate=encode_bitrate, codec=codec,
+                                             before_options=before_options, options=options)
+        return cls(track, BufferedSource(source), volume=volume, position=position, bitrate=bitrate,
+                   acodec=acodec, abr=abr)
+
+    def restart(self, *, volume: float):
+        """Returns a new source for the same track, resuming where this one is."""
+
+        return self.from_track(self.track, volume=volume, position=self.elapsed, bitrate=self.bitrate)
+
+
+class Broadcast:
+    """Decodes and encodes a song once and fans its Opus frames out to every guild playing it.
+
+    A pump thread reads the shared source in real time, a few frames ahead,
+    into a short ring buffer. Subscribers start at the live position and take
+    the frames from the ring. The broadcast stops when its last subscriber
+    leaves.
+    """
+
+    # Frames read ahead of real time, and frames kept for subscribers lagging behind.
+    LEAD = 10
+    RING = 250
+    # Sent when the pump falls behind, so the voice connection doesn't end the song.
+    SILENCE = b'\xf8\xff\xfe'
+    # Seconds between frames, real time. bench/music.py shortens it to match its speed.
+    FRAME_DELAY = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+    # (track cache key, volume) -> Broadcast
+    live = {}
+    _lock = threading.Lock()
+
+    def __init__(self, key: tuple, source: 'YTDLOpusSource'):
+        self.key = key
+        self.source = source
+        self.track = source.track
+        self.position = source.position
+        self.subscribers = 0
+        self.frames = collections.deque(maxlen=self.RING)
+        # Index of the next frame the pump will add.
+        self.head = 0
+        self.finished = False
+
+        self._ready = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._pump, name='broadcast', daemon=True)
+
+    @classmethod
+    def joinable(cls, track: Track, *, volume: float):
+        broadcast = cls.live.get((track.cache_key, round(volume, 2)))
+        return broadcast is not None and not broadcast.finished
+
+    @classmethod
+    def subscribe(cls, track: Track, *, volume: float, position: float = 0.0, bitrate: int = None):
+        """Returns a source playing ``track`` from the live position of its broadcast.
+        Starts a broadcast from ``position`` if there is none, in the format that suits
+        ``bitrate``, the voice channel of the guild starting it. Guilds joining later
+        get that format too.
+        """
+
+        key = (track.cache_key, round(volume, 2))
+        with cls._lock:
+            if cls.joinable(track, volume=volume):
+                return cls.live[key].join(joined=True)
+
+        source = YTDLOpusSource.from_track(track, volume=volume, position=position, bitrate=bitrate)
+        with cls._lock:
+            if cls.joinable(track, volume=volume):
+                # Someone else started it while FFmpeg was spawning.
+                source.cleanup()
+                return cls.live[key].join(joined=True)
+
+            broadcast = cls.live[key] = cls(key, source)
+            subscriber = broadcast.join(joined=False)
+
+        broadcast._thread.start()
+        return subscriber
+
+    def join(self, *, joined: bool):
+        self.subscribers += 1
+        return BroadcastSource(self, max(self.head - len(self.frames), self.head - self.LEAD), joined=joined)
+
+    def leave(self):
+        with self._lock:
+            self.subscribers -= 1
+            if self.subscribers > 0:
+                return
+
+            if self.live.get(self.key) is self:
+                del self.live[self.key]
+
+        self._stopped.set()
+
+    def read(self, cursor: int):
+        """Returns the frame at ``cursor`` and the cursor of the next one."""
+
+        with self._ready:
+            if cursor >= self.head and not self.finished:
+                self._ready.wait(2 * self.FRAME_DELAY)
+
+            base = self.head - len(self.frames)
+            cursor = max(cursor, base)
+            if cursor < self.head:
+                return self.frames[cursor - base], cursor + 1
+
+            return (b'' if self.finished else self.SILENCE), cursor
+
+    def _pump(self):
+        delay = self.FRAME_DELAY
+        start = time.perf_counter()
+        try:
+            while not self._stopped.is_set():
+                data = self.source.read()
+                if not data:
+                    break
+
+                with self._ready:
+                    self.frames.append(data)
+                    self.head += 1
+                    self._ready.notify_all()
+
+                self._stopped.wait(max(0.0, start + (self.head - self.LEAD) * delay - time.perf_counter()))
+        finally:
+            with self._ready:
+                self.finished = True
+                self._ready.notify_all()
+            self.source.cleanup()
+
+
+class BroadcastSource(discord.AudioSource):
+    """One guild's place in a Broadcast."""
+
+    def __init__(self, broadcast: Broadcast, cursor: int, *, joined: bool):
+        self.broadcast = broadcast
+        self.track = broadcast.track
+        self.volume = broadcast.key[1]
+        # Whether it joined a broadcast that was already playing.
+        self.joined = joined
+        self._cursor = cursor
+        self._cleaned_up = False
+
+    def __str__(self):
+        return str(self.track)
+
+    @property
+    def elapsed(self):
+        return self.broadcast.position + self._cursor * discord.opus.Encoder.FRAME_LENGTH / 1000
+
+    def read(self):
+        data, self._cursor = self.broadcast.read(self._cursor)
+        return data
+
+    def is_opus(self):
+        return True
+
+    def record(self, *, volume: float):
+        # Loops replay from the broadcast instead.
+        return None
+
+    def restart(self, *, volume: float):
+        """Returns a source for the same track at the new volume, from the broadcast at that volume if any."""
+
+        return Broadcast.subscribe(self.track, volume=volume, position=self.elapsed,
+                                   bitrate=self.broadcast.source.bitrate)
+
+    def cleanup(self):
+        if not self._cleaned_up:
+            self._cleaned_up = True
+            self.broadcast.leave()
+
+
+def probe_stream(url: str, *, timeout: float = 5):
+    headers = dict(load_youtube_dl().utils.std_headers, Range='bytes=0-0')
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+            return response.status < 400
+    except (urllib.error.URLError, OSError, ValueError):
+        return False
+
+
+def extractor_message(error: Exception):
+    """The part of an extraction error worth showing in the channel."""
+
+    message = str(error) or type(error).__name__
+    # youtube_dl prefixes what it reports with a colored "ERROR: ".
+    return re.sub(r'^(\x1b\[[0-9;]*m)?ERROR:(\x1b\[0m)? ', '', message)
+
+
+def is_transient(error: Exception):
+    """Whether an extraction error is worth retrying: throttling, server errors and network trouble."""
+
+    # youtube_dl wraps the original error, possibly twice.
+    for _ in range(3):
+        cause = getattr(error, 'exc_info', None)
+        cause = cause[1] if cause else getattr(error, 'cause', None)
+        if cause is None or cause is error:
+            break
+        error = cause
+
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+
+    return isinstance(error, (urllib.error.URLError, ConnectionError, socket.timeout, TimeoutError))
+
+
+def ytdl_extract_info(url: str, process: bool = True):
+    # Module level so it can be pickled into a process pool.
+    return YTDLSource.ytdl.extract_info(url, download=False, process=process)
+
+
+def ytdl_extract_playlist(url: str):
+    """Returns (webpage_url, title, duration) for every entry of the playlist at ``url``.
+    Nothing else is kept, so the result stays small however long the playlist is.
+    """
+
+    data = YTDLSource.ytdl_flat.extract_info(url, download=False)
+    if data is None:
+        return []
+
+    entries = []
+    for entry in data.get('entries', [data]):
+        if not entry:
+            continue
+
+        webpage_url = entry.get('webpage_url') or entry.get('url')
+        if webpage_url and not webpage_url.startswith(('http://', 'https://')):
+            # Flat YouTube entries only have the video id.
+            if entry.get('ie_key') != 'Youtube':
+                continue
+            webpage_url = 'https://www.youtube.com/watch?v=' + webpage_url
+
+        if webpage_url:
+            entries.append((webpage_url, entry.get('title'), entry.get('duration')))
+
+    return entries
+
+
+class Requester(collections.namedtuple('Requester', 'id')):
+    """Stands in for the member who requested a restored song when they aren't cached."""
+
+    __slots__ = ()
+
+    @property
+    def mention(self):
+        return '<@{}>'.format(self.id)
+
+
+class Song:
+    __slots__ = ('track', 'requester', 'channel', 'source', 'prefetched')
+
+    def __init__(self, track: Track, requester: discord.abc.User, channel: discord.abc.Messageable):
+        self.track = track
+        self.requester = requester
+        self.channel = channel
+        # Only created by the player right before the song starts.
+        self.source = None
+        self.prefetched = False
+
+    def to_dict(self):
+        return {'track': self.track.to_dict(), 'requester': self.requester.id, 'channel': self.channel.id}
+
+    @classmethod
+    def from_dict(cls, guild: discord.Guild, data: dict):
+        channel = guild.get_channel(data['channel'])
+        if channel is None:
+            return None
+
+        requester = guild.get_member(data['requester']) or Requester(data['requester'])
+        return cls(Track.from_dict(data['track']), requester, channel)
+
+    def create_embed(self):
+        duration = YTDLSource.parse_duration(int(self.track.duration or 0)) or 'Live'
+        embed = (discord.Embed(title='Now playing',
+                               description='```css\n{0.track.title}\n```'.format(self),
+                               color=discord.Color.blurple())
+                 .add_field(name='Duration', value=duration)
+                 .add_field(name='Requested by', value=self.requester.mention)
+                 .add_field(name='Uploader', value='[{0.track.uploader}]({0.track.uploader_url})'.format(self))
+                 .add_field(name='URL', value='[Click]({0.track.webpage_url})'.format(self))
+                 .set_thumbnail(url=self.track.thumbnail))
+
+        return embed
+
+
+class SongQueue(asyncio.Queue):
+    """The songs waiting to be played, ordered by a position key.
+
+    Entries live in a sorted list, so indexing, removing and moving songs are
+    O(log n). Keys are exact fractions: a moved song simply gets a key between
+    its new neighbours. In fair mode new songs are interleaved round-robin by
+    requester instead of being appended.
+    """
+
+    def __init__(self, *, fair: bool = False, **kwargs):
+        self.fair = fair
+        super().__init__(**kwargs)
+
+    def _init(self, maxsize):
+        # Entries are (key, seq, song), seq breaks ties so songs are never compared.
+        self._queue = sortedcontainers.SortedList()
+        # Bumped on every change, for snapshots.
+        self.version = 0
+        self._urls = collections.Counter()
+        self._seq = itertools.count()
+        self._tail = 0
+        # Fair mode: the round each requester's last song went into and the
+        # round currently being played.
+        self._rounds = {}
+        self._round = 0
+        # Rendered pages of music.queue, until the queue changes.
+        self._pages = {}
+        self._pages_version = 0
+
+    def _put(self, song):
+        key, seq = self._next_key(song)
+        self._insert(key, seq, song)
+
+    def _get(self):
+        key, _, song = self._queue.pop(0)
+        self._forget(song)
+        self.version += 1
+        self._round = max(self._round, math.floor(key))
+        return song
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [entry[2] for entry in self._queue[item]]
+        else:
+            return self._queue[item][2]
+
+    def __iter__(self):
+        return (entry[2] for entry in self._queue)
+
+    def __len__(self):
+        return self.qsize()
+
+    def has(self, webpage_url: str):
+        return self._urls[webpage_url] > 0
+
+    def index(self, webpage_url: str):
+        for i, song in enumerate(self):
+            if song.track.webpage_url == webpage_url:
+                return i
+
+        raise ValueError(webpage_url)
+
+    def extend(self, songs):
+        for song in songs:
+            self.put_nowait(song)
+
+    def page(self, number: int, size: int = 10):
+        """Returns the listing of page ``number`` (from 1) of the queue. Pages are
+        rendered once and kept until the queue changes.
+        """
+
+        if self._pages_version != self.version:
+            self._pages.clear()
+            self._pages_version = self.version
+
+        text = self._pages.get((number, size))
+        if text is None:
+            start = (number - 1) * size
+            text = self._pages[number, size] = '\n'.join(
+                '`{0}.` [**{1.track.title}**]({1.track.webpage_url})'.format(i + 1, song)
+                for i, song in enumerate(self[start:start + size], start=start))
+
+        return text
+
+    def clear(self):
+        self._queue.clear()
+        self._urls.clear()
+        self._rounds.clear()
+        self.version += 1
+
+    def shuffle(self):
+        songs = list(self)
+        random.shuffle(songs)
+        self._rekey(songs)
+
+    def remove(self, index: int):
+        _, _, song = self._queue.pop(index)
+        self._forget(song)
+        self.version += 1
+        return song
+
+    def move(self, index: int, destination: int):
+        """Moves the song at ``index`` so it ends up at ``destination``."""
+
+        entry = self._queue.pop(index)
+        size = len(self._queue)
+        destination = max(0, min(destination, size))
+
+        if size == 0:
+            key = entry[0]
+        elif destination == 0:
+            key = self._queue[0][0] - 1
+        elif destination == size:
+            key = self._queue[-1][0] + 1
+        else:
+            key = (Fraction(self._queue[destination - 1][0]) + self._queue[destination][0]) / 2
+
+        self._tail = max(self._tail, key)
+        self._queue.add((key, entry[1], entry[2]))
+        self.version += 1
+
+    def set_fair(self, fair: bool):
+        """Switches the ordering mode, re-ordering the queued songs to match it."""
+
+        self.fair = fair
+        self._rekey(list(self))
+
+    def _next_key(self, song):
+        seq = next(self._seq)
+        if self.fair:
+            # A requester's n-th queued song goes into round n (but never into
+            # a round that already played), songs in a round keep arrival order.
+            requester = song.requester.id
+            round_ = max(self._rounds.get(requester, 0) + 1, self._round)
+            self._rounds[requester] = round_
+            key = round_ + Fraction(seq, seq + 1)
+        else:
+            key = math.floor(self._tail) + 1
+
+        self._tail = max(self._tail, key)
+        return key, seq
+
+    def _insert(self, key, seq: int, song):
+        self._queue.add((key, seq, song))
+        self._urls[song.track.webpage_url] += 1
+        self.version += 1
+
+    def _forget(self, song):
+        url = song.track.webpage_url
+        self._urls[url] -= 1
+        if self._urls[url] <= 0:
+            del self._urls[url]
+
+    def _rekey(self, songs):
+        self.clear()
+        for song in songs:
+            self._insert(*self._next_key(song), song)
+
+
+class TokenBucket:
+    """Allows ``rate`` operations a second on average, in bursts of up to ``burst``."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    @property
+    def full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+    def delay(self):
+        """Returns how many seconds until the next operation is allowed."""
+
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class Outgoing:
+    """A message waiting to be sent and the futures waiting for it."""
+
+    __slots__ = ('content', 'embed', 'key', 'futures', 'queued_at')
+
+    def __init__(self, content: str = None, embed: discord.Embed = None, *, key=None, future: asyncio.Future):
+        self.content = content
+        self.embed = embed
+        self.key = key
+        self.futures = [future]
+        self.queued_at = time.perf_counter()
+
+    @property
+    def mergeable(self):
+        return self.key is None and self.embed is None and self.content is not None
+
 
-    def __init__(self, ctx: commands.Context, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5):
-        super().__init__(source, volume)
+class Dispatcher:
+    """Sends the bot's chat output, one queue per channel.
 
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.data = data
-
-        self.uploader = data.get('uploader')
-        self.uploader_url = data.get('uploader_url')
-        date = data.get('upload_date')
-        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4]
-        self.title = data.get('title')
-        self.thumbnail = data.get('thumbnail')
-        self.description = data.get('description')
-        self.duration = self.parse_duration(int(data.get('duration')))
-        self.tags = data.get('tags')
-        self.url = data.get('webpage_url')
-        self.views = data.get('view_count')
-        self.likes = data.get('like_count')
-        self.dislikes = data.get('dislike_count')
-        self.stream_url = data.get('url')
+    Every channel has a token bucket (MUSIC_SEND_RATE, MUSIC_SEND_BURST) and all
+    of them share a global one, so Discord never has to throttle us. Text
+    messages that are queued one after another by the time their channel gets a
+    token are merged into one message. :meth:`show` keeps a single message per
+    key up to date by editing it in place, only the latest of several queued
+    updates is made. A channel's queue is drained by a task that ends once
+    it's empty.
+    """
 
-    def __str__(self):
-        return '**{0.title}** by **{0.uploader}**'.format(self)
+    MESSAGE_LIMIT = 2000
 
-    @classmethod
-    async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
-        loop = loop or asyncio.get_event_loop()
+    # Discord allows 50 requests a second per bot, leave some for everything else.
+    GLOBAL_RATE = 40
 
-        partial = functools.partial(cls.ytdl.extract_info, search, download=False, process=False)
-        data = await loop.run_in_executor(None, partial)
+    def __init__(self, *, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.global_bucket = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
 
-        if data is None:
-            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+        self.sent = 0
+        self.edited = 0
+        self.coalesced = 0
+        self.failed = 0
 
-        if 'entries' not in data:
-            process_info = data
-        else:
-            process_info = None
-            for entry in data['entries']:
-                if entry:
-                    process_info = entry
-                    break
+        # channel id -> deque of Outgoing, only while its drain task runs.
+        self._outboxes = {}
+        self._buckets = {}
+        # key -> (channel id, message) of what show() displayed last.
+        self._shown = {}
 
-            if process_info is None:
-                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+    def __len__(self):
+        return sum(len(outbox) for outbox in self._outboxes.values())
 
-        webpage_url = process_info['webpage_url']
-        partial = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+    def send(self, channel: discord.abc.Messageable, content: str = None, *, embed: discord.Embed = None):
+        """Queues a message. Returns a future for the discord.Message it ends up in."""
 
-        if processed_info is None:
-            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
+        return self._queue(channel, content, embed, None)
 
-        if 'entries' not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
+    def show(self, channel: discord.abc.Messageable, key, content: str = None, *, embed: discord.Embed = None):
+        """Shows ``content`` and ``embed`` in the message kept for ``key``. It's edited if
+        it's in ``channel``, otherwise a new one is sent. Returns a future for the message.
+        """
+
+        shown = self._shown.get(key)
+        if shown is not None and shown[0] != channel.id:
+            del self._shown[key]
+
+        return self._queue(channel, content, embed, key)
+
+    def forget(self, key):
+        self._shown.pop(key, None)
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'edited': self.edited,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'queued': len(self),
+            'channels': len(self._outboxes),
+        }
+
+    def _queue(self, channel, content, embed, key):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        outbox = self._outboxes.get(channel.id)
+        if outbox is None:
+            outbox = self._outboxes[channel.id] = collections.deque()
+            loop.create_task(self._drain(channel, outbox))
+        elif key is not None:
+            for item in outbox:
+                if item.key == key:
+                    item.content, item.embed = content, embed
+                    item.futures.append(future)
+                    self.coalesced += 1
+                    return future
+
+        outbox.append(Outgoing(content, embed, key=key, future=future))
+        return future
+
+    async def _drain(self, channel, outbox: collections.deque):
+        bucket = self._buckets.get(channel.id)
+        if bucket is None:
+            bucket = self._buckets[channel.id] = TokenBucket(self.rate, self.burst)
+
+        try:
+            while outbox:
+                delay = max(bucket.delay(), self.global_bucket.delay())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                bucket.take()
+                self.global_bucket.take()
+                item = self._next(outbox)
+                metrics.observe('music_message_wait_seconds', time.perf_counter() - item.queued_at)
                 try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
+                    result = await self._deliver(channel, item)
+                except Exception as e:
+                    self.failed += 1
+                    print('Couldn\'t send a message to channel {}: {}'.format(channel.id, e))
+                    for future in item.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                            # Nobody has to look at it, most output is fire and forget.
+                            future.exception()
+                else:
+                    for future in item.futures:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            del self._outboxes[channel.id]
+            self._forget_bucket(channel.id)
+
+    def _next(self, outbox: collections.deque):
+        """Takes the next item, merging the text messages queued right after it into it."""
+
+        item = outbox.popleft()
+        while item.mergeable and outbox and outbox[0].mergeable and \
+                len(item.content) + len(outbox[0].content) < self.MESSAGE_LIMIT:
+            merged = outbox.popleft()
+            item.content += '\n' + merged.content
+            item.futures.extend(merged.futures)
+            self.coalesced += 1
+
+        return item
+
+    async def _deliver(self, channel, item: Outgoing):
+        shown = self._shown.get(item.key) if item.key is not None else None
+        if shown is not None and shown[0] == channel.id:
+            try:
+                await shown[1].edit(content=item.content, embed=item.embed)
+                self.edited += 1
+                return shown[1]
+            except discord.NotFound:
+                # Someone deleted it, post it again.
+                pass
+
+        message = await channel.send(item.content, embed=item.embed)
+        self.sent += 1
+        if item.key is not None and message is not None:
+            self._shown[item.key] = (channel.id, message)
+
+        return message
+
+    def _forget_bucket(self, channel_id: int):
+        # Kept until it has refilled, a burst right after the last one still has to wait.
+        bucket = self._buckets.get(channel_id)
+        if bucket is None or channel_id in self._outboxes:
+            return
 
-        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **cls.FFMPEG_OPTIONS), data=info)
+        if bucket.full:
+            del self._buckets[channel_id]
+        else:
+            asyncio.get_event_loop().call_later(self.burst / self.rate, self._forget_bucket, channel_id)
 
-    @staticmethod
-    def parse_duration(duration: int):
-        minutes, seconds = divmod(duration, 60)
-        hours, minutes = divmod(minutes, 60)
-        days, hours = divmod(hours, 24)
 
-        duration = []
-        if days > 0:
-            duration.append('{} days'.format(days))
-        if hours > 0:
-            duration.append('{} hours'.format(hours))
-        if minutes > 0:
-            duration.append('{} minutes'.format(minutes))
-        if seconds > 0:
-            duration.append('{} seconds'.format(seconds))
+dispatcher = Dispatcher(rate=MUSIC_SEND_RATE, burst=MUSIC_SEND_BURST)
 
-        return ', '.join(duration)
 
+class KeepWarmPolicy:
+    """Decides how long an idle player stays connected to voice, per guild.
 
-class Song:
-    __slots__ = ('source', 'requester')
+    Remembers how long each guild took to queue something again after its
+    queue ran out (whether it was still connected or not). The connection is
+    kept for the ``percentile`` of the last ``history`` returns times
+    ``slack``, within ``minimum`` and ``maximum``. If that many returns took
+    longer than ``maximum``, staying connected mostly waits for nothing, so
+    the guild is disconnected after ``minimum``. Until a guild came back
+    MIN_RETURNS times, it's kept at least ``default`` seconds.
+    """
 
-    def __init__(self, source: YTDLSource):
-        self.source = source
-        self.requester = source.requester
+    MIN_RETURNS = 3
 
-    def create_embed(self):
-        embed = (discord.Embed(title='Now playing',
-                               description='```css\n{0.source.title}\n```'.format(self),
-                               color=discord.Color.blurple())
-                 .add_field(name='Duration', value=self.source.duration)
-                 .add_field(name='Requested by', value=self.requester.mention)
-                 .add_field(name='Uploader', value='[{0.source.uploader}]({0.source.uploader_url})'.format(self))
-                 .add_field(name='URL', value='[Click]({0.source.url})'.format(self))
-                 .set_thumbnail(url=self.source.thumbnail))
+    def __init__(self, *, default: float = 180, minimum: float = 30, maximum: float = 1800, history: int = 20,
+                 percentile: float = 80, slack: float = 1.25, max_guilds: int = 10000):
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.history = history
+        self.percentile = percentile
+        self.slack = slack
+        self.max_guilds = max_guilds
 
-        return embed
+        # guild id -> seconds it took to come back, and when it went idle.
+        self._returns = collections.OrderedDict()
+        self._idle_since = {}
 
+    def idle(self, guild_id: int):
+        self._idle_since[guild_id] = time.monotonic()
 
-class SongQueue(asyncio.Queue):
-    def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
+    def returned(self, guild_id: int):
+        since = self._idle_since.pop(guild_id, None)
+        if since is None:
+            return
 
-    def __iter__(self):
-        return self._queue.__iter__()
+        returns = self._returns.pop(guild_id, None) or collections.deque(maxlen=self.history)
+        returns.append(time.monotonic() - since)
+        self._returns[guild_id] = returns
+        while len(self._returns) > self.max_guilds:
+            forgotten, _ = self._returns.popitem(last=False)
+            self._idle_since.pop(forgotten, None)
 
-    def __len__(self):
-        return self.qsize()
+    def timeout(self, guild_id: int):
+        """Seconds to stay connected once the guild's queue has run out."""
 
-    def clear(self):
-        self._queue.clear()
+        returns = sorted(self._returns.get(guild_id, ()))
+        if not returns:
+            return self.default
 
-    def shuffle(self):
-        random.shuffle(self._queue)
+        gap = returns[min(len(returns) - 1, int(len(returns) * self.percentile / 100))]
+        if gap > self.maximum:
+            keep = self.minimum
+        else:
+            keep = min(self.maximum, max(self.minimum, gap * self.slack))
 
-    def remove(self, index: int):
-        del self._queue[index]
+        if len(returns) < self.MIN_RETURNS:
+            keep = max(keep, self.default)
+
+        return keep
 
 
 class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    # Silence between the end of a song and the start of the next queued one,
+    # labelled by whether the next song was prefetched.
+    gaps = LatencyRecorder()
+
+    # Time from music.play to audio on an idle player, labelled by whether it
+    # was still connected (warm) or had to connect first (cold).
+    first_audio = LatencyRecorder()
+    joins = collections.Counter()
+    keep_warm = KeepWarmPolicy(default=MUSIC_KEEP_WARM, minimum=MUSIC_KEEP_WARM_MIN, maximum=MUSIC_KEEP_WARM_MAX,
+                               max_guilds=MUSIC_MAX_STATES)
+
+    # Refresh prefetched stream URLs that expire within this many seconds.
+    PREFETCH_MARGIN = 15 * 60
+
+    # How much audio the pre-warmed next song buffers before it's needed.
+    PREWARM_FRAMES = 50
+
+    def __init__(self, bot: commands.Bot, guild_id: int):
         self.bot = bot
-        self._ctx = ctx
+        self._ctx = None
+        self.guild_id = guild_id
 
         self.current = None
         self.voice = None
         self.next = asyncio.Event()
-        self.songs = SongQueue()
+        self.songs = SongQueue(fair=MUSIC_QUEUE_FAIR)
 
         self._loop = False
         self._volume = 0.5
+        self._broadcast = MUSIC_BROADCAST
         self.skip_votes = set()
+        self._ended_at = None
+
+        # The next song with its source already running, and the recording
+        # of the current song while looping.
+        self.warmed = None
+        self.recording = None
+        self._skipped = False
+
+        self.prefetcher = None
+        self.prewarmer = None
+        self.last_active = time.monotonic()
+
+        # Set when restored from a snapshot: where to reconnect and where to
+        # resume the first song once the player gets to it.
+        self.resume_channel = None
+        self.resume_at = None
+        self._version = 0
+
+        # One now playing message per guild, edited for every song.
+        self.now_playing_key = ('now playing', guild_id)
+        # When the play command an idle player is waiting for started, and whether it was connected.
+        self._requested = None
+        self._pending = 0
 
         self.audio_player = bot.loop.create_task(self.audio_player_task())
 
     def __del__(self):
         self.audio_player.cancel()
+        self.cancel_prefetch()
+        self.cancel_prewarm()
+        self.discard_recording()
 
     @property
     def loop(self):
@@ -215,6 +2994,7 @@ class VoiceState:
     @loop.setter
     def loop(self, value: bool):
         self._loop = value
+        self._version += 1
 
     @property
     def volume(self):
@@ -223,69 +3003,770 @@ class VoiceState:
     @volume.setter
     def volume(self, value: float):
         self._volume = value
+        self._version += 1
+
+        source = self.current.source if self.current else None
+        if source is None:
+            return
+
+        if not isinstance(source, (YTDLOpusSource, BroadcastSource)):
+            source.volume = value
+        elif self.voice and (self.voice.is_playing() or self.voice.is_paused()):
+            # The volume is baked into the FFmpeg output, so swap in a new
+            # process that continues from the current position.
+            self.current.source = self.voice.source = source.restart(volume=value)
+            source.cleanup()
+            self.discard_recording()
+
+    @property
+    def broadcast(self):
+        return self._broadcast
+
+    @broadcast.setter
+    def broadcast(self, value: bool):
+        self._broadcast = value
+        self._version += 1
 
     @property
     def is_playing(self):
         return self.voice and self.current
 
+    @property
+    def bitrate(self):
+        """Bits per second the voice channel carries, None if not known yet."""
+
+        channel = self.voice.channel if self.voice else self.resume_channel
+        return getattr(channel, 'bitrate', None)
+
+    @property
+    def version(self):
+        """Changes whenever anything a snapshot holds (except the play position) changes."""
+
+        return self._version, self.songs.version, id(self.current)
+
+    def snapshot(self):
+        """Returns what's needed to resume this player after a restart, or None if there's nothing to resume."""
+
+        if self.current is None and not len(self.songs):
+            return None
+
+        source = self.current.source if self.current else None
+        voice = self.voice.channel.id if self.voice else getattr(self.resume_channel, 'id', None)
+        return {
+            'voice_channel': voice,
+            'loop': self.loop,
+            'volume': self._volume,
+            'broadcast': self._broadcast,
+            'current': self.current.to_dict() if self.current else None,
+            'position': getattr(source, 'elapsed', 0.0),
+            'songs': [song.to_dict() for song in self.songs],
+        }
+
+    def restore(self, guild: discord.Guild, data: dict):
+        """Loads a snapshot. Nothing is connected or resolved until the player gets to the first song."""
+
+        self.resume_channel = guild.get_channel(data['voice_channel'])
+        if self.resume_channel is None:
+            return False
+
+        songs = [Song.from_dict(guild, song) for song in [data['current']] + data['songs'] if song]
+        songs = [song for song in songs if song is not None]
+        if not songs:
+            return False
+
+        if data['current'] and songs[0].track.webpage_url == data['current']['track']['webpage_url']:
+            self.resume_at = (songs[0], data['position'])
+
+        self._volume = data['volume']
+        self._loop = data['loop']
+        self._broadcast = data.get('broadcast', MUSIC_BROADCAST)
+        self.songs.extend(songs)
+        return True
+
+    @property
+    def idle(self):
+        return self.audio_player.done() or (not self.current and not len(self.songs))
+
+    @property
+    def warm(self):
+        """Idle, but still connected to voice for the next song."""
+
+        return self.voice is not None and not self.current and not len(self.songs) and not self.audio_player.done()
+
+    @contextlib.contextmanager
+    def request(self):
+        """Wraps a music.play from before it joins. The player doesn't time out meanwhile,
+        and if nothing was playing, the time until its first audio is recorded.
+        """
+
+        if self.current is None and not len(self.songs) and self.resume_channel is None:
+            join = 'warm' if self.voice is not None else 'cold'
+            self._requested = (join, time.perf_counter())
+            self.joins[join] += 1
+
+        self._pending += 1
+        try:
+            yield
+        finally:
+            self._pending -= 1
+            if self.current is None and not len(self.songs):
+                # Nothing was queued, so there's no first audio to time.
+                self._requested = None
+
+    def touch(self, ctx: commands.Context):
+        """Marks the guild as active again. Restarts the player if it had stopped.
+        Returns True if it did.
+        """
+
+        self._ctx = ctx
+        self.last_active = time.monotonic()
+
+        if not self.audio_player.done():
+            return False
+
+        self.current = None
+        self.loop = False
+        self.audio_player = self.bot.loop.create_task(self.audio_player_task())
+        return True
+
     async def audio_player_task(self):
         while True:
             self.next.clear()
 
-            if not self.loop:
-                # Try to get the next song within 3 minutes.
-                # If no song will be added to the queue in time,
-                # the player will disconnect due to performance
-                # reasons.
+            if not self.loop or self.current is None:
+                # Stay connected for a while in case another song is queued,
+                # for as long as this guild usually takes to come back.
+                if not len(self.songs) and self.voice is not None:
+                    self.keep_warm.idle(self.guild_id)
+
                 try:
-                    async with timeout(180):  # 3 minutes
-                        self.current = await self.songs.get()
+                    self.current = await self.next_song()
                 except asyncio.TimeoutError:
+                    await self.stop()
+                    if self._pending:
+                        # A music.play came in while disconnecting.
+                        continue
+                    return
+
+                self.keep_warm.returned(self.guild_id)
+
+            if self.voice is None and self.resume_channel is not None:
+                try:
+                    await self.resume()
+                except (discord.ClientException, asyncio.TimeoutError) as e:
+                    dispatcher.send(self.current.channel, 'Couldn\'t resume playback: {}'.format(e))
                     self.bot.loop.create_task(self.stop())
                     return
 
-            self.current.source.volume = self._volume
+            # The source (and its FFmpeg process) only exists while the song plays.
+            # Looping songs are replayed from their recording when possible.
+            try:
+                with metrics.timed('source'):
+                    self.current.source, label = await self.next_source()
+            except YTDLError as e:
+                dispatcher.send(self.current.channel, 'Couldn\'t play {}: {}'.format(self.current.track, e))
+                self.current = None
+                self.loop = False
+                continue
+
+            self._skipped = False
             self.voice.play(self.current.source, after=self.play_next_song)
-            await self.current.source.channel.send(embed=self.current.create_embed())
+            if label == 'resumed':
+                VoiceStates.resumed(self)
+            if self._requested is not None:
+                join, requested_at = self._requested
+                self._requested = None
+                elapsed = time.perf_counter() - requested_at
+                self.first_audio(join, elapsed)
+                metrics.observe('music_first_audio_seconds', elapsed, join=join)
+            if self._ended_at is not None:
+                gap = time.perf_counter() - self._ended_at
+                self.gaps(label, gap)
+                metrics.observe('music_gap_seconds', gap, source=label)
+                self._ended_at = None
+
+            self.prefetch()
+            self.prewarm()
+            # Until the embed is on Discord, rate limits included.
+            metrics.timed_future('now_playing', dispatcher.show(self.current.channel, self.now_playing_key,
+                                                                embed=self.current.create_embed()))
 
             await self.next.wait()
+            self.last_active = time.monotonic()
+
+            if self.recording is not None:
+                if self._skipped:
+                    self.discard_recording()
+                else:
+                    self.recording.finish()
+
+            if not self.loop:
+                self.current = None
+
+    async def next_song(self):
+        """Waits for a song to be queued, until the guild has been inactive for its keep warm time."""
+
+        while True:
+            # Commands in the guild (like the music.play this may be waiting for) restart the clock.
+            remaining = self.last_active + self.keep_warm.timeout(self.guild_id) - time.monotonic()
+            if remaining <= 0 and not self._pending:
+                raise asyncio.TimeoutError()
+            remaining = max(remaining, 1.0)
+
+            try:
+                async with timeout(remaining):
+                    return await self.songs.get()
+            except asyncio.TimeoutError:
+                continue
+
+    async def next_source(self):
+        """Returns the source for the current song and where it came from (for the gap metric)."""
+
+        warmed, self.warmed = self.warmed, None
+        self.cancel_prewarm()
+
+        resume_at, self.resume_at = self.resume_at, None
+        if resume_at is not None and resume_at[0] is self.current:
+            source = await YTDLSource.create_source(self.current.track, volume=self._volume, position=resume_at[1],
+                                                    bitrate=self.bitrate, loop=self.bot.loop, guild=self.guild_id)
+            return source, 'resumed'
+
+        recording = self.recording
+        if self.loop and recording is not None and recording.complete:
+            if not recording.opus or recording.volume == self._volume:
+                if warmed is not None:
+                    warmed[1].cleanup()
+                return YTDLSource.replay(self.current.track, recording, volume=self._volume), 'replay'
+
+        self.discard_recording()
+
+        if warmed is not None:
+            song, source = warmed
+            # Opus sources have their volume baked in by FFmpeg.
+            if song is self.current and (isinstance(source, YTDLSource) or source.volume == self._volume):
+                source.volume = self._volume
+                label = 'prewarmed'
+            else:
+                source.cleanup()
+                source = None
+        else:
+            source = None
+
+        if source is None and self.broadcast:
+            track = self.current.track
+            if not Broadcast.joinable(track, volume=self._volume):
+                await YTDLSource.ensure_stream(track, loop=self.bot.loop, guild=self.guild_id)
+            source = Broadcast.subscribe(track, volume=self._volume, bitrate=self.bitrate)
+            label = 'broadcast-joined' if source.joined else 'broadcast'
+        elif source is None:
+            label = 'prefetched' if self.current.prefetched else 'cold'
+            source = await YTDLSource.create_source(self.current.track, volume=self._volume, bitrate=self.bitrate,
+                                                    loop=self.bot.loop, guild=self.guild_id)
+
+        YTDLSource.played(self.current.track, loop=self.bot.loop)
+        if self.loop:
+            self.recording = source.record(volume=self._volume)
+
+        return source, label
 
     def play_next_song(self, error=None):
         if error:
-            raise VoiceError(str(error))
+            # Raising here would only end the player thread, the song still has to end.
+            metrics.inc('music_voice_errors_total')
+            print('Player error in guild {}: {!r}'.format(self.guild_id, error))
+
+        # Only a gap if something was waiting to be played.
+        if len(self.songs) or self.loop:
+            self._ended_at = time.perf_counter()
+
+        # Called from the voice client's player thread.
+        self.bot.loop.call_soon_threadsafe(self.next.set)
+
+    def prefetch(self):
+        """(Re)starts resolving the upcoming songs. A prefetch already running is cancelled first,
+        so call this whenever the upcoming songs change.
+        """
 
-        self.next.set()
+        self.cancel_prefetch()
+        if MUSIC_PREFETCH > 0 and len(self.songs):
+            self.prefetcher = self.bot.loop.create_task(self.prefetch_task())
+
+    def cancel_prefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+
+    async def prefetch_task(self):
+        for song in self.songs[:MUSIC_PREFETCH]:
+            track = song.track
+            if song.prefetched and not track.expires_within(self.PREFETCH_MARGIN):
+                continue
+
+            try:
+                if track.expires_within(self.PREFETCH_MARGIN):
+                    await YTDLSource.refresh_track(track, loop=self.bot.loop, guild=self.guild_id)
+
+                if not await YTDLSource.probe(track, loop=self.bot.loop):
+                    # Revoked before its advertised expiry, get a new one.
+                    await YTDLSource.refresh_track(track, loop=self.bot.loop, guild=self.guild_id)
+            except ExtractorBusy:
+                continue
+            except YTDLError as e:
+                if not track.resolved and not is_transient(e.__cause__ or e):
+                    # A playlist entry that's gone (removed, private, ...), it won't come back.
+                    if self.drop(song):
+                        dispatcher.send(song.channel, 'Couldn\'t play {}: {}'.format(track, e))
+                        continue
+
+                # The player reports the error when it gets to this song.
+                continue
+
+            song.prefetched = True
+
+    def drop(self, song: Song):
+        """Removes ``song`` from the queue. Returns False if it isn't queued anymore."""
+
+        for index, queued in enumerate(self.songs):
+            if queued is song:
+                self.songs.remove(index)
+                return True
+
+        return False
+
+    def prewarm(self):
+        self.cancel_prewarm()
+        # Broadcasts are joined live, there is nothing to warm up.
+        if MUSIC_PREWARM > 0 and not self.broadcast:
+            self.prewarmer = self.bot.loop.create_task(self.prewarm_task())
+
+    def cancel_prewarm(self, *, discard: bool = False):
+        if self.prewarmer is not None:
+            self.prewarmer.cancel()
+            self.prewarmer = None
+
+        if discard and self.warmed is not None:
+            self.warmed[1].cleanup()
+            self.warmed = None
+
+    def discard_recording(self):
+        if self.recording is not None:
+            self.recording.close()
+            self.recording = None
+
+    async def prewarm_task(self):
+        """Starts the next song's source a few seconds before the current one ends,
+        so the player can switch over without waiting for FFmpeg to connect and buffer.
+        """
+
+        current = self.current
+        duration = current.track.duration
+        if not duration:
+            # Live streams don't end on their own.
+            return
+
+        # Sleep until we're close to the end, rechecking in case the song was paused.
+        while True:
+            remaining = duration - current.source.elapsed
+            if remaining <= MUSIC_PREWARM:
+                break
+
+            await asyncio.sleep(remaining - MUSIC_PREWARM)
+
+        while True:
+            if self.loop:
+                if self.recording is not None:
+                    # Will be replayed from the recording.
+                    return
+                song = current
+            else:
+                song = self.songs[0] if len(self.songs) else None
+
+            if song is not None:
+                break
+
+            await asyncio.sleep(1)
+
+        try:
+            source = await YTDLSource.create_source(song.track, volume=self._volume, bitrate=self.bitrate,
+                                                    loop=self.bot.loop, guild=self.guild_id)
+        except YTDLError:
+            return
+
+        self.warmed = (song, source)
+        await source.prebuffer(self.PREWARM_FRAMES, loop=self.bot.loop)
 
     def skip(self):
         self.skip_votes.clear()
 
         if self.is_playing:
+            self._skipped = True
+            self.cancel_prefetch()
             self.voice.stop()
 
+    async def resume(self):
+        """Reconnects to the voice channel of a restored player. Only a few guilds do this at once."""
+
+        async with VoiceStates.resume_slots:
+            with metrics.timed('voice_connect'):
+                self.voice = await self.resume_channel.connect()
+            self.resume_channel = None
+
     async def stop(self):
+        self.resume_channel = None
+        self.resume_at = None
+        self.cancel_prefetch()
+        self.cancel_prewarm(discard=True)
+        self.discard_recording()
         self.songs.clear()
 
         if self.voice:
             await self.voice.disconnect()
             self.voice = None
 
+    async def close(self):
+        """Stops the player for good, releasing everything it holds."""
+
+        await self.stop()
+        self.audio_player.cancel()
+        self.current = None
+        dispatcher.forget(self.now_playing_key)
+
+
+class SnapshotStore:
+    """Keeps the latest snapshot of every guild's player in sqlite.
+
+    Only players whose queue, current song, loop or volume changed (or whose
+    position moved on by more than POSITION_DRIFT seconds) are rewritten.
+    """
+
+    POSITION_DRIFT = 30
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS voice_snapshots ('
+                         'guild_id INTEGER PRIMARY KEY, data TEXT NOT NULL, saved_at REAL NOT NULL)')
+        self._db.commit()
+        # guild id -> (version, position) of what was written last.
+        self._saved = {}
+
+    def load(self):
+        return {guild_id: json.loads(data)
+                for guild_id, data in self._db.execute('SELECT guild_id, data FROM voice_snapshots')}
+
+    def changes(self, states: dict):
+        """Returns {guild_id: snapshot or None (delete)} for the states that need writing."""
+
+        changes = {}
+        for guild_id, state in states.items():
+            saved = self._saved.get(guild_id)
+            version = state.version
+            if saved is not None and saved[0] == version:
+                source = state.current.source if state.current else None
+                if abs(getattr(source, 'elapsed', 0.0) - saved[1]) < self.POSITION_DRIFT:
+                    continue
+
+            snapshot = state.snapshot()
+            if snapshot is None and saved is None:
+                continue
+
+            changes[guild_id] = snapshot
+            self._saved[guild_id] = (version, snapshot['position'] if snapshot else 0.0)
+
+        for guild_id in set(self._saved) - set(states):
+            changes[guild_id] = None
+            del self._saved[guild_id]
+
+        return changes
+
+    def write(self, changes: dict):
+        now = time.time()
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO voice_snapshots VALUES (?, ?, ?)',
+                                 [(guild_id, json.dumps(data), now)
+                                  for guild_id, data in changes.items() if data is not None])
+            self._db.executemany('DELETE FROM voice_snapshots WHERE guild_id = ?',
+                                 [(guild_id,) for guild_id, data in changes.items() if data is None])
+
+
+class VoiceStates:
+    """The VoiceState of every guild the bot plays music in.
+
+    States that have been idle for ``idle_timeout`` seconds are closed and
+    dropped by :meth:`reap_task`. Never more than ``max_states`` are tracked:
+    the least recently used idle ones make room for new guilds. With a
+    SnapshotStore, :meth:`snapshot_task` saves the states that changed, and
+    :meth:`restore` brings them back after a restart.
+    """
+
+    resume_slots = asyncio.Semaphore(MUSIC_RESUME_CONCURRENCY)
+
+    # Seconds from process start until the first restored guild played audio.
+    first_resume = None
+    resumed_count = 0
+
+    def __init__(self, bot: commands.Bot, *, idle_timeout: float = 600, max_states: int = 10000,
+                 interval: float = 60, store: 'SnapshotStore' = None):
+        self.bot = bot
+        self.idle_timeout = idle_timeout
+        self.max_states = max_states
+        self.interval = interval
+        self.store = store
+        self.restored = False
+
+        self.reaped = 0
+        self.restarted = 0
+        self._states = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    def values(self):
+        return list(self._states.values())
+
+    def get(self, ctx: commands.Context):
+        state = self._states.get(ctx.guild.id)
+        if state is None:
+            self._make_room()
+            state = self._states[ctx.guild.id] = VoiceState(self.bot, ctx.guild.id)
+            state.touch(ctx)
+        else:
+            self._states.move_to_end(ctx.guild.id)
+            if state.touch(ctx):
+                self.restarted += 1
+
+        return state
+
+    async def remove(self, guild_id: int):
+        state = self._states.pop(guild_id, None)
+        if state is not None:
+            await state.close()
+
+    async def reap(self):
+        now = time.monotonic()
+        for guild_id, state in list(self._states.items()):
+            # Warm players disconnect on their own once their guild's keep warm time is up.
+            if state.idle and not state.warm and now - state.last_active >= self.idle_timeout:
+                await self.remove(guild_id)
+                self.reaped += 1
+
+    async def reap_task(self):
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.reap()
+
+    async def snapshot_task(self, interval: float):
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(interval)
+            await self.snapshot()
+
+    async def snapshot(self):
+        changes = self.store.changes(self._states)
+        if changes:
+            await self.bot.loop.run_in_executor(None, self.store.write, changes)
+
+    def restore(self):
+        """Recreates the players saved before the last restart. They reconnect lazily, see VoiceState.resume."""
+
+        if self.restored or self.store is None:
+            return 0
+
+        self.restored = True
+        gone = []
+        for guild_id, data in self.store.load().items():
+            if not self.owns(guild_id):
+                # Another worker's.
+                continue
+
+            guild = self.bot.get_guild(guild_id)
+            state = VoiceState(self.bot, guild_id)
+            if guild is None or guild_id in self._states or not state.restore(guild, data):
+                state.audio_player.cancel()
+                gone.append(guild_id)
+                continue
+
+            self._states[guild_id] = state
+
+        self.store.write({guild_id: None for guild_id in gone})
+        return len(self._states)
+
+    def owns(self, guild_id: int):
+        """Whether ``guild_id`` is on one of the shards this process runs."""
+
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if not shard_ids or not self.bot.shard_count:
+            return True
+
+        return (guild_id >> 22) % self.bot.shard_count in shard_ids
+
+    @classmethod
+    def resumed(cls, state: VoiceState):
+        cls.resumed_count += 1
+        if cls.first_resume is None:
+            cls.first_resume = process_age()
+            if cls.first_resume is not None:
+                print('Resumed audio {:.1f}s after start'.format(cls.first_resume))
+
+    def stats(self):
+        idle = sum(1 for state in self._states.values() if state.idle)
+        return {
+            'tracked': len(self._states),
+            'max': self.max_states,
+            'live': len(self._states) - idle,
+            'idle': idle,
+            'warm': sum(1 for state in self._states.values() if state.warm),
+            'reaped': self.reaped,
+            'restarted': self.restarted,
+            'resumed': self.resumed_count,
+            'first_resume': self.first_resume,
+        }
+
+    def _make_room(self):
+        while len(self._states) >= self.max_states:
+            guild_id = next((guild_id for guild_id, state in self._states.items() if state.idle), None)
+            if guild_id is None:
+                # Everyone is playing, don't cut anybody off.
+                return
+
+            self.bot.loop.create_task(self._states.pop(guild_id).close())
+            self.reaped += 1
+
+
+class MusicContext(commands.Context):
+    """Sends replies through the dispatcher, so they're rate limited and merged per channel."""
+
+    async def send(self, content=None, *, embed: discord.Embed = None, **kwargs):
+        if kwargs:
+            return await super().send(content, embed=embed, **kwargs)
+
+        return await dispatcher.send(self.channel, str(content) if content is not None else None, embed=embed)
+
+
+class MusicBot(commands.Bot):
+    async def get_context(self, message: discord.Message, *, cls=MusicContext):
+        return await super().get_context(message, cls=cls)
+
+    async def login(self, *args, **kwargs):
+        startup.mark('run')
+        await super().login(*args, **kwargs)
+        startup.mark('login')
+
+
+class ShardedMusicBot(MusicBot, commands.AutoShardedBot):
+    """The bot of one worker process, running the shards the Supervisor gave it."""
+
 
 class Music(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.voice_states = {}
+        self.voice_states = VoiceStates(bot, idle_timeout=MUSIC_IDLE_REAP, max_states=MUSIC_MAX_STATES,
+                                        store=SnapshotStore(MUSIC_DB_PATH))
+        # Background tasks, see start_tasks.
+        self.reaper = None
+        self.snapshotter = None
+        self.metrics_server = None
+
+        self.register_metrics()
+
+    def start_tasks(self):
+        """Starts the background tasks once the bot runs (on_ready, or the first command
+        if that comes first), not when the cog is created on import.
+        """
 
-    def get_voice_state(self, ctx: commands.Context):
-        state = self.voice_states.get(ctx.guild.id)
-        if not state:
-            state = VoiceState(self.bot, ctx)
-            self.voice_states[ctx.guild.id] = state
+        if self.reaper is not None:
+            return
 
-        return state
+        self.reaper = self.bot.loop.create_task(self.voice_states.reap_task())
+        self.snapshotter = self.bot.loop.create_task(self.voice_states.snapshot_task(MUSIC_SNAPSHOT_INTERVAL))
+        if MUSIC_METRICS_PORT:
+            self.metrics_server = self.bot.loop.create_task(metrics.serve(MUSIC_METRICS_HOST, MUSIC_METRICS_PORT))
+
+    def register_metrics(self):
+        states = self.voice_states
+        engine = YTDLSource.engine
+        cache = YTDLSource.cache
+        audio_cache = YTDLSource.audio_cache
+
+        metrics.register('music_ffmpeg_processes', 'gauge', 'Live FFmpeg processes.',
+                         lambda: StreamStats.ffmpeg_sources)
+        metrics.register('music_broadcasts', 'gauge', 'Live broadcasts.',
+                         lambda: len(Broadcast.live))
+        metrics.register('music_broadcast_subscribers', 'gauge', 'Guilds playing a broadcast.',
+                         lambda: sum(broadcast.subscribers for broadcast in list(Broadcast.live.values())))
+        metrics.register('music_queued_songs', 'gauge', 'Songs waiting in all queues.',
+                         lambda: sum(len(state.songs) for state in states.values()))
+        metrics.register('music_queue_depth_max', 'gauge', 'Songs waiting in the longest queue.',
+                         lambda: max((len(state.songs) for state in states.values()), default=0))
+        metrics.register('music_players', 'gauge', 'Guild players, by state.',
+                         lambda: {key: states.stats()[key] for key in ('live', 'idle', 'warm')}, label='state')
+        metrics.register('music_voice_joins_total', 'counter',
+                         'Play requests on idle players, by join: warm ones skipped the voice handshake.',
+                         lambda: dict(VoiceState.joins), label='join')
+        metrics.register('music_players_reaped_total', 'counter', 'Idle players closed.',
+                         lambda: states.reaped)
+        metrics.register('music_extractions', 'gauge', 'Extractions running or waiting for a worker.',
+                         lambda: {'active': engine._active, 'pending': engine._pending}, label='state')
+        metrics.register('music_extractions_total', 'counter', 'Extractions finished.',
+                         lambda: engine.completed)
+        metrics.register('music_extraction_requests_total', 'counter',
+                         'Resolutions asked for, by kind (query or page).',
+                         lambda: dict(YTDLSource.inflight.calls), label='kind')
+        metrics.register('music_extractor_circuit', 'gauge', 'State of the extractor circuit breaker.',
+                         lambda: {state: int(YTDLSource.breaker.state == state)
+                                  for state in ('closed', 'open', 'half-open')}, label='state')
+        metrics.register('music_extractor_circuit_trips_total', 'counter', 'Times the circuit breaker opened.',
+                         lambda: YTDLSource.breaker.trips)
+        metrics.register('music_extraction_coalesced_total', 'counter',
+                         'Resolutions that shared an extraction already in flight, by kind.',
+                         lambda: dict(YTDLSource.inflight.shared), label='kind')
+        metrics.register('music_extraction_cache_lookups_total', 'counter', 'Extraction cache lookups, by result.',
+                         lambda: {'hit': cache.hits, 'miss': cache.misses}, label='result')
+        metrics.register('music_library_lookups_total', 'counter', 'Searches looked up in the local library, by result.',
+                         lambda: {'hit': YTDLSource.library.hits, 'miss': YTDLSource.library.misses}, label='result')
+        metrics.register('music_audio_cache_plays_total', 'counter', 'Plays of cacheable tracks, by result.',
+                         lambda: {'hit': audio_cache.hits, 'miss': audio_cache.misses}, label='result')
+        metrics.register('music_audio_cache_saved_bytes_total', 'counter', 'Bytes played from the audio cache.',
+                         lambda: audio_cache.bytes_saved)
+        metrics.register('music_startup_seconds', 'gauge', 'Time each phase of starting up took.',
+                         lambda: dict(startup.phases), label='phase')
+        metrics.register('music_messages_total', 'counter', 'Chat messages sent and edited.',
+                         lambda: {'send': dispatcher.sent, 'edit': dispatcher.edited}, label='kind')
+        metrics.register('music_messages_coalesced_total', 'counter',
+                         'Chat messages merged into another one or superseded before they were sent.',
+                         lambda: dispatcher.coalesced)
+        metrics.register('music_messages_queued', 'gauge', 'Chat messages waiting for their channel\'s rate limit.',
+                         lambda: len(dispatcher))
+        metrics.register('music_stream_bytes_total', 'counter',
+                         'Bytes streamed from the origin (estimated from the format bitrate), by codec.',
+                         lambda: dict(StreamStats.stream_bytes), label='acodec')
+        metrics.register('music_ffmpeg_cpu_seconds_total', 'counter', 'CPU seconds FFmpeg spent, by codec decoded.',
+                         lambda: dict(StreamStats.decode_cpu), label='acodec')
+        metrics.register('music_gateway_latency_seconds', 'gauge', 'Gateway heartbeat latency, by shard.',
+                         lambda: {str(shard_id): latency for shard_id, latency in
+                                  getattr(self.bot, 'latencies', [(0, self.bot.latency)])}, label='shard')
+
+    def get_voice_state(self, ctx: commands.Context):
+        return self.voice_states.get(ctx)
 
     def cog_unload(self):
+        for task in (self.reaper, self.snapshotter, self.metrics_server):
+            if task is not None:
+                task.cancel()
         for state in self.voice_states.values():
-            self.bot.loop.create_task(state.stop())
+            self.bot.loop.create_task(state.close())
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        restored = self.voice_states.restore()
+        if restored:
+            print('Restored {} players'.format(restored))
+        self.start_tasks()
+
+        if YTDL_LOAD == 'warm' and not YTDLSource.ytdl.loaded:
+            # Off the event loop, the first play finds everything loaded (or waits for the load to finish).
+            await self.bot.loop.run_in_executor(None, YTDLSource.load)
+            print('youtube_dl loaded in {:.2f}s'.format(LazyExtractor.load_seconds))
 
     def cog_check(self, ctx: commands.Context):
         if not ctx.guild:
@@ -294,6 +3775,7 @@ class Music(commands.Cog):
         return True
 
     async def cog_before_invoke(self, ctx: commands.Context):
+        self.start_tasks()
         ctx.voice_state = self.get_voice_state(ctx)
 
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
@@ -308,7 +3790,8 @@ class Music(commands.Cog):
             await ctx.voice_state.voice.move_to(destination)
             return
 
-        ctx.voice_state.voice = await destination.connect()
+        with metrics.timed('voice_connect'):
+            ctx.voice_state.voice = await destination.connect()
 
     @commands.command(name='summon')
     @commands.has_permissions(manage_guild=True)
@@ -318,6 +3801,7 @@ class Music(commands.Cog):
         """
 
         if not channel and not ctx.author.voice:
+            metrics.inc('music_voice_errors_total')
             raise VoiceError('You are neither connected to a voice channel nor specified a channel to join.')
 
         destination = channel or ctx.author.voice.channel
@@ -325,7 +3809,8 @@ class Music(commands.Cog):
             await ctx.voice_state.voice.move_to(destination)
             return
 
-        ctx.voice_state.voice = await destination.connect()
+        with metrics.timed('voice_connect'):
+            ctx.voice_state.voice = await destination.connect()
 
     @commands.command(name='leave', aliases=['disconnect'])
     @commands.has_permissions(manage_guild=True)
@@ -335,8 +3820,7 @@ class Music(commands.Cog):
         if not ctx.voice_state.voice:
             return await ctx.send('Not connected to any voice channel.')
 
-        await ctx.voice_state.stop()
-        del self.voice_states[ctx.guild.id]
+        await self.voice_states.remove(ctx.guild.id)
 
     @commands.command(name='volume')
     async def _volume(self, ctx: commands.Context, *, volume: int):
@@ -355,6 +3839,9 @@ class Music(commands.Cog):
     async def _now(self, ctx: commands.Context):
         """Displays the currently playing song."""
 
+        if not ctx.voice_state.current:
+            return await ctx.send('Nothing being played at the moment.')
+
         await ctx.send(embed=ctx.voice_state.current.create_embed())
 
     @commands.command(name='pause')
@@ -380,6 +3867,8 @@ class Music(commands.Cog):
     async def _stop(self, ctx: commands.Context):
         """Stops playing song and clears the queue."""
 
+        ctx.voice_state.cancel_prefetch()
+        ctx.voice_state.cancel_prewarm(discard=True)
         ctx.voice_state.songs.clear()
 
         if ctx.voice_state.is_playing:
@@ -396,7 +3885,7 @@ class Music(commands.Cog):
             return await ctx.send('Not playing any music right now...')
 
         voter = ctx.message.author
-        if voter == ctx.voice_state.current.requester:
+        if voter.id == ctx.voice_state.current.requester.id:
             await ctx.message.add_reaction('⏭')
             ctx.voice_state.skip()
 
@@ -425,17 +3914,28 @@ class Music(commands.Cog):
         items_per_page = 10
         pages = math.ceil(len(ctx.voice_state.songs) / items_per_page)
 
-        start = (page - 1) * items_per_page
-        end = start + items_per_page
-
-        queue = ''
-        for i, song in enumerate(ctx.voice_state.songs[start:end], start=start):
-            queue += '`{0}.` [**{1.source.title}**]({1.source.url})\n'.format(i + 1, song)
-
+        queue = ctx.voice_state.songs.page(page, items_per_page)
         embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(len(ctx.voice_state.songs), queue))
                  .set_footer(text='Viewing page {}/{}'.format(page, pages)))
         await ctx.send(embed=embed)
 
+    @commands.command(name='search')
+    async def _search(self, ctx: commands.Context, *, query: str):
+        """Lists the songs played before that best match a search."""
+
+        rows = YTDLSource.library.search(query, limit=10)
+        if not rows:
+            return await ctx.send('Nothing like `{}` has been played before.'.format(query))
+
+        results = ''
+        for i, (webpage_url, title, uploader, duration, plays) in enumerate(rows, start=1):
+            results += '`{}.` [**{}**]({}) by {} ({}), played {} times\n'.format(
+                i, title, webpage_url, uploader, YTDLSource.parse_duration(duration or 0) or 'live', plays)
+
+        embed = (discord.Embed(description='**Local matches for `{}`:**\n\n{}'.format(query, results))
+                 .set_footer(text='Play one with music.play <link>'))
+        await ctx.send(embed=embed)
+
     @commands.command(name='shuffle')
     async def _shuffle(self, ctx: commands.Context):
         """Shuffles the queue."""
@@ -444,6 +3944,7 @@ class Music(commands.Cog):
             return await ctx.send('Empty queue.')
 
         ctx.voice_state.songs.shuffle()
+        ctx.voice_state.prefetch()
         await ctx.message.add_reaction('✅')
 
     @commands.command(name='remove')
@@ -454,8 +3955,31 @@ class Music(commands.Cog):
             return await ctx.send('Empty queue.')
 
         ctx.voice_state.songs.remove(index - 1)
+        ctx.voice_state.prefetch()
+        await ctx.message.add_reaction('✅')
+
+    @commands.command(name='move')
+    async def _move(self, ctx: commands.Context, index: int, destination: int):
+        """Moves a song in the queue from one position to another."""
+
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send('Empty queue.')
+
+        ctx.voice_state.songs.move(index - 1, destination - 1)
+        ctx.voice_state.prefetch()
         await ctx.message.add_reaction('✅')
 
+    @commands.command(name='fair')
+    async def _fair(self, ctx: commands.Context):
+        """Toggles round-robin ordering of the queue by requester.
+        Invoke this command again to go back to first come, first served.
+        """
+
+        ctx.voice_state.songs.set_fair(not ctx.voice_state.songs.fair)
+        ctx.voice_state.prefetch()
+        await ctx.send('Queue is now {}.'.format('fair (round-robin by requester)' if ctx.voice_state.songs.fair
+                                                 else 'first come, first served'))
+
     @commands.command(name='loop')
     async def _loop(self, ctx: commands.Context):
         """Loops the currently playing song.
@@ -469,6 +3993,149 @@ class Music(commands.Cog):
         ctx.voice_state.loop = not ctx.voice_state.loop
         await ctx.message.add_reaction('✅')
 
+    @commands.command(name='broadcast')
+    async def _broadcast(self, ctx: commands.Context, enabled: bool = None):
+        """Shares playback with other servers playing the same song.
+        Songs that are already playing somewhere are joined at the live position
+        instead of starting from the beginning. Takes effect from the next song.
+        Invoke this command again to turn it off.
+        """
+
+        ctx.voice_state.broadcast = not ctx.voice_state.broadcast if enabled is None else enabled
+        subscribers = sum(broadcast.subscribers for broadcast in list(Broadcast.live.values()))
+        await ctx.send('Broadcast mode is **{}**. **{}** broadcasts are live with **{}** listening servers.'.format(
+            'on' if ctx.voice_state.broadcast else 'off', len(Broadcast.live), subscribers))
+
+    @commands.command(name='cache')
+    async def _cache(self, ctx: commands.Context):
+        """Shows the extraction cache, audio cache and library statistics."""
+
+        stats = YTDLSource.cache.stats()
+        audio = YTDLSource.audio_cache.stats()
+        await ctx.send('Extraction cache: **{entries}/{capacity}** entries, **{hits}** hits, **{misses}** misses '
+                       '({hit_ratio:.0%}), **{stream_refreshes}** stream refreshes\n'.format(**stats) +
+                       'Audio cache: **{files}** files, **{size_mb:.0f}/{max_mb:.0f} MB**, **{hits}** hits, '
+                       '**{misses}** misses ({hit_ratio:.0%}), **{saved_mb:.1f} MB** saved, **{downloading}** '
+                       'downloading'.format(size_mb=audio['size'] / 2 ** 20, max_mb=audio['max_size'] / 2 ** 20,
+                                            saved_mb=audio['bytes_saved'] / 2 ** 20, **audio) +
+                       '\nLibrary: **{tracks}** tracks, **{hits}** searches answered locally, **{misses}** searched '
+                       'online ({hit_ratio:.0%})'.format(**YTDLSource.library.stats()))
+
+    @commands.command(name='latency')
+    async def _latency(self, ctx: commands.Context):
+        """Shows the enqueue latency per resolution path and the gaps between songs."""
+
+        summary = YTDLSource.latency.summary()
+        if not summary:
+            return await ctx.send('Nothing has been enqueued yet.')
+
+        lines = ['`{:<9}` {} requests, median **{:.0f} ms**, p90 **{:.0f} ms**, p99 **{:.0f} ms**'.format(
+                 label, values['count'], values['p50'] * 1000, values['p90'] * 1000, values['p99'] * 1000)
+                 for label, values in sorted(summary.items())]
+        lines.extend('`gap/{:<10}` {} transitions, median **{:.0f} ms**, p90 **{:.0f} ms**'.format(
+                     label, values['count'], values['p50'] * 1000, values['p90'] * 1000)
+                     for label, values in sorted(VoiceState.gaps.summary().items()))
+        lines.extend('`first/{:<8}` {} joins, median **{:.0f} ms**, p90 **{:.0f} ms**'.format(
+                     label, values['count'], values['p50'] * 1000, values['p90'] * 1000)
+                     for label, values in sorted(VoiceState.first_audio.summary().items()) if label != 'all')
+        lines.append('Voice kept warm here for **{:.0f}s** after the queue runs out'.format(
+            VoiceState.keep_warm.timeout(ctx.guild.id)))
+        await ctx.send('\n'.join(lines))
+
+    @commands.command(name='extractors')
+    async def _extractors(self, ctx: commands.Context):
+        """Shows the extraction pool queue depth and wait times."""
+
+        stats = YTDLSource.engine.stats()
+        wait = ', '.join('{:.0f} ms'.format(stats[key] * 1000) if stats[key] is not None else '-'
+                         for key in ('wait_p50', 'wait_p90'))
+        await ctx.send('Extraction pool ({pool}): **{active}/{workers}** busy, **{pending}/{backlog}** waiting '
+                       'across **{guild_count}** guilds, **{completed}** done, **{rejected}** rejected, '
+                       'wait p50/p90: {wait}\n'.format(guild_count=len(stats['guilds']), wait=wait, **stats) +
+                       'Coalescing: **{in_flight}** in flight, **{coalesced}/{requests}** requests shared an '
+                       'extraction ({dedup_rate:.0%})\n'.format(**YTDLSource.inflight.stats()) +
+                       'Circuit breaker: **{}**, **{}** failures in a row, opened **{}** times'.format(
+                           YTDLSource.breaker.state, YTDLSource.breaker.failures, YTDLSource.breaker.trips))
+
+    @commands.command(name='cpu')
+    async def _cpu(self, ctx: commands.Context):
+        """Shows how much CPU a stream costs in each playback mode, and what each codec streams and costs FFmpeg."""
+
+        lines = ['Playback mode: **{}**, live sources: **{}**'.format(MUSIC_PLAYBACK, StreamStats.live_sources)]
+        for mode in ('pcm', 'opus'):
+            total = StreamStats.cpu_usage.median(mode)
+            python = StreamStats.cpu_usage.median(mode + '-python')
+            if python is None:
+                continue
+
+            lines.append('`{:<4}` median per stream: **{}** total, **{:.1%}** in the bot process'.format(
+                mode, '{:.1%}'.format(total) if total is not None else '-', python))
+
+        lines.append('Stream format: **{}**'.format(MUSIC_FORMAT))
+        for acodec, samples in sorted(StreamStats.track_bytes.samples.items()):
+            if acodec == 'all':
+                continue
+
+            ffmpeg = StreamStats.cpu_usage.median('ffmpeg-' + acodec)
+            lines.append('`{:<4}` {} tracks, median **{:.0f} kB** streamed per track, FFmpeg **{}** per stream'.format(
+                acodec, len(samples), StreamStats.track_bytes.median(acodec) / 1000,
+                '{:.1%}'.format(ffmpeg) if ffmpeg is not None else '-'))
+
+        await ctx.send('\n'.join(lines))
+
+    @commands.command(name='states')
+    async def _states(self, ctx: commands.Context):
+        """Shows how many guild players are live, idle or were reaped."""
+
+        stats = self.voice_states.stats()
+        first_resume = '{:.1f}s'.format(stats['first_resume']) if stats['first_resume'] is not None else '-'
+        content = ('Players: **{tracked}/{max}** tracked, **{live}** live, **{idle}** idle '
+                   '(**{warm}** still connected), **{reaped}** reaped, **{restarted}** restarted, **{resumed}** resumed after restart '
+                   '(first audio after {first})'.format(first=first_resume, **stats))
+        if MUSIC_SHARD_IDS:
+            content += '\nShards: **{}** of **{}** in this process (pid {})'.format(
+                ', '.join(str(shard_id) for shard_id in MUSIC_SHARD_IDS), MUSIC_SHARD_COUNT, os.getpid())
+        await ctx.send(content)
+
+    @commands.command(name='startup')
+    async def _startup(self, ctx: commands.Context):
+        """Shows how long starting up took, phase by phase."""
+
+        await ctx.send(startup.report())
+
+    @commands.command(name='stats')
+    async def _stats(self, ctx: commands.Context):
+        """Shows where the time goes, what failed and what's running."""
+
+        lines = []
+        for stage, samples in sorted(metrics.stages.samples.items()):
+            if stage == 'all':
+                continue
+
+            lines.append('`{:<14}` {} times, median **{:.0f} ms**, p90 **{:.0f} ms**, p99 **{:.0f} ms**'.format(
+                stage, len(samples), metrics.stages.percentile(50, stage) * 1000,
+                metrics.stages.percentile(90, stage) * 1000, metrics.stages.percentile(99, stage) * 1000))
+
+        failures = ', '.join('{} {}'.format(count, dict(labels)['reason'])
+                             for (name, labels), count in sorted(metrics.counters.items())
+                             if name == 'music_extraction_failures_total')
+        lines.append('Extraction failures: {}, voice errors: **{}**'.format(
+            failures or 'none', metrics.counters['music_voice_errors_total', ()]))
+
+        collected = metrics.collect()
+        gauge = (lambda name: ', '.join('{} {}'.format(labels[0][1], value) if labels else str(value)
+                                        for labels, value in collected[name][2]))
+        lines.append('FFmpeg processes: **{}**, queued songs: **{}** (longest queue **{}**), players: {}, '
+                     'extractions: {}'.format(gauge('music_ffmpeg_processes'), gauge('music_queued_songs'),
+                                              gauge('music_queue_depth_max'), gauge('music_players'),
+                                              gauge('music_extractions')))
+        lines.append('Messages: **{sent}** sent, **{edited}** edits, **{coalesced}** merged or superseded, '
+                     '**{queued}** queued in **{channels}** channels, **{failed}** failed'.format(**dispatcher.stats()))
+        if MUSIC_METRICS_PORT:
+            lines.append('Prometheus metrics: `http://{}:{}/metrics`'.format(MUSIC_METRICS_HOST, MUSIC_METRICS_PORT))
+
+        await ctx.send('\n'.join(lines))
+
     @commands.command(name='play')
     async def _play(self, ctx: commands.Context, *, search: str):
         """Plays a song.
@@ -476,21 +4143,59 @@ class Music(commands.Cog):
         other songs finished playing.
         This command automatically searches from various sites if no URL is provided.
         A list of these sites can be found here: https://rg3.github.io/youtube-dl/supportedsites.html
+        Searches matching a song played before play it right away, start the search
+        with ! to search online anyway.
+        Playlist links queue every song of the playlist.
         """
 
-        if not ctx.voice_state.voice:
-            await ctx.invoke(self._join)
+        # The player stays connected until this is done, even past its keep warm time.
+        with ctx.voice_state.request():
+            if not ctx.voice_state.voice or ctx.voice_state.voice.channel != ctx.author.voice.channel:
+                await ctx.invoke(self._join)
 
+            if YTDLSource.is_playlist(search):
+                await self._enqueue_playlist(ctx, search)
+            else:
+                await self._enqueue(ctx, search)
+
+    async def _enqueue(self, ctx: commands.Context, search: str):
         async with ctx.typing():
             try:
-                source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop)
+                track = await YTDLSource.create_track(ctx, search, loop=self.bot.loop)
+            except ExtractorBusy as e:
+                await ctx.send(str(e))
             except YTDLError as e:
                 await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
             else:
-                song = Song(source)
+                if MUSIC_QUEUE_DEDUPE and ctx.voice_state.songs.has(track.webpage_url):
+                    position = ctx.voice_state.songs.index(track.webpage_url) + 1
+                    return await ctx.send('{} is already in the queue at position {}.'.format(track, position))
+
+                song = Song(track, ctx.author, ctx.channel)
 
                 await ctx.voice_state.songs.put(song)
-                await ctx.send('Enqueued {}'.format(str(source)))
+                if ctx.voice_state.current is not None:
+                    ctx.voice_state.prefetch()
+                await ctx.send('Enqueued {}'.format(str(track)))
+
+    async def _enqueue_playlist(self, ctx: commands.Context, url: str):
+        async with ctx.typing():
+            try:
+                tracks = await YTDLSource.create_playlist(ctx, url, loop=self.bot.loop)
+            except ExtractorBusy as e:
+                return await ctx.send(str(e))
+            except YTDLError as e:
+                return await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+
+            songs = ctx.voice_state.songs
+            if MUSIC_QUEUE_DEDUPE:
+                tracks = (track for track in tracks if not songs.has(track.webpage_url))
+
+            queued = len(songs)
+            songs.extend(Song(track, ctx.author, ctx.channel) for track in tracks)
+            # Resolves the first few now, the rest as playback gets to them.
+            ctx.voice_state.prefetch()
+            await ctx.send('Enqueued **{}** songs from the playlist'.format(len(songs) - queued))
 
     @_join.before_invoke
     @_play.before_invoke
@@ -499,125 +4204,61 @@ class Music(commands.Cog):
             raise commands.CommandError('You are not connected to any voice channel.')
 
         if ctx.voice_client:
-            if ctx.voice_client.channel != ctx.author.voice.channel:
+            # A player kept warm follows whoever wants it next.
+            if ctx.voice_client.channel != ctx.author.voice.channel and not ctx.voice_state.warm:
                 raise commands.CommandError('Bot is already in a voice channel.')
 
 
 
-bot = commands.Bot('music.', description='Yet another music bot.')
+startup.mark('setup')
+if YTDL_LOAD == 'eager':
+    YTDLSource.load()
+    startup.mark('youtube_dl')
+
+if MUSIC_SHARD_IDS:
+    bot = ShardedMusicBot('music.', description='Yet another music bot.', shard_ids=MUSIC_SHARD_IDS,
+                          shard_count=MUSIC_SHARD_COUNT)
+else:
+    bot = MusicBot('music.', description='Yet another music bot.')
 bot.add_cog(Music(bot))
+startup.mark('cog')
+message_rules = MessageRules(RULES_PATH)
+startup.mark('rules')
 
 
 @bot.event
 async def on_ready():
     print('Logged in as:\n{0.user.name}\n{0.user.id}'.format(bot))
+    if not startup.ready:
+        startup.ready = True
+        startup.mark('gateway')
+        print(startup.report().replace('**', ''))
 
 @bot.event
 async def on_message(message):
-    mention = f'<@!317000109680230400>'
-    mention2 = f'<@317000109680230400>'
-    
-    messages_from_mee6 = ['Să mă iei de cuc {}',
-                          'Mama ta știe că a fătat un ratat {}?',
-                          'De ce sugi pula atata {}?',
-                          'Bă {}. Nu mai fii poponar',
-                          'Sugi pula {}',
-                          'Știi ceva {}? Tu chiar mănânci sloboz cu câcat',
-                          'Muie {}. Ia la muie. Muie muie muie',
-                          'Să-ți fut familia {}',
-                          '{} maimuţă electrocutată ce ești',
-                          'Te bag în pizda mã-tii cu picioarele înainte ca sã-ți dau și muie dupã aia {}',
-                          'Bă {}. Zii lui mã-ta sã nu își mai schimbe rujurile cã îmi face pula curcubeu',
-                          '{}, eu nu am pulã ...... destulã pentru mã-ta',
-                          'Să-mi usuc chiloții pe crucea mã-tii {}',
-                          'Bãgami-aș pula în capul lui {} de imbecil avortat',
-                          '{} Băgami-ai limba-n gaura curului să-mi gâdili hemoroizii',
-                          '{} Dacă slobozul ar eroda, mă-ta ar fi la a 10-a proteză',
-                          '{} Auzi mă pulă bleagă, o mai dor pe mă-ta genunchii ?',
-                          '{} Când mă uit la fața ta, îmi aduc aminte de cea mai nespălată pulă pe care a supt-o mă-ta',
-                          'Du-te dracu {} că dacă te scutur odată îți pică pulele din cur precum merele din pom',
-                          '{} În dicționar, în dreptul cuvântului muie vezi poza lu mă-ta',
-                          '{} Tu n-ai coaie, băi homosexual împuțit, tu ai o urmă de pulicică și două coșuri de le zici tu, mincinos mic, "coaie"',
-                          'Nu ți-a ajuns câtă pulă ți-ai luat aseară la gingiile alea ca niște ciuperci stricate {}?',
-                          'Ți-a mai zis cineva că puți a câcat cu miere, cu un strop de spermă și unul de untură de pește {} ?',
-                          '{} Tu ești o grămadă de slobozi împrăștiați în atmosferă și redirectionați în gura lu mă-ta cu scopul de a-i crăcăna gaura curului care a fost înțepată de toți turcii care au cotropit România de-alungul anilor.',
-                          'Ți-am spus {} de mii de ori că dacă nu te speli pe dinții ăia de raton paralizat nu te mai las să mă sugi de sloboz',
-                          'Te mai duci la pescuit de pule {} ?',
-                          'Sugia-ți-ar dracii pula s-o ducă în sahara iar tu sa rămai cu limba-n curu meu {}',
-                          'Tu și cu mă-ta să vă luați bon de ordine ca să veniți să-mi sugeți pula {}. Nu de alta, dar înainte sunt toate rudele tale și toți morții mă-tii',
-                          'Bă {}, cred ca tu ești un mare magician de ai reușit să sari din prezervativul lu tactu în pizda mă-tii, deserta-mi-aș coaiele în gâtu mă-tii!',
-                          '{} Să te fut până ți s-or strepezi dinții, spaima pulii!',
-                          'Stai la rând {} că nu sunt depozit de sloboz, o să opresc pentru tot neamu lu mă-ta, numai să vă săturați!',
-                          '{} Fraieră a fost mă-ta când s-a crăcănat la tactu și te-a spircăit pe tine, amărâtule!',
-                          'Proastă-i mă-ta la supt că suge de-o viață și tot trabant aveți {}',
-                          'Bravo {}! Ești apreciat ca cel mai bun muist',
-                          'baga-mi-aș pula peste mă-ta-n casă să-i mai fac un handicapat {}!',
-                          '{} Să-mi bag pula peste mă-ta în casă să o dobor, mânca-mi-ai pula de la cotor de curvă lindicoasă',
-                          'TUȘI-MI-AȘ CURUL ÎN GURA TA {} !',
-                          'Dacă mă scol de pe mă-ta și îți înfig pula în carotidă, s-ar putea să ai nevoie de respirație pulă-n gură ca să îți revii {}',
-                          '{} dependent de labă, să mori în budă când iți dă mă-ta aia proastă câcat cu lingurița',
-                          'Să te vad mort și cu dinții rânjiți în pizda mă-tii {}',
-                          '{} Să ți-o dea tactu la căcău până-ți ies ochii ca la melc',
-                          '{} Te bagi și tu în seamă ca chiloții în curul lu curva de mă-ta',
-                          'Uscami-aș prezervativele după ce le scot din zdreanța de mă-ta pe crucea lu tactu ăla labagiu {}',
-                          'Să-mi bag pula în farmacistul de i-a dat prezervative găurite lu tactu de te-a făcut pe tine {}!',
-                          'Da-ți-aș un pumn în pizda aia de gura ca să-ți sară pulile din cur {}',
-                          'Ba {} accident biologic, handicapații nu au drept să vorbească pe serverul asta, așa că taci și suge',
-                          'Tu sugi pula mai mult decât prevede codul de procedura penală {}',
-                          'Mânca-mi-ai puroiul de la hemoroizii curului meu păros {} !',
-                          'Vezi că iți pute gura a pulă de la 10 km {}',
-                          'Dacă aș avea dinți în cur tu ai avea găuri în limbă {}',
-                          'Bă {} tu du-te să faci labă la câcat până o să iasă pasta de dinți cu care o să te speli mândru pe gingii',
-                          'Bă muie, să faci umbra pulii mele cu nasu {}',
-                          '{} Dacă iți procesez un viol peste gingii o să vii la anul cu maxilarul încleștat de sloboz uscat.',
-                          'Îți admir curajul {}, eu niciodată nu aș fi avut curajul să fiu în același timp și idiot și poponar',
-                          '{} Să-mi bag capul pulii cu delicatețe în curul lu soră-ta, bordel de tenii',
-                          '{} Să mi-o sugi ca și cum te-ai îneca și coaiele mele generoase ar fi pline cu oxigen',
-                          'Băga-mi-aș pula în mă-ta că te-a fătat viu {}.',
-                          'Să te bag în pizda mă-tii {}, dar nu de tot, numai cât să-ți rămână capul cu gura afara să mă cac în ea',
-                          '{} Să-ți dea la muie tot poporul chinez și ca supliment să te fută în cur și indienii cu sulițele',
-                          'Să facă mă-ta spume la pizdă ca mașina de spalat și apoi tu sa bei {}',
-                          '{} Bășită e mă-ta aia că se cacă pe ea non stop și tu o ștergi la cur cu gura',
-                          '{} Să-mi bag pula în gura mă-tii că nu rupe chitanțe pe facut muie',
-                          '{} Aș fi putut fi tatăl tău, dar țiganul din fața mea a avut mărunt. Eu nu.',
-                          '{} Mă-ta e ca un congelator: toată lumea își pune carnea în ea, vedea-o-aș chinuită în paturi de hotel!',
-                          'Sugruma-mi-ai ștromeleagul cu corzile tale vocale {}',
-                          'îneca-mi-ai pula cu saliva mă-tii {}',
-                          '{} Trage aer în cur că nu o să mai poți respira de atâta pulă câtă o să primești, sugea-mi-ai nectaru din pula.',
-                          'Câca-m-aș pe mormântu tău să aibe mă-ta în ce să înfigă lumanarea {}.',
-                          '{} Tu să-mi sufli în pulă până o să fac aburi să spui că te-am futut în stil trenuletz de epoca',
-                          '{} Dacă vrei coaie, hai la tata să ți le dea pe la buzișoare de n-ai să mai poți zice nici cum te cheamă, băi rahat cu girofar ce ești',
-                          'Esti o puțulică de sconcs pansat {}',
-                          '{} Am auzit ca mă-ta se duce noaptea când tu dormi, vinde un kil de pizdă, ia 500 g de pulă și iți dă dimineața, sub formă de cârnați să mănânci',
-                          'Dacă ai avea capu de fier, ar rugini de câtă muie ai luat {}. Am impresia că ai ramas încă în stadiul de spermatozoid',
-                          '{} E nesățioasă rău mă-ta, pot sa cred ca e rampă de lansare pentru putori ',
-                          '{} Zi-i lu mă-ta că mai are mult de supt ca să-ți plătească taxa de prost, atâta-i de mare',
-                          'Detona-mi-ași pula între măselele tale {}',
-                          'Să ai parte de felație de la toate babele peste 81 de ani {}',
-                          '{} Îți fac cunoștință cu domnu` Capu` Pulii până-n inima aia a ta de muist lăbar',
-                          'Acolo la școala mea era mă-ta educatoare {}. Ne educa pulile ca să se comporte bine în gura ei',
-                          'Ești de o prostie rară {}, rămân urme pe asfalt pe unde calci',
-                          'Dacă ar durea prostia cred că tu ai fi tot timpul in comă {}',
-                          'Să rozi fiecare spermatozoid între dinții tăi cariați de spermă {}.',
-                          '{} Dacă aș fi avut la momentul potrivit 10 de lei, acum ți-aș fi fost tată',
-                          'Să-ți îndop pula-n cur până faci ocluzie intestinală {}',
-                          '{} Limbajul tău denotă tulburari hormonale de virgin cu coșuri pe față',
-                          '{} Aurolacu pulii mele, ia pielița pulii, respiră în ea și o să ai un kinder cu surprize',
-                          '{} Mai ai ceva de zis să iți dau un cur de lins ',
-                          'Lua-mi-ai câcatul la polizor să-ți sară așchii în gură {}',
-                          'Să-mi bag coaiele în gura lu mă-ta {}. La tine n-am curaj că mi le înghiți',
-                          '{} Să mă plimb cu trenu unde mă-ta e pe post de taxator cu pizdă la urcarea în vagoane']
-    
-    if (str(message.author) == 'MEE6#4876'):
-        if (str(message.author.nick) == 'Modaru Nivelaru'):
-            await message.channel.send(random.choice(messages_from_mee6).format(message.author.mention))           
-    if ((mention in message.content or mention2 in message.content) and str(message.author) == 'MEE6#0000'):
-        await message.channel.send(random.choice(messages_from_mee6).format(message.author.mention))
-    else:
+    consumed = False
+    for rule in message_rules.match(message):
+        dispatcher.send(message.channel, rule.respond(message))
+        consumed = consumed or rule.consume
+
+    if not consumed:
         await bot.process_commands(message)
-    if (str(message.author) == 'OmuRoshuCuUnBatz#8792' and 'muie.popa' in message.content):
-        await message.channel.send(random.choice(messages_from_mee6).format('<@!318429439690276864>'))
 
-bot_token = os.getenv("token")
-bot.run(bot_token)
+
+@bot.command(name='reloadrules')
+@commands.is_owner()
+async def _reload_rules(ctx: commands.Context):
+    """Reloads the message trigger rules from disk."""
+
+    try:
+        message_rules.reload()
+    except (configparser.Error, OSError, KeyError, ValueError) as e:
+        return await ctx.send('Couldn\'t reload the rules, keeping the old ones: {}'.format(e))
+
+    await ctx.message.add_reaction('✅')
+
+
+if __name__ == '__main__':
+    bot_token = os.getenv("token")
+    bot.run(bot_token)
 #dummy commit
@@ -0,0 +1,8 @@
+import os
+
+# Importing bot builds the bot and its caches: keep them in memory, and
+# don't serve metrics or download anything.
+os.environ.setdefault('MUSIC_DB_PATH', ':memory:')
+os.environ.setdefault('MUSIC_METRICS_PORT', '0')
+os.environ.setdefault('MUSIC_AUDIO_CACHE_SIZE', '0')
+os.environ.setdefault('YTDL_LOAD', 'lazy')
@@ -0,0 +1,77 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_opens_after_threshold_failures_in_a_row(clock):
+    breaker = bot.CircuitBreaker(threshold=3, reset_after=30)
+
+    for _ in range(2):
+        breaker.check()
+        breaker.failed()
+    assert breaker.state == 'closed'
+
+    breaker.check()
+    breaker.failed()
+    assert breaker.state == 'open'
+    assert breaker.trips == 1
+    with pytest.raises(bot.ExtractorUnavailable):
+        breaker.check()
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = bot.CircuitBreaker(threshold=2, reset_after=30)
+
+    breaker.failed()
+    breaker.succeeded()
+    breaker.failed()
+
+    assert breaker.state == 'closed'
+
+
+def test_half_open_lets_one_trial_through(clock):
+    breaker = bot.CircuitBreaker(threshold=1, reset_after=30)
+    breaker.failed()
+
+    clock[0] += 30
+    assert breaker.state == 'half-open'
+    breaker.check()
+    # The trial is still running, everyone else fails fast.
+    with pytest.raises(bot.ExtractorUnavailable):
+        breaker.check()
+
+    breaker.succeeded()
+    assert breaker.state == 'closed'
+    breaker.check()
+
+
+def test_failed_trial_opens_again(clock):
+    breaker = bot.CircuitBreaker(threshold=1, reset_after=30)
+    breaker.failed()
+
+    clock[0] += 30
+    breaker.check()
+    breaker.failed()
+
+    assert breaker.state == 'open'
+    assert breaker.trips == 2
+    assert breaker.retry_after == 30
+
+
+def test_released_trial_lets_the_next_one_through(clock):
+    breaker = bot.CircuitBreaker(threshold=1, reset_after=30)
+    breaker.failed()
+
+    clock[0] += 30
+    breaker.check()
+    breaker.released()
+
+    assert breaker.state == 'half-open'
+    breaker.check()
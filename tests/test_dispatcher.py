@@ -0,0 +1,140 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+class FakeMessage:
+    def __init__(self, content, embed):
+        self.content = content
+        self.embed = embed
+        self.edits = 0
+
+    async def edit(self, *, content=None, embed=None):
+        self.content, self.embed = content, embed
+        self.edits += 1
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int = 1):
+        self.id = channel_id
+        self.messages = []
+        self.sent_at = []
+
+    async def send(self, content=None, *, embed=None):
+        message = FakeMessage(content, embed)
+        self.messages.append(message)
+        self.sent_at.append(time.perf_counter())
+        return message
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_token_bucket_allows_a_burst_then_refills(clock):
+    bucket = bot.TokenBucket(rate=2, burst=3)
+
+    for _ in range(3):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+
+    clock[0] += 0.5
+    assert bucket.delay() == 0
+    bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+
+
+def test_token_bucket_refills_up_to_the_burst(clock):
+    bucket = bot.TokenBucket(rate=2, burst=3)
+    bucket.take()
+
+    clock[0] += 60
+    assert bucket.full
+    assert bucket.tokens == 3
+
+
+def test_queued_text_messages_are_merged():
+    dispatcher = bot.Dispatcher(rate=1, burst=5)
+    channel = FakeChannel()
+
+    async def main():
+        futures = [dispatcher.send(channel, 'line {}'.format(i)) for i in range(3)]
+        return await asyncio.gather(*futures)
+
+    messages = asyncio.run(main())
+
+    assert [message.content for message in channel.messages] == ['line 0\nline 1\nline 2']
+    assert all(message is channel.messages[0] for message in messages)
+    assert dispatcher.sent == 1
+    assert dispatcher.coalesced == 2
+
+
+def test_show_edits_the_message_it_sent():
+    dispatcher = bot.Dispatcher(rate=100, burst=5)
+    channel = FakeChannel()
+
+    async def main():
+        await dispatcher.show(channel, 'now playing', 'first')
+        await dispatcher.show(channel, 'now playing', 'second')
+
+    asyncio.run(main())
+
+    assert len(channel.messages) == 1
+    assert channel.messages[0].content == 'second'
+    assert (dispatcher.sent, dispatcher.edited) == (1, 1)
+
+
+def test_only_the_latest_queued_update_is_shown():
+    dispatcher = bot.Dispatcher(rate=100, burst=5)
+    channel = FakeChannel()
+
+    async def main():
+        dispatcher.send(channel, 'Enqueued a song')
+        first = dispatcher.show(channel, 'now playing', 'first')
+        second = dispatcher.show(channel, 'now playing', 'second')
+        return await first, await second
+
+    first, second = asyncio.run(main())
+
+    assert [message.content for message in channel.messages] == ['Enqueued a song', 'second']
+    assert first is second
+    assert dispatcher.coalesced == 1
+
+
+def test_show_in_another_channel_sends_a_new_message():
+    dispatcher = bot.Dispatcher(rate=100, burst=5)
+    channels = FakeChannel(1), FakeChannel(2)
+
+    async def main():
+        await dispatcher.show(channels[0], 'now playing', 'first')
+        await dispatcher.show(channels[1], 'now playing', 'second')
+
+    asyncio.run(main())
+
+    assert [len(channel.messages) for channel in channels] == [1, 1]
+    assert dispatcher.edited == 0
+
+
+def test_sends_beyond_the_burst_wait_for_the_rate():
+    dispatcher = bot.Dispatcher(rate=20, burst=2)
+    channel = FakeChannel()
+    embeds = [bot.discord.Embed(title=str(i)) for i in range(4)]
+
+    async def main():
+        start = time.perf_counter()
+        await asyncio.gather(*(dispatcher.send(channel, embed=embed) for embed in embeds))
+        return start
+
+    start = asyncio.run(main())
+
+    # Embeds aren't merged: two go out at once, then one every 1/20 s.
+    assert len(channel.messages) == 4
+    assert channel.sent_at[1] - start < 0.04
+    assert channel.sent_at[3] - start >= 0.09
@@ -0,0 +1,115 @@
+import os
+import types
+
+import pytest
+
+import bot
+
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rules.ini')
+
+
+def make_message(tag: str, content: str = '', nick: str = None, author_id: int = None):
+    name, discriminator = tag.split('#')
+    author = types.SimpleNamespace(id=author_id if author_id is not None else hash(tag), name=name,
+                                   discriminator=discriminator, nick=nick, mention='<@{}>'.format(hash(tag)))
+    return types.SimpleNamespace(author=author, content=content)
+
+
+def old_on_message(message):
+    """What the hardcoded on_message did: (targets replied to, whether commands were processed)."""
+
+    author = '{0.name}#{0.discriminator}'.format(message.author)
+    targets = []
+    processed = True
+
+    if author == 'MEE6#4876' and message.author.nick == 'Modaru Nivelaru':
+        targets.append(message.author.mention)
+
+    if ('<@!317000109680230400>' in message.content or '<@317000109680230400>' in message.content) \
+            and author == 'MEE6#0000':
+        targets.append(message.author.mention)
+        processed = False
+
+    if author == 'OmuRoshuCuUnBatz#8792' and 'muie.popa' in message.content:
+        targets.append('<@!318429439690276864>')
+
+    return targets, processed
+
+
+def new_on_message(rules, message):
+    matched = rules.match(message)
+    targets = [rule.target or message.author.mention for rule in matched]
+    return targets, not any(rule.consume for rule in matched)
+
+
+MESSAGES = [
+    make_message('MEE6#4876', 'GG, you just advanced to level 2!', nick='Modaru Nivelaru'),
+    make_message('MEE6#4876', 'GG, you just advanced to level 2!', nick='MEE6'),
+    make_message('MEE6#4876', 'GG, you just advanced to level 2!'),
+    make_message('MEE6#0000', 'hey <@317000109680230400>'),
+    make_message('MEE6#0000', 'hey <@!317000109680230400>'),
+    make_message('MEE6#0000', 'hey <@!318429439690276864>'),
+    make_message('MEE6#1234', 'hey <@!317000109680230400>'),
+    make_message('OmuRoshuCuUnBatz#8792', 'muie.popa'),
+    make_message('OmuRoshuCuUnBatz#8792', 'muie popa'),
+    make_message('Someone#0001', 'muie.popa <@317000109680230400>', nick='Modaru Nivelaru'),
+    make_message('Someone#0001', 'music.play never gonna give you up'),
+]
+
+
+@pytest.mark.parametrize('message', MESSAGES, ids=lambda m: '{0.author.name}#{0.author.discriminator}: {0.content}'.format(m))
+def test_rules_ini_matches_the_old_on_message(message):
+    rules = bot.MessageRules(RULES_PATH)
+
+    assert new_on_message(rules, message) == old_on_message(message)
+
+
+def test_responses_fill_in_the_target():
+    rules = bot.MessageRules(RULES_PATH)
+    message = make_message('OmuRoshuCuUnBatz#8792', 'muie.popa')
+
+    [rule] = rules.match(message)
+    assert '<@!318429439690276864>' in rule.respond(message)
+
+
+def write_rules(tmp_path, text):
+    path = tmp_path / 'rules.ini'
+    path.write_text(text, encoding='utf-8')
+    return bot.MessageRules(str(path))
+
+
+def test_rules_by_id_and_by_tag(tmp_path):
+    rules = write_rules(tmp_path, '\n'.join([
+        '[rule:by-id]', 'author_ids = 42', 'responses = hi',
+        '[rule:by-tag]', 'authors = Bot#0001', 'contains = ping, pong', 'responses = hi', 'consume = yes',
+        '[responses:hi]', 'lines =', '    hi {}',
+    ]))
+
+    assert len(rules) == 2
+    assert [rule.name for rule in rules.match(make_message('Anyone#0002', author_id=42))] == ['by-id']
+    assert [rule.name for rule in rules.match(make_message('Bot#0001', 'pong', author_id=7))] == ['by-tag']
+    assert rules.match(make_message('Bot#0001', 'hello', author_id=7)) == []
+    assert rules.match(make_message('Bot#0002', 'ping', author_id=8)) == ()
+
+
+def test_tags_are_resolved_to_the_first_id_seen(tmp_path):
+    rules = write_rules(tmp_path, '\n'.join([
+        '[rule:by-tag]', 'authors = Bot#0001', 'responses = hi',
+        '[responses:hi]', 'lines = hi {}',
+    ]))
+
+    assert rules.match(make_message('Bot#0001', author_id=7))
+    # A renamed author keeps their rules, looked up by id from now on.
+    assert rules.match(make_message('Renamed#0009', author_id=7))
+
+
+def test_reload_replaces_the_rules(tmp_path):
+    rules = write_rules(tmp_path, '[rule:a]\nauthor_ids = 1\nresponses = hi\n[responses:hi]\nlines = hi\n')
+    (tmp_path / 'rules.ini').write_text('[rule:b]\nauthor_ids = 2\nresponses = hi\n[responses:hi]\nlines = hi\n',
+                                        encoding='utf-8')
+
+    rules.reload()
+
+    assert rules.match(make_message('A#0001', author_id=1)) == ()
+    assert [rule.name for rule in rules.match(make_message('B#0001', author_id=2))] == ['b']
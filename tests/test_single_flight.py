@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def test_concurrent_callers_share_one_run():
+    flight = bot.SingleFlight()
+    runs = []
+
+    async def work():
+        runs.append(1)
+        await asyncio.sleep(0.01)
+        return 'info'
+
+    async def main():
+        return await asyncio.gather(*(flight.run(('query', 'song'), work) for _ in range(5)))
+
+    results = asyncio.run(main())
+
+    assert len(runs) == 1
+    assert [result for result, _ in results] == ['info'] * 5
+    assert [shared for _, shared in results] == [False] + [True] * 4
+    assert flight.stats() == {'in_flight': 0, 'requests': 5, 'coalesced': 4, 'dedup_rate': 0.8}
+
+
+def test_different_keys_run_separately():
+    flight = bot.SingleFlight()
+    runs = []
+
+    async def work():
+        runs.append(1)
+        await asyncio.sleep(0)
+        return len(runs)
+
+    async def main():
+        return await asyncio.gather(flight.run(('query', 'a'), work), flight.run(('query', 'b'), work))
+
+    asyncio.run(main())
+
+    assert len(runs) == 2
+
+
+def test_later_callers_start_a_new_run():
+    flight = bot.SingleFlight()
+    runs = []
+
+    async def work():
+        runs.append(1)
+        return len(runs)
+
+    async def main():
+        first = await flight.run(('page', 'url'), work)
+        second = await flight.run(('page', 'url'), work)
+        return first, second
+
+    assert asyncio.run(main()) == ((1, False), (2, False))
+    assert len(flight) == 0
+
+
+def test_errors_reach_every_caller():
+    flight = bot.SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise bot.YTDLError('gone')
+
+    async def main():
+        return await asyncio.gather(*(flight.run(('query', 'song'), work) for _ in range(3)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert all(isinstance(result, bot.YTDLError) for result in results)
+
+
+def test_cancelled_caller_doesnt_cancel_the_shared_run():
+    flight = bot.SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.02)
+        return 'info'
+
+    async def main():
+        first = asyncio.ensure_future(flight.run(('query', 'song'), work))
+        second = asyncio.ensure_future(flight.run(('query', 'song'), work))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == ('info', True)
@@ -0,0 +1,114 @@
+import random
+
+import bot
+
+
+def make_song(name: str, requester: int = 1):
+    track = bot.Track.placeholder('https://www.youtube.com/watch?v=' + name, name)
+    return bot.Song(track, bot.Requester(requester), channel=None)
+
+
+def titles(queue: bot.SongQueue):
+    return [song.track.title for song in queue]
+
+
+def test_appends_in_arrival_order():
+    queue = bot.SongQueue()
+    queue.extend(make_song(name) for name in 'abc')
+
+    assert titles(queue) == ['a', 'b', 'c']
+    assert queue.get_nowait().track.title == 'a'
+    assert titles(queue) == ['b', 'c']
+
+
+def test_fair_interleaves_requesters_round_robin():
+    queue = bot.SongQueue(fair=True)
+    queue.extend(make_song(name, 1) for name in ('a1', 'a2', 'a3'))
+    queue.extend(make_song(name, 2) for name in ('b1', 'b2'))
+
+    assert titles(queue) == ['a1', 'b1', 'a2', 'b2', 'a3']
+
+
+def test_fair_newcomer_joins_the_round_being_played():
+    queue = bot.SongQueue(fair=True)
+    queue.extend(make_song(name, 1) for name in ('a1', 'a2'))
+    queue.put_nowait(make_song('b1', 2))
+    assert queue.get_nowait().track.title == 'a1'
+
+    queue.put_nowait(make_song('c1', 3))
+
+    assert titles(queue) == ['b1', 'c1', 'a2']
+
+
+def test_set_fair_reorders_queued_songs():
+    queue = bot.SongQueue()
+    queue.extend(make_song(name, 1) for name in ('a1', 'a2'))
+    queue.extend(make_song(name, 2) for name in ('b1', 'b2'))
+
+    queue.set_fair(True)
+    assert titles(queue) == ['a1', 'b1', 'a2', 'b2']
+
+    queue.set_fair(False)
+    assert titles(queue) == ['a1', 'b1', 'a2', 'b2']
+    queue.put_nowait(make_song('c1', 3))
+    assert titles(queue)[-1] == 'c1'
+
+
+def test_move():
+    queue = bot.SongQueue()
+    queue.extend(make_song(name) for name in 'abcde')
+
+    queue.move(4, 0)
+    assert titles(queue) == ['e', 'a', 'b', 'c', 'd']
+    queue.move(0, 2)
+    assert titles(queue) == ['a', 'b', 'e', 'c', 'd']
+    queue.move(1, 100)
+    assert titles(queue) == ['a', 'e', 'c', 'd', 'b']
+
+    # Songs queued after a move still go to the end.
+    queue.put_nowait(make_song('f'))
+    assert titles(queue)[-1] == 'f'
+
+
+def test_repeated_moves_between_the_same_neighbours():
+    queue = bot.SongQueue()
+    queue.extend(make_song(name) for name in 'abc')
+
+    for _ in range(100):
+        queue.move(2, 1)
+
+    assert titles(queue) == ['a', 'b', 'c']
+
+
+def test_shuffle_keeps_every_song():
+    random.seed(0)
+    queue = bot.SongQueue()
+    queue.extend(make_song(str(i)) for i in range(50))
+
+    queue.shuffle()
+
+    assert sorted(titles(queue), key=int) == [str(i) for i in range(50)]
+    assert titles(queue) != [str(i) for i in range(50)]
+    assert all(queue.has(song.track.webpage_url) for song in queue)
+
+
+def test_remove_and_lookups():
+    queue = bot.SongQueue()
+    songs = [make_song(name) for name in 'abc']
+    queue.extend(songs)
+    url = songs[1].track.webpage_url
+
+    assert queue.has(url)
+    assert queue.index(url) == 1
+    assert queue.remove(1) is songs[1]
+    assert not queue.has(url)
+    assert titles(queue) == ['a', 'c']
+
+
+def test_page_is_rendered_again_after_a_change():
+    queue = bot.SongQueue()
+    queue.extend(make_song(name) for name in 'abc')
+
+    assert queue.page(1, size=2).count('\n') == 1
+    queue.remove(0)
+    assert '**b**' in queue.page(1, size=2).splitlines()[0]